@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; -*-
+# SPDX-FileCopyrightText: 2016-2023 Siveo <support@siveo.net>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+One pass of the WOL 1 / WAITING MACHINE ONLINE phases of
+scheduledeployrecoveryjob over a campaign, with one query per machine
+(getPresenceuuid, update_state_deploy, test_deploy_in_partiel_slot,
+nbsyncthingdeploy) and with the bulk queries (getPresenceuuids,
+update_state_deploys, test_deploy_in_partiel_slots, nbsyncthingdeploys).
+
+The methods of XmppMasterDatabase and MscDatabase are called as the
+substitute calls them, on a fixture holding the columns they read. The
+deploy table is created in the xmppmaster schema: with sqlite it is an
+attached database, with --url the tables are dropped and created in the
+database of the url, which must be named xmppmaster.
+
+usage: bench_deploy_states.py [--url sqlite:///:memory:] [--machines 5000]
+                              [--commands 10]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+from sqlalchemy import MetaData, Table, create_engine, event, text
+from sqlalchemy.orm import mapper
+from sqlalchemy.pool import StaticPool
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.realpath(__file__)),
+        "..",
+        "..",
+        "pulse_xmpp_master_substitute",
+    ),
+)
+from lib.plugins.msc import MscDatabase  # noqa: E402
+from lib.plugins.msc.orm.commands import Commands  # noqa: E402
+from lib.plugins.xmpp import XmppMasterDatabase  # noqa: E402
+
+SCHEMA = [
+    """CREATE TABLE xmppmaster.deploy (id INTEGER PRIMARY KEY,
+       title VARCHAR(255), state VARCHAR(255), inventoryuuid VARCHAR(45),
+       command INTEGER, group_uuid VARCHAR(45), syncthing INTEGER)""",
+    """CREATE TABLE machines (id INTEGER PRIMARY KEY,
+       uuid_inventorymachine VARCHAR(45), enabled INTEGER)""",
+    """CREATE TABLE commands (id INTEGER PRIMARY KEY, title VARCHAR(255),
+       deployment_intervals VARCHAR(255))""",
+]
+SCHEMA_TABLES = ["xmppmaster.deploy", "machines", "commands"]
+
+
+def create(engine):
+    with engine.begin() as connection:
+        for sql in ["DROP TABLE IF EXISTS %s" % x for x in SCHEMA_TABLES] + SCHEMA:
+            connection.execute(text(sql))
+
+
+def populate(engine, machines, commands):
+    with engine.begin() as connection:
+        for table in SCHEMA_TABLES:
+            connection.execute(text("DELETE FROM %s" % table))
+        connection.execute(
+            text("INSERT INTO commands VALUES (:id, :title, '')"),
+            [{"id": x, "title": "command %s" % x} for x in range(commands)],
+        )
+        connection.execute(
+            text("INSERT INTO machines VALUES (:id, :uuid, :enabled)"),
+            [
+                {"id": x, "uuid": "UUID%s" % x, "enabled": random.randint(0, 1)}
+                for x in range(machines)
+            ],
+        )
+        # nbsyncthingdeploy writes the group in the query without quotes:
+        # the groups are numbers, as in the database of the substitute
+        connection.execute(
+            text(
+                "INSERT INTO xmppmaster.deploy VALUES "
+                "(:id, :title, 'WOL 1', :uuid, :command, '1', 0)"
+            ),
+            [
+                {
+                    "id": x,
+                    "title": "command %s" % (x % commands),
+                    "uuid": "UUID%s" % x,
+                    "command": x % commands,
+                }
+                for x in range(machines)
+            ],
+        )
+
+
+def per_machine(xmpp, msc, rows):
+    for row in rows:
+        msc.test_deploy_in_partiel_slot(row["title"])
+        xmpp.nbsyncthingdeploy(row["group_uuid"], row["command"])
+        if xmpp.getPresenceuuid(row["inventoryuuid"]):
+            xmpp.update_state_deploy(row["id"], "WAITING MACHINE ONLINE")
+        else:
+            xmpp.update_state_deploy(row["id"], "WOL 2")
+
+
+def bulk(xmpp, msc, rows):
+    msc.test_deploy_in_partiel_slots(set([row["title"] for row in rows]))
+    xmpp.nbsyncthingdeploys(set([(row["group_uuid"], row["command"]) for row in rows]))
+    presence = xmpp.getPresenceuuids([row["inventoryuuid"] for row in rows])
+    newstates = {}
+    for row in rows:
+        if presence[row["inventoryuuid"]]:
+            newstates.setdefault("WAITING MACHINE ONLINE", []).append(row["id"])
+        else:
+            newstates.setdefault("WOL 2", []).append(row["id"])
+    for state, sql_ids in newstates.items():
+        xmpp.update_state_deploys(sql_ids, state)
+
+
+def run(label, engine, options, function):
+    populate(engine, options.machines, options.commands)
+    with engine.connect() as connection:
+        rows = [
+            dict(x._mapping)
+            for x in connection.execute(
+                text("SELECT * FROM xmppmaster.deploy WHERE state LIKE 'WOL 1%'")
+            )
+        ]
+    queries = []
+
+    def count(connection, cursor, statement, *args):
+        queries.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count)
+    start = time.perf_counter()
+    function(XmppMasterDatabase(), MscDatabase(), rows)
+    elapsed = time.perf_counter() - start
+    event.remove(engine, "before_cursor_execute", count)
+    print(
+        "%-20s %6d machines  %7d queries  %8.3f s"
+        % (label, len(rows), len(queries), elapsed)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="sqlite:///:memory:")
+    parser.add_argument("--machines", type=int, default=5000)
+    parser.add_argument("--commands", type=int, default=10)
+    options = parser.parse_args()
+
+    if options.url.startswith("sqlite"):
+        engine = create_engine(
+            options.url,
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+        )
+
+        @event.listens_for(engine, "connect")
+        def attach(connection, record):
+            connection.execute("ATTACH DATABASE ':memory:' AS xmppmaster")
+
+    else:
+        engine = create_engine(options.url)
+
+    XmppMasterDatabase().engine_xmppmmaster_base = engine
+    MscDatabase().engine_mscmmaster_base = engine
+    create(engine)
+    mapper(Commands, Table("commands", MetaData(), autoload_with=engine))
+
+    random.seed(0)
+    run("query per machine", engine, options, per_machine)
+    random.seed(0)
+    run("bulk queries", engine, options, bulk)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; -*-
+# SPDX-FileCopyrightText: 2016-2023 Siveo <support@siveo.net>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+Forward of inventories to several inventory servers, with one gzip level 9
+and one requests.post per url (old send_content of resultinventory) and
+with the InventoryForwarder (keep-alive sessions, parallel targets).
+
+Each target is a local HTTP stand-in which answers after --latency ms.
+
+usage: bench_inventory_forward.py [--inventories 300] [--targets 2]
+                                  [--size 300] [--latency 50]
+                                  [--workers 2] [--compresslevel 6]
+"""
+
+import argparse
+import gzip
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.realpath(__file__)),
+        "..",
+        "..",
+        "pulse_xmpp_master_substitute",
+    ),
+)
+from lib.inventoryforward import ForwardTarget, InventoryForwarder  # noqa: E402
+
+
+class StandIn(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.server.connections.add(self.client_address)
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.headers["Content-Type"] == "Application/x-gzip":
+            body = gzip.decompress(body)
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.received += 1
+        reply = b"<?xml version='1.0' encoding='UTF-8'?><REPLY></REPLY>"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+
+def stand_in(latency):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    server.daemon_threads = True
+    server.latency = latency
+    server.lock = threading.Lock()
+    server.received = 0
+    server.connections = set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def inventory(size, index):
+    softwares = "".join(
+        "<SOFTWARES><NAME>software %s</NAME><VERSION>%s.%s</VERSION></SOFTWARES>"
+        % (x, random.randint(0, 9), x)
+        for x in range(size * 1024 // 70)
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8" ?><REQUEST><CONTENT>%s</CONTENT>'
+        "<DEVICEID>pc-%05d-2024-01-01-10-00-00</DEVICEID><QUERY>INVENTORY</QUERY>"
+        "</REQUEST>" % (softwares, index)
+    )
+
+
+def send_content(urls, content):
+    for url in urls:
+        requests.post(
+            url,
+            headers={"Content-Type": "Application/x-gzip"},
+            data=gzip.compress(content.encode("utf-8"), compresslevel=9),
+        )
+
+
+def run(label, servers, inventories, function):
+    for server in servers:
+        server.received = 0
+        server.connections = set()
+    start = time.perf_counter()
+    function(inventories)
+    while sum(server.received for server in servers) < len(inventories) * len(servers):
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    print(
+        "%-24s %5d inventories  %5d connections  %8.3f s  %8.0f inventories/min"
+        % (
+            label,
+            len(inventories),
+            sum(len(server.connections) for server in servers),
+            elapsed,
+            len(inventories) * 60 / elapsed,
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--inventories", type=int, default=300)
+    parser.add_argument("--targets", type=int, default=2)
+    parser.add_argument("--size", type=int, default=300, help="inventory size, Ko")
+    parser.add_argument("--latency", type=int, default=50, help="ms")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--compresslevel", type=int, default=6)
+    options = parser.parse_args()
+
+    random.seed(0)
+    servers = [stand_in(options.latency / 1000.0) for _ in range(options.targets)]
+    urls = ["http://127.0.0.1:%s/" % server.server_address[1] for server in servers]
+    inventories = [inventory(options.size, x) for x in range(options.inventories)]
+
+    def old(inventories):
+        for content in inventories:
+            send_content(urls, content)
+
+    forwarder = InventoryForwarder(
+        [
+            ForwardTarget(
+                url,
+                compresslevel=options.compresslevel,
+                workers=options.workers,
+                queue_size=options.inventories,
+            )
+            for url in urls
+        ]
+    )
+
+    def new(inventories):
+        for content in inventories:
+            forwarder.submit(content)
+
+    run("post per url, level 9", servers, inventories, old)
+    run("forwarder, level %s" % options.compresslevel, servers, inventories, new)
+    forwarder.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; -*-
+# SPDX-FileCopyrightText: 2016-2023 Siveo <support@siveo.net>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+Encode/decode time and stanza size of the custom_xep IQ payloads, in the
+legacy format (base64 in the tag name) and in the payload element with each
+available encoding, for typical remotefile, remotecommandshell and
+inventory messages.
+
+usage: bench_iq_payload.py [--loops 50]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import slixmpp
+from slixmpp import Iq
+from slixmpp.xmlstream import tostring
+from slixmpp.xmlstream.stanzabase import ET
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.realpath(__file__)),
+        "..",
+        "..",
+        "pulse_xmpp_master_substitute",
+    ),
+)
+from lib.iq_payload import (  # noqa: E402
+    get_iq_payload,
+    set_iq_payload,
+    supported_encodings,
+)
+
+
+def remotefile_payload():
+    listing = {
+        "path_abs_current": "/var/lib/pulse2/packages",
+        "list_dirs_current": ["dir%04d" % i for i in range(300)],
+        "list_files_current": [
+            ["file%05d.dat" % i, random.randint(0, 1 << 30)] for i in range(3000)
+        ],
+    }
+    return json.dumps({"action": "remotefile", "result": listing})
+
+
+def remotecommandshell_payload():
+    lines = [
+        "%-10s %6d %5.1f %5.1f %s"
+        % ("root", pid, random.random() * 10, random.random() * 5, "/usr/bin/proc")
+        for pid in range(1, 4000)
+    ]
+    return json.dumps(
+        {"action": "remotecommandshell", "result": {"code": 0, "result": lines}}
+    )
+
+
+def inventory_payload():
+    softwares = "".join(
+        "<SOFTWARES><NAME>package-%d</NAME><VERSION>%d.%d.%d</VERSION>"
+        "<PUBLISHER>Vendor %d</PUBLISHER></SOFTWARES>"
+        % (i, i % 7, i % 13, i % 29, i % 50)
+        for i in range(2500)
+    )
+    xml = "<?xml version='1.0'?><REQUEST><CONTENT>%s</CONTENT></REQUEST>" % softwares
+    return json.dumps({"action": "inventory", "result": xml})
+
+
+def run(client, name, message, encoding, loops):
+    legacy = encoding == "legacy"
+    start = time.perf_counter()
+    for _ in range(loops):
+        iq = client.make_iq_get(queryxmlns="custom_xep", ito="machine@pulse/r")
+        set_iq_payload(iq, message, None if legacy else encoding)
+        wire = tostring(iq.xml)
+    encode = (time.perf_counter() - start) / loops
+    start = time.perf_counter()
+    for _ in range(loops):
+        data, _ = get_iq_payload(Iq(client, ET.fromstring(wire)))
+    decode = (time.perf_counter() - start) / loops
+    assert data.decode("utf-8") == message
+    print(
+        "%-20s %-7s %10d %10d %10.2f %10.2f"
+        % (name, encoding, len(message), len(wire), encode * 1000, decode * 1000)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--loops", type=int, default=50)
+    options = parser.parse_args()
+    random.seed(0)
+    client = slixmpp.ClientXMPP("master@pulse/MASTER", "secret")
+    print(
+        "%-20s %-7s %10s %10s %10s %10s"
+        % ("payload", "format", "json", "stanza", "encode ms", "decode ms")
+    )
+    for name, message in (
+        ("remotefile", remotefile_payload()),
+        ("remotecommandshell", remotecommandshell_payload()),
+        ("inventory", inventory_payload()),
+    ):
+        for encoding in ["legacy"] + supported_encodings():
+            run(client, name, message, encoding, options.loops)
+
+
+if __name__ == "__main__":
+    main()
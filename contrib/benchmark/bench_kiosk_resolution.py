@@ -0,0 +1,245 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; -*-
+# SPDX-FileCopyrightText: 2016-2023 Siveo <support@siveo.net>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+Resolution of the kiosk packages of machines by plugin_resultkiosk, with the
+old search (regex compiled, descriptor loaded and software list scanned for
+each package, one acknowledgement query per package) and with the
+kiosk_resolver (compiled rules, cached descriptors, prefix index of the
+softwares, one acknowledgement query per machine).
+
+The packages are written in a temporary package directory, the profiles and
+the inventories of the machines are synthetic.
+
+usage: bench_kiosk_resolution.py [--machines 50] [--packages 300]
+                                 [--softwares 1000] [--installed 0.3]
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from distutils.version import LooseVersion
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.realpath(__file__)),
+        "..",
+        "..",
+        "pulse_xmpp_master_substitute",
+    ),
+)
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.realpath(__file__)),
+        "..",
+        "..",
+        "pulse_xmpp_master_substitute",
+        "pluginsmastersubstitute",
+    ),
+)
+from lib.managepackage import managepackage  # noqa: E402
+from lib.kioskresolver import kiosk_resolver  # noqa: E402
+import plugin_resultkiosk  # noqa: E402
+
+VENDORS = ["Microsoft", "Mozilla", "Oracle", "Adobe", "Google", "VideoLAN", "7-Zip"]
+
+
+def packages_fixture(directory, count):
+    """
+    Returns the profile packages (rows of get_profile_list_for_profiles_list).
+    """
+    rows = []
+    for index in range(count):
+        package_uuid = str(uuid.uuid4())
+        software = "%s Software %s (x64)" % (VENDORS[index % len(VENDORS)], index)
+        sequence = [{"action": "actionprocessscriptfile", "step": 0}]
+        if index % 2:
+            sequence.append({"action": "action_section_uninstall", "step": 1})
+        os.makedirs(os.path.join(directory, package_uuid))
+        with open(os.path.join(directory, package_uuid, "xmppdeploy.json"), "w") as f:
+            json.dump(
+                {
+                    "info": {
+                        "name": "package %s" % index,
+                        "software": software,
+                        "version": "2.%s" % index,
+                        "launcher": "C:\\Program Files\\soft%s.exe" % index,
+                    },
+                    "win": {"sequence": sequence},
+                },
+                f,
+            )
+        with open(os.path.join(directory, package_uuid, "conf.json"), "w") as f:
+            json.dump({"id": package_uuid, "version": "2.%s" % index}, f)
+        rows.append(
+            (
+                "package %s" % index,
+                "profile %s" % (index % 5),
+                "description %s" % index,
+                "2.%s" % index,
+                software,
+                "2.%s" % index,
+                package_uuid,
+                "win",
+                "allowed" if index % 3 else "restricted",
+                index,
+            )
+        )
+    return rows
+
+
+def inventory(rng, rows, count, installed):
+    softwares = [
+        [rng.choice(VENDORS), "Other Software %s" % rng.randint(0, 100000), "1.0"]
+        for _ in range(count)
+    ]
+    for row in rows:
+        if rng.random() < installed:
+            softwares.insert(
+                rng.randint(0, len(softwares)),
+                [row[4].split(" ")[0], row[4], "2.%s" % rng.randint(0, len(rows))],
+            )
+    return softwares
+
+
+def acknowledges(rows, rng):
+    return [
+        {
+            "package_uuid": row[6],
+            "id_package_has_profil": row[9],
+            "status": rng.choice(["allowed", "waiting", "rejected"]),
+        }
+        for row in rows
+        if row[8] != "allowed" and rng.random() < 0.5
+    ]
+
+
+def old_search(list_software_glpi, list_granted_packages, packageprofile):
+    # __search_software_in_glpi before the kiosk_resolver
+    structuredatakioskelement = {
+        "name": packageprofile[0],
+        "action": [],
+        "uuid": packageprofile[6],
+        "description": packageprofile[2],
+        "version": packageprofile[3],
+        "profile": packageprofile[1],
+        "launcher_cmd": "",
+    }
+    descriptor = managepackage.getdescriptorpackageuuid(packageprofile[6])
+    if "launcher" in descriptor["info"]:
+        structuredatakioskelement["launcher_cmd"] = descriptor["info"]["launcher"]
+    patternname = re.compile(
+        "(?i)"
+        + packageprofile[4]
+        .replace("+", r"\+")
+        .replace("*", r"\*")
+        .replace("(", r"\(")
+        .replace(")", r"\)")
+        .replace(".", r"\.")
+    )
+    for soft_glpi in list_software_glpi:
+        if (
+            patternname.match(str(soft_glpi[0]))
+            or patternname.match(str(soft_glpi[1]))
+            or (soft_glpi[1] == packageprofile[4] and soft_glpi[2] == packageprofile[5])
+        ):
+            structuredatakioskelement["icon"] = "kiosk.png"
+            for step in descriptor.get("win", {}).get("sequence", []):
+                if step.get("action") == "action_section_uninstall":
+                    structuredatakioskelement["action"].append("Delete")
+                    break
+            structuredatakioskelement["action"].append("Launch")
+            if LooseVersion(soft_glpi[2]) < LooseVersion(packageprofile[3]):
+                structuredatakioskelement["action"].append("Update")
+            break
+    if len(structuredatakioskelement["action"]) == 0:
+        if packageprofile[8] == "allowed":
+            structuredatakioskelement["action"].append("Install")
+        else:
+            trigger = False
+            for ack in list_granted_packages:
+                if ack["package_uuid"] == structuredatakioskelement["uuid"]:
+                    if ack["id_package_has_profil"] != packageprofile[9]:
+                        continue
+                    if ack["status"] == "allowed":
+                        structuredatakioskelement["action"].append("Install")
+                    elif ack["status"] in ("waiting", "rejected"):
+                        trigger = True
+            if len(structuredatakioskelement["action"]) == 0 and trigger is False:
+                structuredatakioskelement["action"].append("Ask")
+    return structuredatakioskelement
+
+
+def old(rows, softwares, acks):
+    queries = len(rows)
+    return [old_search(softwares, acks, row) for row in rows], queries
+
+
+def new(rows, softwares, acks):
+    queries = 1
+    granted = {}
+    for ack in acks:
+        granted.setdefault(
+            (ack["package_uuid"], ack["id_package_has_profil"]), []
+        ).append(ack)
+    index = kiosk_resolver.softwares(softwares, [row[4] for row in rows])
+    search = getattr(plugin_resultkiosk, "__search_software_in_glpi")
+    return [search(index, granted, row) for row in rows], queries
+
+
+def run(label, function, machines, rows):
+    start = time.perf_counter()
+    results = []
+    queries = 0
+    for softwares, acks in machines:
+        result, count = function(rows, softwares, acks)
+        results.append(result)
+        queries += count
+    elapsed = time.perf_counter() - start
+    print(
+        "%-16s %4d machines  %6d ack queries  %8.3f s  %8.2f ms/machine"
+        % (label, len(machines), queries, elapsed, elapsed * 1000 / len(machines))
+    )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--machines", type=int, default=50)
+    parser.add_argument("--packages", type=int, default=300)
+    parser.add_argument("--softwares", type=int, default=1000)
+    parser.add_argument("--installed", type=float, default=0.3)
+    options = parser.parse_args()
+
+    rng = random.Random(0)
+    directory = tempfile.mkdtemp()
+    managepackage.packagedir = staticmethod(lambda: directory)
+    try:
+        rows = packages_fixture(directory, options.packages)
+        machines = [
+            (
+                inventory(rng, rows, options.softwares, options.installed),
+                acknowledges(rows, rng),
+            )
+            for _ in range(options.machines)
+        ]
+        before = run("old search", old, machines, rows)
+        after = run("kiosk_resolver", new, machines, rows)
+        print("same packages and actions : %s" % (before == after))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; -*-
+# SPDX-FileCopyrightText: 2016-2023 Siveo <support@siveo.net>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+Reflection of the tables at the activation of a database plugin
+(automap_base().prepare(reflect=True) then Table(..., autoload=True) for each
+table, as the Glpi* initMappers do), with and without schema snapshot.
+
+The database is a SQLite file of --tables tables. --latency ms are added to
+each query to stand for the round trip to a MySQL server.
+
+usage: bench_schema_snapshot.py [--tables 60] [--columns 15] [--latency 0.5]
+                                [--starts 3]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from sqlalchemy import MetaData, Table, create_engine, event
+from sqlalchemy.ext.automap import automap_base
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.realpath(__file__)),
+        "..",
+        "..",
+        "pulse_xmpp_master_substitute",
+    ),
+)
+from lib.plugins.utils.database_utils import schema_snapshot  # noqa: E402
+
+
+def fixture(filename, tables, columns):
+    engine = create_engine("sqlite:///%s" % filename)
+    with engine.begin() as connection:
+        for index in range(tables):
+            fields = ", ".join(
+                "field%s varchar(255) default ''" % x for x in range(columns)
+            )
+            connection.exec_driver_sql(
+                "CREATE TABLE glpi_table%s (id integer primary key, %s,"
+                " parent_id integer references glpi_table%s(id))"
+                % (index, fields, max(index - 1, 0))
+            )
+            connection.exec_driver_sql(
+                "CREATE INDEX ix_table%s ON glpi_table%s (field0)" % (index, index)
+            )
+    engine.dispose()
+
+
+def start(filename, tables, latency, directory):
+    """
+    Activation of the plugin, returns (duration, number of queries).
+    """
+    queries = [0]
+    engine = create_engine("sqlite:///%s" % filename)
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def round_trip(*args, **kwargs):
+        queries[0] += 1
+        time.sleep(latency)
+
+    begin = time.perf_counter()
+    metadata = MetaData(engine)
+    with schema_snapshot(engine, "bench", directory):
+        base = automap_base()
+        base.prepare(engine, reflect=True)
+        for index in range(tables):
+            Table("glpi_table%s" % index, metadata, autoload=True)
+    duration = time.perf_counter() - begin
+    engine.dispose()
+    return duration, queries[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tables", type=int, default=60)
+    parser.add_argument("--columns", type=int, default=15)
+    parser.add_argument("--latency", type=float, default=0.5, help="ms per query")
+    parser.add_argument("--starts", type=int, default=3)
+    options = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(workdir, "glpi.db")
+        directory = os.path.join(workdir, "schema_snapshot")
+        fixture(filename, options.tables, options.columns)
+        runs = [("reflection", None)] * options.starts
+        runs += [("snapshot, first start", directory)]
+        runs += [("snapshot", directory)] * options.starts
+        for label, snapshot in runs:
+            duration, queries = start(
+                filename, options.tables, options.latency / 1000.0, snapshot
+            )
+            print(
+                "%-24s %4d tables  %6d queries  %8.3f s"
+                % (label, options.tables, queries, duration)
+            )
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; -*-
+# SPDX-FileCopyrightText: 2016-2023 Siveo <support@siveo.net>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+Calls per second of a DatabaseHelper._sessionm decorated method, with a
+sessionmaker/scoped_session built on every call (old decorator) and with the
+shared SessionRegistry, plus the same calls grouped in one unit of work.
+
+usage: bench_sessionm.py [--url sqlite:///:memory:] [--calls 5000]
+"""
+
+import argparse
+import functools
+import os
+import sys
+import time
+
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.realpath(__file__)),
+        "..",
+        "..",
+        "pulse_xmpp_master_substitute",
+    ),
+)
+from lib.plugins.utils.database_utils import session_registry  # noqa: E402
+
+Base = declarative_base()
+
+
+class Logs(Base):
+    __tablename__ = "logs"
+    id = Column(Integer, primary_key=True)
+    text = Column(String(255))
+
+
+def old_sessionm(func):
+    @functools.wraps(func)
+    def __sessionm(self, *args, **kw):
+        session_factory = sessionmaker(bind=self.engine)
+        sessionmultithread = scoped_session(session_factory)
+        result = func(self, sessionmultithread, *args, **kw)
+        sessionmultithread.remove()
+        return result
+
+    return __sessionm
+
+
+def new_sessionm(func):
+    @functools.wraps(func)
+    def __sessionm(self, *args, **kw):
+        return session_registry(self.engine).call(func, self, *args, **kw)
+
+    return __sessionm
+
+
+class Database(object):
+    def __init__(self, engine):
+        self.engine = engine
+
+    @old_sessionm
+    def setlog_old(self, session, text):
+        session.add(Logs(text=text))
+        session.commit()
+
+    @new_sessionm
+    def setlog_new(self, session, text):
+        session.add(Logs(text=text))
+        session.commit()
+
+
+def run(label, calls, function, batch=1):
+    """
+    Calls function calls // batch times, each call making batch decorated
+    calls.
+    """
+    start = time.perf_counter()
+    for index in range(calls // batch):
+        function("log %s" % index)
+    elapsed = time.perf_counter() - start
+    print(
+        "%-28s %8d calls  %8.3f s  %10.1f calls/s"
+        % (label, calls, elapsed, calls / elapsed)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="sqlite:///:memory:")
+    parser.add_argument("--calls", type=int, default=5000)
+    options = parser.parse_args()
+
+    if options.url.startswith("sqlite"):
+        engine = create_engine(
+            options.url,
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+        )
+    else:
+        engine = create_engine(options.url)
+    Base.metadata.create_all(engine)
+    database = Database(engine)
+
+    run("sessionmaker per call", options.calls, database.setlog_old)
+    run("shared SessionRegistry", options.calls, database.setlog_new)
+
+    def unit_of_work(text):
+        # 10 calls per transaction
+        with session_registry(engine).unit_of_work():
+            for _ in range(10):
+                database.setlog_new(text)
+
+    run("unit of work, 10 calls each", options.calls, unit_of_work, batch=10)
+
+
+if __name__ == "__main__":
+    main()
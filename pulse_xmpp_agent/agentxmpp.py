@@ -22,8 +22,6 @@ import random
 import hashlib
 import configparser
 from lib.manageresourceplugin import resource_plugin
-import zlib
-import importlib
 import cherrypy
 from lib.reverseport import reverse_port_ssh
 from lib.agentconffile import (
@@ -34,6 +32,8 @@ from lib.agentconffile import (
     pulseTempDir,
 )
 from lib.update_remote_agent import Update_Remote_Agent
+from lib.plugin_manifest import plugin_manifest
+from lib.registration_fingerprint import registration_fingerprint
 from lib.xmppiq import dispach_iq_command
 from lib.networkinfo import (
     networkagentinfo,
@@ -50,10 +50,13 @@ from lib.configuration import (
 )
 from lib.managesession import session
 from lib.managefifo import fifodeploy
+from lib.deploydispatcher import DeployDispatcher
 from lib.managedeployscheduler import ManageDbScheduler
 from lib.managedbkiosk import manageskioskdb
 
-from lib.iq_custom import iq_custom_xep, iq_value, Myiq
+from lib.iq_custom import iq_custom_xep, iq_value, Myiq, peer_encodings
+from lib.iq_payload import set_iq_payload, get_iq_payload, peer_accept
+from lib.bigdata_transfer import BigDataTransfers
 from lib.utils import (
     DEBUGPULSE,
     getIpXmppInterface,
@@ -97,11 +100,13 @@ from lib.utils import (
     call_plugin_sequentially,
     convert,
     DateTimebytesEncoderjson,
+    link_or_copy,
 )
 from lib.manage_xmppbrowsing import xmppbrowsing
 from lib.manage_event import manage_event
 from lib.manage_process import mannageprocess, process_on_end_send_message_xmpp
 from lib.syncthingapirest import syncthing, syncthingprogram, iddevice, conf_ars_deploy
+from lib.syncthingwatch import SyncthingDeployWatcher, folder_complete
 from lib.manage_scheduler import manage_scheduler
 from lib.logcolor import add_coloring_to_emit_ansi, add_coloring_to_emit_windows
 from lib.manageRSAsigned import MsgsignedRSA, installpublickey
@@ -153,12 +158,26 @@ from lib.server_kiosk import (
     manage_kiosk_message,
 )
 
-
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "lib"))
 
 # Créer un verrou partagé
 terminate_lock = multiprocessing.Lock()
 
+# doTask cree un MUCBot par connexion : le watcher syncthing et les
+# deploiements syncthing passent par le MUCBot en cours, sous un meme verrou
+syncthing_deploy_lock = threading.Lock()
+syncthing_deploy_bot = {"xmpp": None}
+
+
+def syncthing_deploy_folder(folder):
+    """
+    Callback du watcher syncthing : lance les deploiements du partage folder
+    sur le MUCBot en cours.
+    """
+    xmpp = syncthing_deploy_bot["xmpp"]
+    if xmpp is not None:
+        xmpp.syncthing_deploy(folder)
+
 
 # reecriture du fichier cluster
 
@@ -327,6 +346,9 @@ class MUCBot(ClientXMPP):
         # create mutex
         self.mutex = threading.Lock()
         self.mutexslotquickactioncount = threading.Lock()
+        self.mutexsyncthingdeploy = syncthing_deploy_lock
+        self.syncthingwatcher = None
+        self.syncthing_ars_cache = {}
         self.eventkilltcp = eventkilltcp
         self.eventkillpipe = eventkillpipe
         self.queue_recv_tcp_to_xmpp = queue_recv_tcp_to_xmpp
@@ -522,10 +544,14 @@ class MUCBot(ClientXMPP):
 
         # initialise charge relay server
         if self.config.agenttype in ["relayserver"]:
-            self.managefifo = fifodeploy()
+            self.managefifo = fifodeploy(self.config.fifodeploy_persistence)
             self.levelcharge = {}
             self.levelcharge["machinelist"] = []
             self.levelcharge["charge"] = 0
+            # les deploiements en file partent des qu'un creneau se libere
+            self.deploydispatcher = DeployDispatcher(
+                self, package_limit=self.config.deploy_package_limit
+            )
             # supprime les reverses ssh inutile
             self.manage_persistence_reverse_ssh = reverse_port_ssh()
         self.jidclusterlistrelayservers = {}
@@ -741,7 +767,7 @@ class MUCBot(ClientXMPP):
 
         self.md5reseau = refreshfingerprint()
         if self.config.sched_scheduled_plugins:
-            self.schedule("schedulerfunction", 10, self.schedulerfunction, repeat=True)
+            self.manage_scheduler.start()
         if self.config.sched_update_plugin:
             self.schedule(
                 "update plugin",
@@ -909,41 +935,16 @@ class MUCBot(ClientXMPP):
         Args:
             jid_receiver (str): Le JID du destinataire.
             data_utf8_json (str): Les données JSON à envoyer, en format UTF-8.
-            segment_size (int, optional): La taille maximale de chaque segment (par défaut: 65535).
+            segment_size (int, optional): La taille maximale de chaque segment (par défaut: 65535),
+                arrondie au multiple de 4 inférieur.
 
         Returns:
             None
         """
         # Vérification si le message est assez gros pour nécessiter un découpage en segments
         if len(data_utf8_json) > segment_size:
-            # Génération d'un identifiant de session
-            sessionid = getRandomName(6, "big_data")
-            # Compression et encodage en base64
-            data_compressed = zlib.compress(data_utf8_json.encode("utf-8"))
-            data_base64 = base64.b64encode(data_compressed).decode("utf-8")
-
-            # Calcul du nombre total de segments nécessaires
-            nb_segments_total = (len(data_base64) + segment_size - 1) // segment_size
-
-            # Envoi des segments
-            for i in range(nb_segments_total):
-                # Découpage des données en segments de taille segment_size
-                segment = data_base64[i * segment_size : (i + 1) * segment_size]
-                # Construction du message
-                message = {
-                    "action": "big_data",  # Action spécifiée pour le plugin à appeler
-                    "sessionid": sessionid,  # Identifiant de session
-                    "data": {
-                        "segment": segment,  # Données de ce segment
-                        "nb_segment": i + 1,  # Numéro du segment actuel
-                        "nb_segment_total": nb_segments_total,  # Nombre total de segments
-                        "from": self.boundjid.full,
-                    },  # JID de l'expéditeur
-                }
-                # Envoi du message à jid_receiver
-                self.send_message(
-                    mto=jid_receiver, mbody=json.dumps(message), mtype="chat"
-                )
+            # Envoi fenêtré avec acquittements (voir lib/bigdata_transfer.py)
+            BigDataTransfers.of(self).send(jid_receiver, data_utf8_json, segment_size)
         else:
             # Envoi direct du message sans découpage
             self.send_message(mto=jid_receiver, mbody=data_utf8_json, mtype="chat")
@@ -1113,7 +1114,9 @@ class MUCBot(ClientXMPP):
            It calls the appropriate processing function (dispach_iq_command) after formatting the request to obtain the result.
            Note: dispach_iq_command only handles a predefined set of permitted commands.
 
-           The result is then encoded in base64 and returned.
+           The result is returned in the format of the request: compressed payload
+           element if the requester advertised the encodings it accepts, legacy
+           base64 data element otherwise (see lib/iq_payload.py).
 
            If an error occurs during data retrieval or processing, an "error" response is sent with the appropriate error message.
 
@@ -1125,19 +1128,13 @@ class MUCBot(ClientXMPP):
            None
         """
 
-        def reply_result(iq, result_str_base64):
-            # warning encodage et decodage base64 se fait sur du bytes.
-            # ici convertit en str pour etre inclut au message.
+        def reply_result(iq, result, encoding):
             logger.debug("reply iq")
             iq["type"] = "result"
             iq["to"] = iq["from"]
             iq["from"] = self.boundjid.bare
-            for childresult in iq.xml:
-                if childresult.tag.endswith("query"):
-                    for z in childresult:
-                        # composition message
-                        z.tag = "{%s}data" % result
-                iq.send()
+            set_iq_payload(iq, result, encoding)
+            iq.send()
 
         def reply_error(iq, str_message_erreur):
             # warning encodage et decodage base64 se fait sur du bytes.
@@ -1156,39 +1153,32 @@ class MUCBot(ClientXMPP):
                 iq.send()
 
         logger.debug("processing of iq get custom xep")
-        for child in iq.xml:
-            if child.tag.endswith("query"):
-                # select data element query
-                for z in child:
-                    # recuperation (bytes data) encode en base64
-                    data = z.tag[1:-5]
-                    try:
-                        data = base64.b64decode(data)
-                    except Exception as e:
-                        logger.error("_custom_xep_get : decoding error : %s" % str(e))
-                        logger.error("\n%s" % (traceback.format_exc()))
-                        logger.error("xml recv : %s " % str(e))
-                        return
-                    try:
-                        # traitement de la function
-                        # result json str
-                        logger.debug("iq get treatment [session %s]" % iq["id"])
-                        result = dispach_iq_command(self, data)
-                        try:
-                            result = convert.encode_to_string_base64(result)
-                            reply_result(iq, result)
-                        except Exception as e:
-                            logger.error(
-                                "_custom_xep_get : encode base64 : %s" % str(e)
-                            )
-                            logger.error("\n%s" % (traceback.format_exc()))
-                            reply_error(iq, str(e))
-                            return ""
-                    except Exception as e:
-                        logger.error("_custom_xep_get : error command : %s" % str(e))
-                        logger.error("\n%s" % (traceback.format_exc()))
-                        self.reply_error(iq, str(e))
-                        return
+        try:
+            data, _ = get_iq_payload(iq)
+        except Exception as e:
+            logger.error("_custom_xep_get : decoding error : %s" % str(e))
+            logger.error("\n%s" % (traceback.format_exc()))
+            return
+        if data is None:
+            return
+        encoding = peer_accept(iq)
+        try:
+            # traitement de la function
+            # result json str
+            logger.debug("iq get treatment [session %s]" % iq["id"])
+            result = dispach_iq_command(self, data)
+            try:
+                reply_result(iq, result, encoding)
+            except Exception as e:
+                logger.error("_custom_xep_get : encode payload : %s" % str(e))
+                logger.error("\n%s" % (traceback.format_exc()))
+                reply_error(iq, str(e))
+                return ""
+        except Exception as e:
+            logger.error("_custom_xep_get : error command : %s" % str(e))
+            logger.error("\n%s" % (traceback.format_exc()))
+            reply_error(iq, str(e))
+            return
 
     def restartBot(self, wait=10):
         """
@@ -1202,6 +1192,21 @@ class MUCBot(ClientXMPP):
         # self.demandeRestartBot_bool = True
         self.disconnect(wait=wait)
 
+    def release(self):
+        """
+        Stop the threads working for this bot.
+        doTask creates a new MUCBot at each reconnection: the threads of the
+        previous one must not keep on running against it.
+        """
+        self.manage_scheduler.stop()
+        if syncthing_deploy_bot["xmpp"] is self:
+            syncthing_deploy_bot["xmpp"] = None
+        if self.syncthingwatcher is not None:
+            self.syncthingwatcher.stop()
+        pool = getattr(self, "plugin_pool", None)
+        if pool is not None:
+            pool.shutdown(wait=False)
+
     def handle_disconnected(self, data):
         logger.debug(f"handle_disconnected {self.server_address}")
         with terminate_lock:
@@ -1889,194 +1894,246 @@ class MUCBot(ClientXMPP):
             return
         self.clean_old_partage_syncting()
         self.clean_old_descriptor_syncting(self.dirsyncthing)
-        listfilearssyncthing = [
-            os.path.join(self.dirsyncthing, x)
-            for x in os.listdir(self.dirsyncthing)
-            if x.endswith("ars")
-        ]
+        self.syncthing_deploy(progress=True)
 
-        # get the root for the sync folders
-        syncthingroot = self.getsyncthingroot()
+    def syncthing_folder_ready(self, folder, namesearch):
+        """
+        Indique si le partage folder est entierement recu.
+        Sans reponse de syncthing, le partage est pret des que son
+        repertoire existe.
+        """
+        if not os.path.isdir(namesearch):
+            return False
+        try:
+            status = self.syncthing.get_db_status(folder)
+        except Exception:
+            return True
+        return folder_complete(status)
 
-        for filears in listfilearssyncthing:
+    def syncthing_ars(self, folder=None):
+        """
+        Retourne les (fichier .ars, contenu) des deploiements syncthing en
+        attente, ceux du partage folder si folder est donne.
+        Un fichier .ars n'est relu que s'il a change.
+        """
+        result = []
+        cache = {}
+        for name in os.listdir(self.dirsyncthing):
+            if not name.endswith("ars"):
+                continue
+            filears = os.path.join(self.dirsyncthing, name)
             try:
-                syncthingtojson = managepackage.loadjsonfile(filears)
-            except Exception:
-                syncthingtojson = None
+                mtime = os.stat(filears).st_mtime_ns
+            except OSError:
+                continue
+            if (
+                filears in self.syncthing_ars_cache
+                and self.syncthing_ars_cache[filears][0] == mtime
+            ):
+                syncthingtojson = self.syncthing_ars_cache[filears][1]
+            else:
+                try:
+                    syncthingtojson = managepackage.loadjsonfile(filears)
+                except Exception:
+                    # todo supprimer le fichier ars et descriptor.
+                    # signaler l'erreur de decodage du fichier json.
+                    logger.error("\n%s" % (traceback.format_exc()))
+                    continue
+            if syncthingtojson is None:
+                continue
+            cache[filears] = (mtime, syncthingtojson)
+            if (
+                folder is None
+                or syncthingtojson["objpartage"]["repertoiredeploy"] == folder
+            ):
+                result.append((filears, syncthingtojson))
+        self.syncthing_ars_cache = cache
+        return result
+
+    def syncthing_deploy(self, folder=None, progress=False):
+        """
+        Lance les deploiements syncthing dont le partage est recu.
 
-            if syncthingtojson is not None:
-                namesearch = os.path.join(
-                    syncthingroot, syncthingtojson["objpartage"]["repertoiredeploy"]
+        Appele par le watcher des evenements syncthing pour un partage
+        (folder), a la creation d'un fichier .ars, et periodiquement par
+        scan_syncthing_deploy pour tous les partages. progress envoie
+        l'avancement des transferts en cours a l'ARS.
+        """
+        if not self.config.syncthing_on:
+            return
+        # get the root for the sync folders
+        syncthingroot = self.getsyncthingroot()
+        with self.mutexsyncthingdeploy:
+            for filears, syncthingtojson in self.syncthing_ars(folder):
+                self.syncthing_deploy_ars(
+                    filears, syncthingtojson, syncthingroot, progress
                 )
-                # verify le contenue de namesearch
-                if os.path.isdir(namesearch):
-                    logging.debug("deploy transfert syncthing : %s" % namesearch)
-                    # Get the deploy json
-                    filedeploy = os.path.join("%s.descriptor" % filears[:-4])
-                    deploytojson = managepackage.loadjsonfile(filedeploy)
-                    # Now we have :
-                    #   - the .ars file root in filears
-                    #   - it's json in syncthingtojson
-                    #   - the .descriptor file root in filedeploy
-                    #   - it's json in deploytojson
-                    #
-                    # We need to copy the content of namesearch into the tmp
-                    # package dirl
-                    packagedir = managepackage.packagedir()
-                    logging.warning(packagedir)
-                    for dirname in os.listdir(namesearch):
-                        if dirname != ".stfolder":
-                            # clean the dest package to be sure
-                            try:
-                                shutil.rmtree(os.path.join(packagedir, dirname))
-                                logging.debug(
-                                    "clean package before copy %s"
-                                    % (os.path.join(packagedir, dirname))
-                                )
-                            except OSError:
-                                pass
-                            try:
-                                self.xmpplog(
-                                    "Transfer complete on machine %s\n "
-                                    "Start Deployement" % self.boundjid.bare,
-                                    type="deploy",
-                                    sessionname=syncthingtojson["sessionid"],
-                                    priority=-1,
-                                    action="xmpplog",
-                                    who="",
-                                    how="",
-                                    why=self.boundjid.bare,
-                                    module="Deployment | Syncthing",
-                                    date=None,
-                                    fromuser="",
-                                    touser="",
-                                )
-                                shutil.copytree(
-                                    os.path.join(namesearch, dirname),
-                                    os.path.join(packagedir, dirname),
-                                )
 
-                                logging.debug(
-                                    "copy %s to %s"
-                                    % (
-                                        os.path.join(namesearch, dirname),
-                                        os.path.join(packagedir, dirname),
-                                    )
-                                )
-                                try:
-                                    logging.debug("Delete %s" % filears)
-                                    os.remove(filears)
-                                except Exception:
-                                    logging.warning("%s no exist" % filears)
-                                try:
-                                    logging.debug("delete %s" % filedeploy)
-                                    os.remove(filedeploy)
-                                except Exception:
-                                    logging.warning("%s does no exist" % filedeploy)
-
-                                dataerreur = {
-                                    "action": "resultapplicationdeploymentjson",
-                                    "sessionid": syncthingtojson["sessionid"],
-                                    "ret": 255,
-                                    "base64": False,
-                                    "data": {"msg": "error deployement"},
-                                }
-
-                                transfertdeploy = {
-                                    "action": "applicationdeploymentjson",
-                                    "sessionid": syncthingtojson["sessionid"],
-                                    "data": deploytojson,
-                                    "ret": 0,
-                                    "base64": False,
-                                }
-                                msg = {
-                                    "from": syncthingtojson["objpartage"]["cluster"][
-                                        "elected"
-                                    ],
-                                    "to": self.boundjid.bare,
-                                    "type": "chat",
-                                }
-                                logging.debug("call  applicationdeploymentjson")
-                                logging.debug(
-                                    "%s " % json.dumps(transfertdeploy, indent=4)
-                                )
-                                call_plugin(
-                                    transfertdeploy["action"],
-                                    self,
-                                    transfertdeploy["action"],
-                                    transfertdeploy["sessionid"],
-                                    transfertdeploy["data"],
-                                    msg,
-                                    dataerreur,
-                                )
-                                logging.warning("SEND MASTER")
-                                datasend = {
-                                    "action": "deploysyncthing",
-                                    "sessionid": syncthingtojson["sessionid"],
-                                    "data": {
-                                        "subaction": "counttransfertterminate",
-                                        "iddeploybase": syncthingtojson["objpartage"][
-                                            "syncthing_deploy_group"
-                                        ],
-                                    },
-                                    "ret": 0,
-                                    "base64": False,
-                                }
-                                strr = json.dumps(datasend)
-                                logging.warning("SEND MASTER %s : " % strr)
-                                logging.error("send to master")
-                                logging.error("%s " % strr)
-
-                                self.send_message(
-                                    mto=self.agentmaster, mbody=strr, mtype="chat"
-                                )
-                            except Exception:
-                                logging.error(
-                                    "The package's copy %s to %s failed"
-                                    % (dirname, packagedir)
-                                )
-                                logger.error("\n%s" % (traceback.format_exc()))
-                else:
-                    # we look if we have informations about the transfert
-                    # print
-                    # self.syncthing.get_db_status(syncthingtojson['id_deploy'])
-                    logging.debug(
-                        "Recherche la completion de transfert %s" % namesearch
-                    )
-                    result = self.syncthing.get_db_completion(
-                        syncthingtojson["objpartage"]["repertoiredeploy"],
-                        self.syncthing.device_id,
-                    )
-                    if (
-                        "syncthing_deploy_group" in syncthingtojson["objpartage"]
-                        and len(self.syncthing.device_id) > 40
-                    ):
-                        if "completion" in result and result["completion"] != 0:
-                            datasend = {
-                                "action": "deploysyncthing",
-                                "sessionid": syncthingtojson["sessionid"],
-                                "data": {
-                                    "subaction": "completion",
-                                    "iddeploybase": syncthingtojson["objpartage"][
-                                        "syncthing_deploy_group"
-                                    ],
-                                    "completion": result["completion"],
-                                    "jidfull": self.boundjid.full,
-                                },
-                                "ret": 0,
-                                "base64": False,
-                            }
-                            strr = json.dumps(datasend)
-                            self.send_message(
-                                mto=syncthingtojson["objpartage"]["agentdeploy"],
-                                mbody=strr,
-                                mtype="chat",
+    def syncthing_deploy_ars(self, filears, syncthingtojson, syncthingroot, progress):
+        namesearch = os.path.join(
+            syncthingroot, syncthingtojson["objpartage"]["repertoiredeploy"]
+        )
+        # verify le contenue de namesearch
+        if self.syncthing_folder_ready(
+            syncthingtojson["objpartage"]["repertoiredeploy"], namesearch
+        ):
+            logging.debug("deploy transfert syncthing : %s" % namesearch)
+            # Get the deploy json
+            filedeploy = os.path.join("%s.descriptor" % filears[:-4])
+            deploytojson = managepackage.loadjsonfile(filedeploy)
+            # Now we have :
+            #   - the .ars file root in filears
+            #   - it's json in syncthingtojson
+            #   - the .descriptor file root in filedeploy
+            #   - it's json in deploytojson
+            #
+            # We need to copy the content of namesearch into the tmp
+            # package dirl
+            packagedir = managepackage.packagedir()
+            logging.warning(packagedir)
+            for dirname in os.listdir(namesearch):
+                if dirname != ".stfolder":
+                    # clean the dest package to be sure
+                    try:
+                        shutil.rmtree(os.path.join(packagedir, dirname))
+                        logging.debug(
+                            "clean package before copy %s"
+                            % (os.path.join(packagedir, dirname))
+                        )
+                    except OSError:
+                        pass
+                    try:
+                        self.xmpplog(
+                            "Transfer complete on machine %s\n "
+                            "Start Deployement" % self.boundjid.bare,
+                            type="deploy",
+                            sessionname=syncthingtojson["sessionid"],
+                            priority=-1,
+                            action="xmpplog",
+                            who="",
+                            how="",
+                            why=self.boundjid.bare,
+                            module="Deployment | Syncthing",
+                            date=None,
+                            fromuser="",
+                            touser="",
+                        )
+                        # hardlinks : le partage n'est pas recopie
+                        shutil.copytree(
+                            os.path.join(namesearch, dirname),
+                            os.path.join(packagedir, dirname),
+                            copy_function=link_or_copy,
+                        )
+
+                        logging.debug(
+                            "link %s to %s"
+                            % (
+                                os.path.join(namesearch, dirname),
+                                os.path.join(packagedir, dirname),
                             )
-            else:
-                # todo supprimer le fichier ars et descriptor.
-                # signaler l'erreur de decodage du fichier json.
-                logger.error("\n%s" % (traceback.format_exc()))
-                pass
+                        )
+                        try:
+                            logging.debug("Delete %s" % filears)
+                            os.remove(filears)
+                        except Exception:
+                            logging.warning("%s no exist" % filears)
+                        try:
+                            logging.debug("delete %s" % filedeploy)
+                            os.remove(filedeploy)
+                        except Exception:
+                            logging.warning("%s does no exist" % filedeploy)
+
+                        dataerreur = {
+                            "action": "resultapplicationdeploymentjson",
+                            "sessionid": syncthingtojson["sessionid"],
+                            "ret": 255,
+                            "base64": False,
+                            "data": {"msg": "error deployement"},
+                        }
+
+                        transfertdeploy = {
+                            "action": "applicationdeploymentjson",
+                            "sessionid": syncthingtojson["sessionid"],
+                            "data": deploytojson,
+                            "ret": 0,
+                            "base64": False,
+                        }
+                        msg = {
+                            "from": syncthingtojson["objpartage"]["cluster"]["elected"],
+                            "to": self.boundjid.bare,
+                            "type": "chat",
+                        }
+                        logging.debug("call  applicationdeploymentjson")
+                        logging.debug("%s " % json.dumps(transfertdeploy, indent=4))
+                        call_plugin(
+                            transfertdeploy["action"],
+                            self,
+                            transfertdeploy["action"],
+                            transfertdeploy["sessionid"],
+                            transfertdeploy["data"],
+                            msg,
+                            dataerreur,
+                        )
+                        logging.warning("SEND MASTER")
+                        datasend = {
+                            "action": "deploysyncthing",
+                            "sessionid": syncthingtojson["sessionid"],
+                            "data": {
+                                "subaction": "counttransfertterminate",
+                                "iddeploybase": syncthingtojson["objpartage"][
+                                    "syncthing_deploy_group"
+                                ],
+                            },
+                            "ret": 0,
+                            "base64": False,
+                        }
+                        strr = json.dumps(datasend)
+                        logging.warning("SEND MASTER %s : " % strr)
+                        logging.error("send to master")
+                        logging.error("%s " % strr)
+
+                        self.send_message(
+                            mto=self.agentmaster, mbody=strr, mtype="chat"
+                        )
+                    except Exception:
+                        logging.error(
+                            "The package's copy %s to %s failed" % (dirname, packagedir)
+                        )
+                        logger.error("\n%s" % (traceback.format_exc()))
+        elif progress:
+            # we look if we have informations about the transfert
+            # print
+            # self.syncthing.get_db_status(syncthingtojson['id_deploy'])
+            logging.debug("Recherche la completion de transfert %s" % namesearch)
+            result = self.syncthing.get_db_completion(
+                syncthingtojson["objpartage"]["repertoiredeploy"],
+                self.syncthing.device_id,
+            )
+            if (
+                "syncthing_deploy_group" in syncthingtojson["objpartage"]
+                and len(self.syncthing.device_id) > 40
+            ):
+                if "completion" in result and result["completion"] != 0:
+                    datasend = {
+                        "action": "deploysyncthing",
+                        "sessionid": syncthingtojson["sessionid"],
+                        "data": {
+                            "subaction": "completion",
+                            "iddeploybase": syncthingtojson["objpartage"][
+                                "syncthing_deploy_group"
+                            ],
+                            "completion": result["completion"],
+                            "jidfull": self.boundjid.full,
+                        },
+                        "ret": 0,
+                        "base64": False,
+                    }
+                    strr = json.dumps(datasend)
+                    self.send_message(
+                        mto=syncthingtojson["objpartage"]["agentdeploy"],
+                        mbody=strr,
+                        mtype="chat",
+                    )
 
     # end syncthing function
 
@@ -2350,38 +2407,20 @@ class MUCBot(ClientXMPP):
                 " concurent deploy max %s"
                 % (
                     self.managefifo.getcount(),
-                    self.levelcharge["charge"],
+                    self.deploydispatcher.charge(),
                     self.config.concurrentdeployments,
                 )
             )
-
-            if self.levelcharge["charge"] < self.config.concurrentdeployments:
-                nbresource = (
-                    self.config.concurrentdeployments - self.levelcharge["charge"]
-                )
-                logger.debug("Possible Slot deploy %s" % nbresource)
-                for Slot in range(nbresource):
-                    if self.managefifo.getcount() != 0:
-                        data = self.managefifo.getfifo()
-                        datasend = {
-                            "action": data["action"],
-                            "sessionid": data["sessionid"],
-                            "ret": 0,
-                            "base64": False,
-                        }
-                        del data["action"]
-                        del data["sessionid"]
-                        datasend["data"] = data
-                        self.send_message(
-                            mto=self.boundjid.bare,
-                            mbody=json.dumps(datasend),
-                            mtype="chat",
-                        )
+            # the dispatcher is notified when a slot is released, this call
+            # only catches up the notifications lost
+            self.deploydispatcher.dispatch()
 
     def checklevelcharge(self, ressource=0):
         self.levelcharge["charge"] = self.levelcharge["charge"] + ressource
         if self.levelcharge["charge"] < 0:
             self.levelcharge["charge"] = 0
+        if ressource < 0:
+            self.deploydispatcher.notify()
         return self.levelcharge["charge"]
 
     def getlevelmachinelist(self, jidmachine=""):
@@ -2390,12 +2429,14 @@ class MUCBot(ClientXMPP):
     def addmachineinlevelmachinelist(self, jidmachine):
         self.levelcharge["machinelist"].append(jidmachine)
         self.levelcharge["charge"] = len(self.levelcharge["machinelist"])
+        self.deploydispatcher.taken(jidmachine)
 
     def delmachineinlevelmachinelist(self, jidmachine):
         for index, elt in enumerate(self.levelcharge["machinelist"][:]):
             if elt == jidmachine:
                 del self.levelcharge["machinelist"][index]
         self.levelcharge["charge"] = len(self.levelcharge["machinelist"])
+        self.deploydispatcher.released(jidmachine)
 
     def signal_handler(self, signal, frame):
         logger.debug("CTRL-C EVENT")
@@ -2547,9 +2588,6 @@ class MUCBot(ClientXMPP):
                 except Exception as e:
                     logger.warning(str(e))
 
-    def schedulerfunction(self):
-        self.manage_scheduler.process_on_event()
-
     def presence_subscribe(self, presence):
         if presence["from"].bare != self.boundjid.bare:
             logger.info(
@@ -2579,6 +2617,8 @@ class MUCBot(ClientXMPP):
             )
 
     def presence_available(self, presence):
+        # le pair a pu changer de version : son encodage des IQ est oublie
+        peer_encodings.forget(presence["from"])
         if presence["from"].bare != self.boundjid.bare:
             logger.info(
                 "********** presence_available %s %s"
@@ -2837,7 +2877,7 @@ class MUCBot(ClientXMPP):
                 if self.config.sched_check_syncthing_deployment:
                     self.schedule(
                         "scan_syncthing_deploy",
-                        55,
+                        self.config.syncthing_deploy_scan_interval,
                         self.scan_syncthing_deploy,
                         repeat=True,
                     )
@@ -2869,6 +2909,19 @@ class MUCBot(ClientXMPP):
                                 "We failed to remove the file %s" % self.tmpfile
                             )
                             pass
+                if (
+                    self.config.agenttype not in ["relayserver"]
+                    and self.config.syncthing_deploy_events
+                ):
+                    # les partages recus sont detectes par les evenements
+                    # syncthing, scan_syncthing_deploy reste en secours
+                    if self.syncthingwatcher is not None:
+                        self.syncthingwatcher.stop()
+                    self.syncthingwatcher = SyncthingDeployWatcher(
+                        self.syncthing, syncthing_deploy_folder
+                    )
+                    syncthing_deploy_bot["xmpp"] = self
+                    self.syncthingwatcher.start()
 
             except KeyError as keyerror:
                 logging.error(
@@ -3919,21 +3972,13 @@ AGENT %s ERROR TERMINATE""" % (
             ).decode("utf-8")
 
         dataobj["lastusersession"] = lastusersession
-        sys.path.append(self.config.pathplugins)
-        for element in os.listdir(self.config.pathplugins):
-            if element.endswith(".py") and element.startswith("plugin_"):
-                try:
-                    mod = __import__(element[:-3])
-                    importlib.reload(mod)
-                    module = getattr(mod, "plugin")
-                    dataobj["plugin"][module["NAME"]] = module["VERSION"]
-                except Exception as e:
-                    logger.error(
-                        "error loading plugin %s : %s verify plugin %s and import"
-                        % (element, str(e), element)
-                    )
+        # versions read from the plugin manifest, without importing the plugins
+        dataobj["plugin"] = plugin_manifest.versions(self.config.pathplugins, "plugin_")
         # add list scheduler plugins
         dataobj["pluginscheduled"] = self.loadPluginschedulerList()
+        plugin_manifest.save()
+        # hash of each section, the substitute only rewrites the changed ones
+        dataobj["registration_fingerprint"] = registration_fingerprint(dataobj)
         # persistence info machine
         self.infomain = dataobj
         self.dataplugininstall = {
@@ -3944,19 +3989,7 @@ AGENT %s ERROR TERMINATE""" % (
 
     def loadPluginschedulerList(self):
         logger.debug("Verify base plugin scheduler")
-        plugindatasearch = {}
-        for element in os.listdir(self.config.pathpluginsscheduled):
-            if element.endswith(".py") and element.startswith("scheduling_"):
-                f = open(os.path.join(self.config.pathpluginsscheduled, element), "r")
-                lignes = f.readlines()
-                f.close()
-                for ligne in lignes:
-                    if "VERSION" in ligne and "NAME" in ligne:
-                        l = ligne.split("=")
-                        plugin = eval(l[1])
-                        plugindatasearch[plugin["NAME"]] = plugin["VERSION"]
-                        break
-        return plugindatasearch
+        return plugin_manifest.versions(self.config.pathpluginsscheduled, "scheduling_")
 
     def module_needed(self):
         finder = ModuleFinder()
@@ -4698,7 +4731,7 @@ class process_xmpp_agent:
                 self.logger.error("RuntimeError during connection")
             finally:
                 # loop.close()
-                pass
+                xmpp.release()
 
             with terminate_lock:
                 if shared_dict.get("terminate"):
@@ -4781,7 +4814,7 @@ if __name__ == "__main__":
     # Création d'un lock pour synchroniser l'accès à la valeur partagée
     lockrestart = multiprocessing.Lock()
     # Création d'une valeur partagée (initialisée à 0)
-    PROCESS_RESTART = Value('i', 1)  # 'i' pour entier (int)
+    PROCESS_RESTART = Value("i", 1)  # 'i' pour entier (int)
 
     if sys.platform.startswith("linux") and os.getuid() != 0:
         print("Agent must be running as root")
@@ -39,7 +39,7 @@ from pulse_xmpp_agent.lib.utils import (
 from pulse_xmpp_agent.lib.agentconffile import directoryconffile
 import mysql.connector
 
-plugin = {"VERSION": "1.42", "NAME": "scheduling_mon_pulsesystem", "TYPE": "relayserver", "SCHEDULED": True}  # fmt: skip
+plugin = {"VERSION": "1.43", "NAME": "scheduling_mon_pulsesystem", "TYPE": "relayserver", "SCHEDULED": True}  # fmt: skip
 
 SCHEDULE = {"schedule": "*/15 * * * *", "nb": -1}
 
@@ -625,16 +625,10 @@ def schedule_main(xmppobject):
                 else:
                     slots_configured = 10
                 pulse_relay_json["deployments"]["slots_configured"] = slots_configured
-                fifodeploy_path = os.path.join(
-                    os.path.dirname(os.path.realpath(__file__)), "..", "fifodeploy"
-                )
-                deployments_queued = len(
-                    [
-                        name
-                        for name in os.listdir(fifodeploy_path)
-                        if os.path.isfile(os.path.join(fifodeploy_path, name))
-                    ]
-                )
+                # la file des deploiements est gardee en memoire par le relais
+                deployments_queued = 0
+                if hasattr(xmppobject, "managefifo"):
+                    deployments_queued = xmppobject.managefifo.getcount()
                 pulse_relay_json["deployments"][
                     "deployments_queued"
                 ] = deployments_queued
@@ -13,20 +13,15 @@ import json
 import hashlib
 from optparse import OptionParser
 import traceback
-import time
+import urllib.parse
 import urllib.request
 import signal
-from threading import Thread
-import imp
+import asyncio
+import ssl
+import uuid
+from collections import deque
 
 logger = logging.getLogger()
-if sys.version_info < (3, 0):
-    imp.reload(sys)
-    sys.setdefaultencoding("utf8")
-else:
-    raw_input = input
-maxthread = 0
-nbthread = 0
 globaltest = """
 <?xml version="1.0" encoding="UTF-8"?>
 <REQUEST>
@@ -10123,67 +10118,209 @@ def md5(fname):
     return hash.hexdigest()
 
 
-class action(Thread):
-    """Thread chargé simplement d'afficher un mot dans la console."""
+def synthetic_inventory(number, rng):
+    """
+    Retourne l'inventaire de test globaltest de la machine number : le nom,
+    le DEVICEID et l'UUID sont propres à chaque machine.
+    """
+    uuid_machine = str(uuid.UUID(int=rng.getrandbits(128))).upper()
+    return (
+        globaltest.strip()
+        .replace("MACHINE_TEST_BENCKMARK", "MACHINE_TEST_%06d" % number)
+        .replace("F15E46B2-BB07-4496-8BDE-C033763239D3", uuid_machine)
+    )
+
+
+# nombre de mesures gardées pour les percentiles en mode démon
+SAMPLES = 10000
+
+
+def percentile(values, percent):
+    """
+    Retourne le percentile percent de values (interpolation linéaire).
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * percent / 100.0
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+class httpclient:
+    """
+    Client HTTP/1.1 asyncio : les connexions vers le serveur d'inventaire
+    sont gardées ouvertes et réutilisées d'un inventaire à l'autre.
+    """
+
+    def __init__(self, url, headers):
+        parsed = urllib.parse.urlsplit(url)
+        self.host = parsed.hostname
+        self.ssl = None
+        if parsed.scheme == "https":
+            self.ssl = ssl.create_default_context()
+        self.port = parsed.port or (443 if self.ssl else 80)
+        self.path = parsed.path or "/"
+        if parsed.query:
+            self.path = f"{self.path}?{parsed.query}"
+        self.headers = headers
+        self._idle = []
 
-    def __init__(self, content, HEADER, url):
-        Thread.__init__(self)
-        global nbthread
-        nbthread += 1
-        self.HEADER = HEADER
-        self.content = content
-        self.url = url
+    async def post(self, body):
+        """
+        Envoie body et retourne le code HTTP de la réponse.
+        """
+        if self._idle:
+            reader, writer = self._idle.pop()
+            try:
+                return await self._exchange(reader, writer, body)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # le serveur a fermé la connexion inactive
+                pass
+        reader, writer = await asyncio.open_connection(
+            self.host, self.port, ssl=self.ssl
+        )
+        return await self._exchange(reader, writer, body)
 
-    def run(self):
-        """Code à exécuter pendant l'exécution du thread."""
-        global nbthread
+    async def _exchange(self, reader, writer, body):
         try:
-            print(self.url)
-            request = urllib.request.Request(self.url, self.content, self.HEADER)
-            response = urllib.request.urlopen(request)
-        except Exception as exc:
-            logger.warning("Unable to send inventory to GLPI")
-            logger.warning(f"Response was: {str(exc)}")
-        nbthread -= 1
+            request = [f"POST {self.path} HTTP/1.1", f"Host: {self.host}"]
+            request.extend(f"{key}: {value}" for key, value in self.headers.items())
+            request.append(f"Content-Length: {len(body)}")
+            writer.write(("\r\n".join(request) + "\r\n\r\n").encode("utf-8") + body)
+            await writer.drain()
+            status, keepalive = await self._response(reader)
+        except BaseException:
+            writer.close()
+            raise
+        if keepalive:
+            self._idle.append((reader, writer))
+        else:
+            writer.close()
+        return status
+
+    async def _response(self, reader):
+        line = await reader.readline()
+        if not line:
+            raise ConnectionResetError("connection closed by the server")
+        version, status = line.decode("latin-1").split()[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+        keepalive = version == "HTTP/1.1"
+        if headers.get("connection", "").lower() == "close":
+            keepalive = False
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                await reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        elif "content-length" in headers:
+            await reader.readexactly(int(headers["content-length"]))
+        else:
+            await reader.read()
+            keepalive = False
+        return int(status), keepalive
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+            await writer.wait_closed()
+
+
+class inventorystub:
+    """
+    Serveur HTTP local qui répond comme le serveur d'inventaire GLPI, pour
+    mesurer l'injecteur sans instance GLPI.
+
+    Chaque réponse est différée de latency secondes, errors est la part
+    des requêtes auxquelles il répond par une erreur 500.
+    """
 
+    REPLY = b'<?xml version="1.0" encoding="UTF-8" ?>\n<REPLY></REPLY>\n'
 
-class actiontest(Thread):
-    """Thread chargé simplement d'afficher un mot dans la console."""
+    def __init__(self, latency=0.0, errors=0.0, seed=0):
+        self.latency = latency
+        self.errors = errors
+        self.rng = random.Random(seed)
+        self.received = 0
+        self.server = None
 
-    def __init__(self, HEADER, url, number=0):
-        Thread.__init__(self)
-        self.HEADER = HEADER
-        self.url = url
-        self.number = number
+    async def start(self, host="127.0.0.1", port=0):
+        """
+        Démarre le serveur et retourne son url.
+        """
+        self.server = await asyncio.start_server(self.handle, host, port)
+        port = self.server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}/"
 
-    def run(self):
-        """Code à exécuter pendant l'exécution du thread."""
-        global nbthread
-        global maxthread
+    async def handle(self, reader, writer):
         try:
-            g = time.time()
-            d = nbthread
-            nbthread += 1
-            d += 1
-            maxthread = max(maxthread, d)
-            request = urllib.request.Request(self.url, globaltest, self.HEADER)
-            response = urllib.request.urlopen(request)
-        except Exception as exc:
-            logger.warning("Unable to send inventory to GLPI")
-            logger.warning(f"Response was: {str(exc)}")
-        end = time.time()
-        nbthread -= 1
-        print(
-            "Thread %d nbrmax %s inventory %s start %s end %s duration %s"
-            % (d, maxthread, self.number, g, end, end - g)
-        )
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    if key.strip().lower() == "content-length":
+                        length = int(value)
+                await reader.readexactly(length)
+                self.received += 1
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                status = "200 OK"
+                if self.rng.random() < self.errors:
+                    status = "500 Internal Server Error"
+                writer.write(
+                    (
+                        f"HTTP/1.1 {status}\r\n"
+                        "Content-Type: application/xml\r\n"
+                        f"Content-Length: {len(self.REPLY)}\r\n\r\n"
+                    ).encode("latin-1")
+                    + self.REPLY
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
 
 
 class inventoryinject:
+    """
+    Générateur de charge du serveur d'inventaire.
+
+    Les inventaires arrivent au rythme conf.rate par seconde, à intervalles
+    réguliers ou selon un processus de Poisson (conf.arrival), quel que soit
+    le temps de réponse du serveur. Au plus conf.nbthreadmax inventaires
+    sont en cours d'envoi, les suivants attendent une connexion libre.
+
+    En mode test, les inventaires sont synthétiques (globaltest, un
+    DEVICEID par machine) et conf.seed rend les arrivées et les machines
+    reproductibles. Sinon, les fichiers .xml de dirinventory sont injectés
+    sans fin : un fichier n'est lu qu'une fois une connexion libre, et
+    supprimé quand son envoi est terminé. Les percentiles ne portent alors
+    que sur les SAMPLES dernières mesures.
+    """
+
     def __init__(self, conf):
         self.conf = conf
-        if conf.testmode:
-            logger.warning(f"time interval is {self.conf.nbmessagebyseconde}")
         self.dirinventory = os.path.join(
             "/",
             "usr",
@@ -10197,72 +10334,190 @@ class inventoryinject:
             "RecvInventory",
         )
         self.stop = False
-        self.listfilename = []
         self.HEADER = {
             "Pragma": "no-cache",
             "User-Agent": "Proxy:FusionInventory/Pulse2/GLPI",
             "Content-Type": "application/x-compress",
         }
         self.url = "http://localhost:9999/" if self.conf.Url is None else self.conf.Url
+        self.rng = random.Random(conf.seed)
+        samples = None if conf.testmode else SAMPLES
+        self.latencies = deque(maxlen=samples)
+        self.waits = deque(maxlen=samples)
+        self.latency_min = None
+        self.latency_max = None
+        self.latency_sum = 0
+        self.status = {}
+        # fichiers en cours d'envoi, encore presents dans dirinventory
+        self.inflight = set()
+        self.errors = 0
+        self.sent = 0
+        self.duration = 0
         signal.signal(signal.SIGINT, self.signal_handler)
 
     def signal_handler(self, signal, frame):
         self.stop = True
 
-    # lecture des fichiers namefichier inventory.
     def load_file_name(self):
-        # print "Load"
-        # self.listpriotity = [x for x in os.listdir(self.dirinventory) if x[-4:] == ".inv"]
-        self.listfilename = [
-            x for x in os.listdir(self.dirinventory) if x[-4:] == ".xml"
-        ]
-        # for element in self.listfilename:
-        # print element
-        return self.listfilename
+        return sorted(
+            x
+            for x in os.listdir(self.dirinventory)
+            if x[-4:] == ".xml" and x not in self.inflight
+        )
 
-    def injectinventory(self, filenameinjectxml="", number=0):
-        if not self.conf.testmode:
-            if filenameinjectxml == "":
-                logger.error("error name file")
-                return
-            namefileinject = os.path.join(self.dirinventory, filenameinjectxml)
-            content = file_get_contents(namefileinject)
-            os.remove(namefileinject)
-            thread_1 = action(content, self.HEADER, self.url).start()
-        else:
-            thread_1 = actiontest(self.HEADER, self.url, number).start()
+    def inventories(self):
+        """
+        Retourne les inventaires à injecter, (contenu, nom du fichier ou
+        None), ou None quand aucun fichier n'attend d'être injecté. Le
+        fichier est lu à la demande de l'inventaire suivant.
+        """
+        if self.conf.testmode:
+            for number in range(self.conf.Numbercycles):
+                yield synthetic_inventory(number, self.rng).encode("utf-8"), None
+            return
+        while not self.stop:
+            listfilename = self.load_file_name()
+            if not listfilename:
+                yield None
+            for filenameinjectxml in listfilename:
+                namefileinject = os.path.join(self.dirinventory, filenameinjectxml)
+                try:
+                    content = file_get_binarycontents(namefileinject)
+                except OSError:
+                    # fichier retire entre-temps
+                    continue
+                self.inflight.add(filenameinjectxml)
+                yield content, filenameinjectxml
 
-    def execprog(self):
-        global nbthread
-        if not self.conf.testmode:
-            self.load_file_name()
+    def interval(self):
+        if not self.conf.rate:
+            return 0
+        if self.conf.arrival == "poisson":
+            return self.rng.expovariate(self.conf.rate)
+        return 1.0 / self.conf.rate
+
+    async def send(self, client, semaphore, body, filename, start):
+        """
+        Envoie body sur la connexion réservée par execprog, puis supprime le
+        fichier filename de l'inventaire.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            try:
+                status = await asyncio.wait_for(client.post(body), self.conf.timeout)
+                self.status[status] = self.status.get(status, 0) + 1
+                if status != 200:
+                    self.errors += 1
+            except Exception as exc:
+                name = type(exc).__name__
+                self.status[name] = self.status.get(name, 0) + 1
+                self.errors += 1
+                logger.warning(f"Unable to send inventory to GLPI : {name} {exc}")
+            latency = loop.time() - start
+            self.latencies.append(latency)
+            self.latency_sum += latency
+            if self.latency_min is None or latency < self.latency_min:
+                self.latency_min = latency
+            if self.latency_max is None or latency > self.latency_max:
+                self.latency_max = latency
+            self.sent += 1
+        finally:
+            if filename is not None:
+                try:
+                    os.remove(os.path.join(self.dirinventory, filename))
+                except OSError:
+                    pass
+                self.inflight.discard(filename)
+            semaphore.release()
+
+    async def execprog(self):
+        loop = asyncio.get_running_loop()
+        client = httpclient(self.url, self.HEADER)
+        semaphore = asyncio.Semaphore(self.conf.nbthreadmax or 1)
+        tasks = set()
+        inventories = self.inventories()
+        start = scheduled = loop.time()
+        while not self.stop:
+            await asyncio.sleep(max(0, scheduled - loop.time()))
+            # une connexion est reservee avant de lire l'inventaire suivant :
+            # les fichiers en attente restent sur le disque
+            await semaphore.acquire()
+            item = next(inventories, False)
+            if item is False or self.stop:
+                semaphore.release()
+                break
+            if item is None:
+                # aucun inventaire en attente
+                semaphore.release()
+                await asyncio.sleep(1)
+                scheduled = loop.time()
+                continue
+            body, filename = item
+            now = loop.time()
+            self.waits.append(now - scheduled)
+            task = asyncio.ensure_future(
+                self.send(client, semaphore, body, filename, now)
+            )
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            scheduled += self.interval()
+        await asyncio.gather(*tasks)
+        self.duration = loop.time() - start
+        await client.close()
+
+    def report(self):
+        """
+        Retourne le bilan de l'injection.
+        """
+        latencies = self.latencies
+
+        def ms(value):
+            return None if value is None else round(value * 1000, 3)
+
+        return {
+            "url": self.url,
+            "testmode": self.conf.testmode,
+            "arrival": self.conf.arrival,
+            "rate": self.conf.rate,
+            "concurrency": self.conf.nbthreadmax,
+            "seed": self.conf.seed,
+            "requests": self.sent,
+            "errors": self.errors,
+            "error_rate": self.errors / self.sent if self.sent else 0,
+            "status": {str(key): value for key, value in self.status.items()},
+            "duration": round(self.duration, 3),
+            "throughput": self.sent / self.duration if self.duration else 0,
+            "latency_ms": {
+                "min": ms(self.latency_min),
+                "mean": ms(self.latency_sum / self.sent if self.sent else None),
+                "p50": ms(percentile(latencies, 50)),
+                "p90": ms(percentile(latencies, 90)),
+                "p95": ms(percentile(latencies, 95)),
+                "p99": ms(percentile(latencies, 99)),
+                "max": ms(self.latency_max),
+            },
+            "wait_ms": {
+                "p50": ms(percentile(self.waits, 50)),
+                "p99": ms(percentile(self.waits, 99)),
+            },
+        }
 
-            while not self.stop:
-                if nbthread < self.conf.nbthreadmax:
-                    # print "nb maximun permit de thread %s"%self.conf.nbthreadmax
-                    # print "nbthread en cours %s"%nbthread
-                    # print "nb fichier a traiter %s"%len(self.listfilename)
-                    if len(self.listfilename) > 0:
-                        try:
-                            filenameinject = self.listfilename.pop(0)
-                            self.injectinventory(filenameinject)
-                        except Exception as e:
-                            logger.error(str(e))
-                        if self.conf.nbmessagebyseconde is not None:
-                            time.sleep(self.conf.nbmessagebyseconde)
-                    else:
-                        self.load_file_name()
-                else:
-                    time.sleep(0.01)
-        else:
-            for i in range(self.conf.Numbercycles):
-                self.injectinventory(filenameinjectxml="", number=i)
-                if self.conf.nbmessagebyseconde is not None:
-                    time.sleep(self.conf.nbmessagebyseconde)
-                if self.stop:
-                    break
-        # 2 secondes for terminate
-        time.sleep(2)
+
+async def inject(conf):
+    stub = None
+    if conf.stub:
+        stub = inventorystub(
+            latency=conf.stub_latency, errors=conf.stub_errors, seed=conf.seed
+        )
+        conf.Url = await stub.start()
+        logger.info(f"local inventory server stub on {conf.Url}")
+    prog = inventoryinject(conf)
+    try:
+        await prog.execprog()
+    finally:
+        if stub is not None:
+            await stub.close()
+    return prog.report()
 
 
 def createDaemon(opts, conf):
@@ -10287,6 +10542,10 @@ def doTask(opts, conf):
         logging.basicConfig(
             level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s"
         )
+    elif conf.testmode:
+        logging.basicConfig(
+            level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+        )
     else:
         stdout_logger = logging.getLogger("STDOUT")
         sl = StreamToLogger(stdout_logger, logging.INFO)
@@ -10300,31 +10559,28 @@ def doTask(opts, conf):
             filename="/var/log/pulse/xmpp-agent-log.log",
             filemode="a",
         )
-    # start programme
-    if conf.testmode:
-        startprog = time.time()
-        print(f"nb injection {conf.Numbercycles}")
-        print(f"START {startprog}")
-        print("--------------------------")
-    prog = inventoryinject(conf)
-    prog.execprog()
-    if conf.testmode:
-        print("--------------------------")
-        end = time.time()
-        print(f"STOP {end}")
-        duration = end - startprog
-        print(f"Duration {duration}")
-        print(f"real nb/s {duration / conf.Numbercycles}")
-        print(f"interval is {prog.conf.nbmessagebyseconde}")
+    report = asyncio.run(inject(conf))
+    result = json.dumps(report, indent=4)
+    if conf.report == "-":
+        print(result)
+    else:
+        file_put_contents(conf.report, result)
+        logger.info(f"report written in {conf.report}")
+    logger.info(
+        "%s inventories in %.3f s, %.1f inventories/s, %s errors, "
+        "latency p50 %s ms p99 %s ms"
+        % (
+            report["requests"],
+            report["duration"],
+            report["throughput"],
+            report["errors"],
+            report["latency_ms"]["p50"],
+            report["latency_ms"]["p99"],
+        )
+    )
 
 
 if __name__ == "__main__":
-    if not sys.platform.startswith("linux"):
-        print("Agent log on systeme linux only")
-    if os.getuid() != 0:
-        print("Agent must be running as root")
-        sys.exit(0)
-
     optp = OptionParser()
     optp.add_option(
         "-d",
@@ -10360,6 +10616,15 @@ if __name__ == "__main__":
         help="time between 2 inventory",
     )
 
+    optp.add_option(
+        "-a",
+        "--arrival",
+        dest="arrival",
+        default="constant",
+        choices=["constant", "poisson"],
+        help="arrival of the inventories : constant or poisson",
+    )
+
     optp.add_option(
         "-t",
         "--testmode",
@@ -10386,58 +10651,105 @@ if __name__ == "__main__":
         "--nbthreadmax",
         dest="nbthreadmax",
         default=None,
-        help="nomber thread maximun",
+        help="number maximum of inventories sent at the same time",
+    )
+
+    optp.add_option(
+        "-U", "--url", dest="url", default=None, help="url connection inventory server"
+    )
+
+    optp.add_option(
+        "-r",
+        "--seed",
+        dest="seed",
+        type="int",
+        default=0,
+        help="seed of the arrivals and of the test machines",
     )
 
-    # optp.add_option("-P", "--port",
-    # dest="port" default=None,
-    # help="port connection xmpp")
+    optp.add_option(
+        "-o",
+        "--report",
+        dest="report",
+        default="-",
+        help="json report file (- : standard output)",
+    )
 
-    # optp.add_option("-S", "--server",
-    # dest="server" default=None,
-    # help="Server ip connection xmpp")
+    optp.add_option(
+        "-D",
+        "--timeout",
+        dest="timeout",
+        type="float",
+        default=60,
+        help="timeout of an inventory in seconds",
+    )
 
-    # optp.add_option("-J", "--jid",
-    # dest="jid" default=None,
-    # help="Jid agent connection xmpp")
+    optp.add_option(
+        "-S",
+        "--stub",
+        action="store_true",
+        dest="stub",
+        default=False,
+        help="send the inventories to a local stub of the inventory server",
+    )
 
     optp.add_option(
-        "-U", "--url", dest="url", default=None, help="url connection inventory server"
+        "--stub-latency",
+        dest="stub_latency",
+        type="float",
+        default=50,
+        help="response time of the stub in ms",
+    )
+
+    optp.add_option(
+        "--stub-errors",
+        dest="stub_errors",
+        type="float",
+        default=0,
+        help="part of the requests answered by an error by the stub (0-1)",
     )
 
     opts, args = optp.parse_args()
 
+    if not sys.platform.startswith("linux"):
+        print("Agent log on systeme linux only")
+    if not opts.testmode and os.getuid() != 0:
+        print("Agent must be running as root")
+        sys.exit(0)
+
     # Setup the command line arguments.
     conf = configuration()
     if opts.url is not None:
         conf.Url = opts.url
 
-    if opts.numberbyseconde is not None:
-        conf.Nbmessage = float(opts.numberbyseconde)
-    else:
-        conf.Nbmessage = None
-
-    conf.Intertime = float(opts.intertime) if opts.intertime is not None else None
     if opts.numbercycles is not None:
         conf.Numbercycles = int(opts.numbercycles)
     else:
         conf.Numbercycles = 100
 
-    conf.testmode = opts.testmode
+    conf.testmode = opts.testmode or opts.stub
 
     if opts.nbthreadmax is not None:
         conf.nbthreadmax = int(opts.nbthreadmax)
-    elif conf.nbthreadmax is not None:
+    elif getattr(conf, "nbthreadmax", None) is not None:
         conf.nbthreadmax = int(conf.nbthreadmax)
+    else:
+        conf.nbthreadmax = 10
 
-    conf.Testmode = bool(opts.testmode)
-
-    if conf.Intertime is not None:
-        conf.nbmessagebyseconde = float(conf.Intertime)
-    elif conf.Nbmessage is not None:
-        conf.nbmessagebyseconde = float(1 / conf.Nbmessage)
+    if opts.intertime is not None:
+        conf.rate = 1 / float(opts.intertime)
+    elif opts.numberbyseconde is not None:
+        conf.rate = float(opts.numberbyseconde)
     else:
-        conf.nbmessagebyseconde = None
+        conf.rate = None
+
+    conf.arrival = opts.arrival
+    conf.seed = opts.seed
+    conf.report = opts.report
+    conf.timeout = opts.timeout
+    conf.stub = opts.stub
+    conf.stub_latency = opts.stub_latency / 1000.0
+    conf.stub_errors = opts.stub_errors
 
     if not opts.deamon:
         doTask(opts, conf)
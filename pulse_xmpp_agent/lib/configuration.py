@@ -536,6 +536,21 @@ class confParameter:
         else:
             self.syncthing_on = True
 
+        # Detection of the received syncthing shares from the syncthing
+        # events. The periodic scan is kept as a fallback.
+        self.syncthing_deploy_events = True
+        if Config.has_option("syncthing", "deploy_events"):
+            self.syncthing_deploy_events = Config.getboolean(
+                "syncthing", "deploy_events"
+            )
+        self.syncthing_deploy_scan_interval = (
+            300 if self.syncthing_deploy_events else 55
+        )
+        if Config.has_option("syncthing", "deploy_scan_interval"):
+            self.syncthing_deploy_scan_interval = Config.getint(
+                "syncthing", "deploy_scan_interval"
+            )
+
         if self.syncthing_on:
             logger.debug("Syncthing have been activated.")
         else:
@@ -616,6 +631,25 @@ class confParameter:
                 )
                 self.concurrentdeployments = 10
 
+            # Maximum number of simultaneous deployments of a same package
+            self.deploy_package_limit = 0
+            if Config.has_option("global", "deploy_package_limit"):
+                self.deploy_package_limit = Config.getint(
+                    "global", "deploy_package_limit"
+                )
+
+            # Persistence of the deployment queue : none, journal or sqlite
+            self.fifodeploy_persistence = None
+            if Config.has_option("global", "fifodeploy_persistence"):
+                persistence = Config.get("global", "fifodeploy_persistence").strip()
+                if persistence in ["journal", "sqlite"]:
+                    self.fifodeploy_persistence = persistence
+                elif persistence not in ["", "none"]:
+                    logger.warning(
+                        "parameter [global] fifodeploy_persistence : %s unknown,"
+                        " use none, journal or sqlite" % persistence
+                    )
+
             if Config.has_option("connection", "portARSscript"):
                 self.parametersscriptconnection["port"] = Config.get(
                     "connection", "portARSscript"
@@ -714,6 +748,27 @@ class confParameter:
                         setattr(self, keyparameter, valueparameter)
                 else:
                     logger.warning("The configuration file: %s is missing" % namefile)
+
+        # Shared pool executing the plugin actions
+        # action_limits caps the concurrency per action, e.g.
+        # action_limits = applicationdeploymentjson:10, xmpplog:4
+        self.plugin_pool_max_workers = 20
+        if Config.has_option("plugin_pool", "max_workers"):
+            self.plugin_pool_max_workers = Config.getint("plugin_pool", "max_workers")
+        self.plugin_pool_max_queue = 500
+        if Config.has_option("plugin_pool", "max_queue"):
+            self.plugin_pool_max_queue = Config.getint("plugin_pool", "max_queue")
+        self.plugin_pool_queue_timeout = 30
+        if Config.has_option("plugin_pool", "queue_timeout"):
+            self.plugin_pool_queue_timeout = Config.getint(
+                "plugin_pool", "queue_timeout"
+            )
+        self.plugin_pool_action_limits = {}
+        if Config.has_option("plugin_pool", "action_limits"):
+            for limit in Config.get("plugin_pool", "action_limits").split(","):
+                if ":" in limit:
+                    actionname, nblimit = limit.split(":", 1)
+                    self.plugin_pool_action_limits[actionname.strip()] = int(nblimit)
         try:
             self.agentcommand = Config.get("global", "relayserver_agent")
         except BaseException:
@@ -0,0 +1,183 @@
+# -*- coding: utf-8; -*-
+# SPDX-FileCopyrightText: 2016-2023 Siveo <support@siveo.net>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import collections
+import logging
+import threading
+import time
+import traceback
+
+from slixmpp import jid
+
+from lib.utils import call_plugin
+
+logger = logging.getLogger()
+
+
+class DeployDispatcher:
+    """
+    Démarre les déploiements de la file managefifo d'un relais dès qu'un
+    créneau se libère.
+
+    notify() est appelé quand la charge du relais baisse
+    (delmachineinlevelmachinelist, checklevelcharge). reloaddeploy appelle
+    encore dispatch() à chaque passage pour les déploiements mis en file
+    alors qu'aucun créneau n'était en cours de libération. Les déploiements sont lancés dans le processus par
+    call_plugin, sans renvoyer de message au relais par le serveur XMPP.
+
+    Un déploiement lancé réserve un créneau jusqu'à ce que la machine prenne
+    la ressource (addmachineinlevelmachinelist), ou au plus
+    reservation_timeout secondes. package_limit borne le nombre de
+    déploiements simultanés d'un même package (0 : pas de limite).
+
+    Le verrou du dispatcher ne protège que ses propres réservations : la
+    file est alimentée par setfifo depuis les threads du pool de plugins,
+    ses accès passent uniquement par les méthodes de fifodeploy, qui
+    prennent le verrou de la file.
+    """
+
+    def __init__(self, objectxmpp, package_limit=0, reservation_timeout=30):
+        self.objectxmpp = objectxmpp
+        self.package_limit = package_limit
+        self.reservation_timeout = reservation_timeout
+        self._lock = threading.RLock()
+        self._scheduled = False
+        self._launched = {}  # sessionid -> (heure du lancement, jidmachine, package)
+        self._running = collections.defaultdict(list)  # jidmachine -> [package]
+        self._packages = collections.Counter()
+
+    def notify(self):
+        """
+        Demande un passage du dispatcher dans la boucle de l'agent.
+
+        Peut être appelé depuis n'importe quel thread, les appels rapprochés
+        ne donnent qu'un passage.
+        """
+        with self._lock:
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self.objectxmpp.loop.call_soon_threadsafe(self.dispatch)
+
+    def charge(self):
+        """
+        Retourne le nombre de créneaux occupés.
+        """
+        with self._lock:
+            return self.objectxmpp.levelcharge["charge"] + len(self._launched)
+
+    def _expire(self):
+        limit = time.time() - self.reservation_timeout
+        for sessionid, (launched, jidmachine, package) in list(self._launched.items()):
+            if launched < limit:
+                logger.warning(
+                    f"deployment {sessionid} on {jidmachine} did not take its resource : slot released"
+                )
+                del self._launched[sessionid]
+                self._packages[package] -= 1
+
+    def _accept(self, datajson):
+        if self.package_limit <= 0:
+            return True
+        package = self.objectxmpp.managefifo.package(datajson)
+        return self._packages[package] < self.package_limit
+
+    def taken(self, jidmachine):
+        """
+        La machine a pris la ressource du déploiement lancé.
+        """
+        with self._lock:
+            for sessionid, (_, machine, package) in self._launched.items():
+                if machine == jidmachine:
+                    del self._launched[sessionid]
+                    self._running[jidmachine].append(package)
+                    return
+
+    def released(self, jidmachine):
+        """
+        La machine a rendu la ressource : son créneau est libre.
+        """
+        with self._lock:
+            # un deploiement differe rend la ressource au lancement, avant de
+            # la prendre : la reservation est gardee
+            if self._running.get(jidmachine):
+                self._packages[self._running[jidmachine].pop(0)] -= 1
+                if not self._running[jidmachine]:
+                    del self._running[jidmachine]
+        self.notify()
+
+    def reset(self):
+        """
+        Oublie les déploiements en cours (redémarrage de la console).
+        """
+        with self._lock:
+            self._launched.clear()
+            self._running.clear()
+            self._packages.clear()
+        self.notify()
+
+    def dispatch(self):
+        """
+        Lance les déploiements en file tant que des créneaux sont libres.
+        """
+        with self._lock:
+            self._scheduled = False
+            self._expire()
+            fifo = self.objectxmpp.managefifo
+            # getfifo_fair retire le descripteur sous le verrou de la file :
+            # un setfifo concurrent ne peut ni le perdre ni le dupliquer
+            while (
+                fifo.getcount() != 0
+                and self.charge() < self.objectxmpp.config.concurrentdeployments
+            ):
+                data = fifo.getfifo_fair(self._accept)
+                if not data:
+                    break
+                if data["sessionid"] in self.objectxmpp.ban_deploy_sessionid_list:
+                    continue
+                package = fifo.package(data)
+                self._launched[data["sessionid"]] = (
+                    time.time(),
+                    data.get("jidmachine"),
+                    package,
+                )
+                self._packages[package] += 1
+                self._launch(data)
+            fifo.flush()
+
+    def _launch(self, data):
+        action = data.pop("action")
+        sessionid = data.pop("sessionid")
+        logger.debug(f"deployment {sessionid} leaves the fifo")
+        msg = {
+            "from": self.objectxmpp.boundjid,
+            "to": jid.JID(self.objectxmpp.boundjid.bare),
+            "type": "chat",
+            "body": {
+                "action": action,
+                "sessionid": sessionid,
+                "data": data,
+                "ret": 0,
+                "base64": False,
+            },
+        }
+        dataerreur = {
+            "action": "resultmsginfoerror",
+            "sessionid": "",
+            "ret": 255,
+            "base64": False,
+            "data": {"msg": ""},
+        }
+        try:
+            call_plugin(
+                action,
+                self.objectxmpp,
+                action,
+                sessionid,
+                data,
+                msg,
+                dataerreur,
+            )
+        except Exception:
+            logger.error("\n%s" % (traceback.format_exc()))
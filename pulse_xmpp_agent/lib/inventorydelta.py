@@ -0,0 +1,137 @@
+# -*- coding: utf-8; -*-
+# SPDX-FileCopyrightText: 2016-2023 Siveo <support@siveo.net>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+Inventaire différentiel.
+
+L'inventaire XML est découpé en sections : les éléments fils de
+/REQUEST/CONTENT regroupés par balise (HARDWARE, SOFTWARES, NETWORKS,
+STORAGES, ...). L'agent garde l'empreinte de chaque section du dernier
+inventaire envoyé et n'envoie ensuite que les sections qui ont changé.
+Le substitut complète le différentiel avec le dernier inventaire reçu et
+reconstruit le document complet.
+"""
+
+import hashlib
+import json
+from xml.parsers import expat
+
+
+class InventoryDeltaError(Exception):
+    pass
+
+
+def split_inventory(content):
+    """
+    Découpe l'inventaire XML content en sections.
+
+    Le découpage se fait sur le texte du document, sans le resérialiser :
+    join_inventory() redonne exactement content.
+
+    Retourne un dict :
+        head : le texte jusqu'au premier élément de CONTENT
+        tail : le texte à partir de </CONTENT>
+        layout : l'ordre des éléments, [[balise, nombre], ...]
+        sections : {balise: [texte de chaque élément]}
+    """
+    data = content.encode("utf-8")
+    parser = expat.ParserCreate()
+    path = []
+    starts = []
+    bounds = {}
+
+    def start_element(name, attrs):
+        path.append(name)
+        if path[:2] == ["REQUEST", "CONTENT"] and len(path) == 3:
+            if "end" in bounds:
+                raise InventoryDeltaError("more than one CONTENT element")
+            starts.append((name, parser.CurrentByteIndex))
+
+    def end_element(name):
+        if path == ["REQUEST", "CONTENT"] and "end" not in bounds:
+            bounds["end"] = parser.CurrentByteIndex
+        path.pop()
+
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    try:
+        parser.Parse(data, True)
+    except expat.ExpatError as e:
+        raise InventoryDeltaError("inventory is not valid xml : %s" % e)
+    if not starts:
+        raise InventoryDeltaError("inventory has no /REQUEST/CONTENT section")
+
+    layout = []
+    sections = {}
+    for index, (tag, offset) in enumerate(starts):
+        end = starts[index + 1][1] if index + 1 < len(starts) else bounds["end"]
+        sections.setdefault(tag, []).append(data[offset:end].decode("utf-8"))
+        if layout and layout[-1][0] == tag:
+            layout[-1][1] += 1
+        else:
+            layout.append([tag, 1])
+    return {
+        "head": data[: starts[0][1]].decode("utf-8"),
+        "tail": data[bounds["end"] :].decode("utf-8"),
+        "layout": layout,
+        "sections": sections,
+    }
+
+
+def join_inventory(inventory):
+    """
+    Reconstruit le texte de l'inventaire découpé par split_inventory().
+    """
+    result = [inventory["head"]]
+    position = {}
+    for tag, count in inventory["layout"]:
+        elements = inventory["sections"].get(tag, [])
+        index = position.get(tag, 0)
+        if index + count > len(elements):
+            raise InventoryDeltaError("section %s is incomplete" % tag)
+        result.extend(elements[index : index + count])
+        position[tag] = index + count
+    result.append(inventory["tail"])
+    return "".join(result)
+
+
+def section_hashes(inventory):
+    """
+    Retourne l'empreinte de chaque section, {balise: md5}.
+    """
+    return {
+        tag: hashlib.md5("".join(elements).encode("utf-8")).hexdigest()
+        for tag, elements in inventory["sections"].items()
+    }
+
+
+def inventory_digest(hashes):
+    """
+    Retourne l'empreinte d'un inventaire à partir de celles de ses sections.
+    """
+    return hashlib.md5(json.dumps(hashes, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def make_delta(inventory, previous):
+    """
+    Retourne le différentiel de inventory par rapport à l'inventaire dont
+    les empreintes de sections sont previous.
+
+    Le différentiel porte head, tail et layout, les empreintes de toutes les
+    sections et le contenu des seules sections qui ont changé. base
+    identifie l'inventaire auquel il s'applique.
+    """
+    hashes = section_hashes(inventory)
+    return {
+        "base": inventory_digest(previous),
+        "head": inventory["head"],
+        "tail": inventory["tail"],
+        "layout": inventory["layout"],
+        "hashes": hashes,
+        "sections": {
+            tag: elements
+            for tag, elements in inventory["sections"].items()
+            if previous.get(tag) != hashes[tag]
+        },
+    }
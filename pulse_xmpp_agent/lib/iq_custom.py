@@ -34,6 +34,8 @@ import gzip
 import ipaddress
 import inspect
 from slixmpp import ClientXMPP
+from slixmpp.xmlstream.handler import Callback
+from slixmpp.xmlstream.matcher.stanzapath import StanzaPath
 
 import threading
 import logging
@@ -42,8 +44,14 @@ import traceback
 from pprint import pprint
 import uuid
 import json
+import base64
 import yaml
 import xml.etree.ElementTree as ET
+from pulse_xmpp_agent.lib.iq_payload import (
+    set_iq_payload,
+    get_iq_payload,
+    peer_encodings,
+)
 
 import unittest
 
@@ -565,9 +573,102 @@ class iq_value:
         return json.dumps(json_data, sort_keys=False, indent=4)
 
 
-class Myiq(threading.Thread):
+class PendingIqTable:
+    """
+    Table des IQ custom_xep en attente de réponse, indexée par id.
+
+    Une seule table et un seul handler slixmpp sont créés par agent. Les
+    réponses (result ou error) sont retrouvées par leur id en O(1), et les
+    timeouts sont armés sur la boucle principale de slixmpp avec call_later.
+    L'appelant attend sur un threading.Event : aucun thread ni boucle
+    d'événements n'est créé par IQ.
+    """
+
+    _lock_create = threading.Lock()
+
+    def __init__(self, xmppobject):
+        self.xmppobject = xmppobject
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def of(cls, xmppobject):
+        """
+        Retourne la table de l'agent, créée et branchée sur slixmpp au premier appel.
+        """
+        table = getattr(xmppobject, "pending_iq_table", None)
+        if table is None:
+            with cls._lock_create:
+                table = getattr(xmppobject, "pending_iq_table", None)
+                if table is None:
+                    table = cls(xmppobject)
+                    xmppobject.loop.call_soon_threadsafe(table._register_handlers)
+                    xmppobject.pending_iq_table = table
+        return table
+
+    def _register_handlers(self):
+        for typeiq in ("result", "error"):
+            self.xmppobject.register_handler(
+                Callback(
+                    f"pending_iq_{typeiq}",
+                    StanzaPath(f"iq@type={typeiq}"),
+                    self._on_iq,
+                )
+            )
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, request):
+        """
+        Enregistre un iq_custom_xep en attente de sa réponse.
+        """
+        with self._lock:
+            self._pending[request.iq["id"]] = request
+
+    def arm(self, request):
+        """
+        Arme le timeout de la requête. Doit être appelée dans la boucle slixmpp.
+        """
+        request.timer = self.xmppobject.loop.call_later(
+            request.timeout, self._on_timeout, request.iq["id"]
+        )
+
+    def discard(self, iqid):
+        with self._lock:
+            request = self._pending.pop(iqid, None)
+        if request is not None and request.timer is not None:
+            self.xmppobject.loop.call_soon_threadsafe(request.timer.cancel)
+
+    def _on_iq(self, iq):
+        with self._lock:
+            request = self._pending.pop(iq["id"], None)
+        if request is None:
+            return
+        if request.timer is not None:
+            request.timer.cancel()
+        try:
+            request.on_response(iq)
+        finally:
+            request.done.set()
+
+    def _on_timeout(self, iqid):
+        with self._lock:
+            request = self._pending.pop(iqid, None)
+        if request is None:
+            return
+        try:
+            request.on_timeout(request.iq)
+        finally:
+            request.done.set()
+
+
+class Myiq:
     """
-    Cette classe est utilisée pour exécuter une tâche en arrière-plan.
+    Cette classe envoie un IQ custom_xep et attend sa réponse.
+
+    Elle est conservée pour compatibilité : l'attente se fait désormais dans
+    le thread appelant, via la table des IQ en attente (PendingIqTable).
 
     :param xmppobject: L'objet XMPP.
     :type xmppobject: object
@@ -584,7 +685,6 @@ class Myiq(threading.Thread):
     """
 
     def __init__(self, xmppobject, to, data, timeout=900, sessionid=None):
-        threading.Thread.__init__(self)
         self.param = {
             "xmppobject": xmppobject,
             "sessionid": sessionid,
@@ -594,9 +694,12 @@ class Myiq(threading.Thread):
         }
         self.result = None
 
-    def run(self):
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+    def iqsend(self):
+        """
+        Cette fonction envoie une requête IQ et retourne sa réponse.
+
+        :return: La réponse de l'IQ ou un dict d'erreur.
+        """
         myiq = iq_custom_xep(
             self.param["xmppobject"],
             self.param["to"],
@@ -605,19 +708,7 @@ class Myiq(threading.Thread):
             sessionid=self.param["sessionid"],
         )
         self.result = myiq.iq_send()
-
-    def iqsend(self):
-        """
-        Cette fonction envoie une requête IQ.
-
-        :return: None
-        """
-        self.start()
-        self.join(self.param["timeout"])
-        if not self.is_alive():
-            return self.result
-        self._stop()
-        raise TimeoutError("Le thread a dépassé le temps d'exécution maximal.")
+        return self.result
 
 
 class iq_custom_xep:
@@ -626,6 +717,8 @@ class iq_custom_xep:
         self.iq = None
         self.fin = False
         self.result_iq = {}
+        self.done = threading.Event()
+        self.timer = None
         try:
             self.data = None
             self.timeout = int(timeout)
@@ -670,10 +763,11 @@ class iq_custom_xep:
                     self.iq = self.xmppobject.make_iq_get(
                         queryxmlns="custom_xep", ito=self.to
                     )
-                    itemXML = ET.Element("{%s}data" % self.data)
-                    for child in self.iq.xml:
-                        if child.tag.endswith("query"):
-                            child.append(itemXML)
+                    set_iq_payload(
+                        self.iq,
+                        base64.b64decode(self.data),
+                        peer_encodings.get(self.to),
+                    )
                     self.iq["id"] = self.sessionid
                 except Exception as e:
                     logger.error(f"{traceback.format_exc()}")
@@ -693,32 +787,46 @@ class iq_custom_xep:
             logger.error(f"{traceback.format_exc()}")
 
     def iq_send(self):
+        """
+        Envoie l'IQ et bloque le thread appelant jusqu'à la réponse ou au timeout.
+
+        L'envoi et le timeout sont confiés à la boucle slixmpp ; la réponse est
+        résolue par la table des IQ en attente. Cette fonction ne peut pas être
+        appelée depuis la boucle slixmpp elle-même (un plugin appelé par
+        call_plugin s'exécute dans le pool de plugins).
+        """
         if not self.iq:
             return '{"error" : "initialisation erreur"}'
-        timeoutloop = float(self.timeout + 5)
-        self.iq.send(
-            callback=self.on_response,
-            timeout=int(self.timeout),
-            timeout_callback=self.on_timeout,
-        )
-        while True:
-            if not timeoutloop:
-                er = f'IQ type get id [{self.iq["id"]}] to [{self.iq["to"]}] in Timeout'
-                self.result_iq = {"error": er}
-                return self.result_iq
-            timeoutloop = timeoutloop - 0.5
-            if self.fin:
-                break
-            time.sleep(0.5)
-        self.reponse_iq = self.iq
+        loop = self.xmppobject.loop
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is loop:
+            er = f'IQ id [{self.iq["id"]}] : iq_send cannot wait on the xmpp loop'
+            logger.error(er)
+            return {"error": er}
+        table = PendingIqTable.of(self.xmppobject)
+        table.add(self)
+        loop.call_soon_threadsafe(self._send_on_loop, table)
+        if not self.done.wait(self.timeout + 5):
+            table.discard(self.iq["id"])
+            peer_encodings.forget(self.to)
+            er = f'IQ type get id [{self.iq["id"]}] to [{self.iq["to"]}] in Timeout'
+            self.result_iq = {"error": er}
         return self.result_iq
 
+    def _send_on_loop(self, table):
+        table.arm(self)
+        self.xmppobject.send(self.iq)
+
     def on_response(self, reponse_iq):
         logger.debug(f'on_response iq id {reponse_iq["iq"]} from {reponse_iq["from"]}')
         self.result_iq = {"error": "on_response"}
         try:
             self.reponse_iq = reponse_iq
             if reponse_iq["type"] == "error":
+                peer_encodings.forget(self.to)
                 texterror = ""
                 actionerror = ""
                 for child in reponse_iq.xml:
@@ -749,20 +857,17 @@ class iq_custom_xep:
             elif reponse_iq["type"] == "result":
                 # traitement du result
                 logger.debug("traitement de iq get custom_xep")
-                for child in reponse_iq.xml:
-                    if child.tag.endswith("query"):
-                        # select data element query
-                        for z in child:
-                            # recuperation (bytes data) encode en base64
-                            data = z.tag[1:-5]
-                            try:
-                                self.result_iq = convert.decode_base64_to_string_(data)
-                                return self.result_iq
-                            except Exception as e:
-                                logger.error(f"on_response custom_xep : {str(e)}")
-                                logger.error("\n%s" % (traceback.format_exc()))
-                                logger.error(f"xml reponse : {str(e)} ")
-                                return {"err": "erreur decodage iq"}
+                try:
+                    data, _ = get_iq_payload(reponse_iq)
+                    peer_encodings.learn(reponse_iq)
+                    if data is not None:
+                        self.result_iq = data.decode("utf-8")
+                    return self.result_iq
+                except Exception as e:
+                    peer_encodings.forget(self.to)
+                    logger.error(f"on_response custom_xep : {str(e)}")
+                    logger.error("\n%s" % (traceback.format_exc()))
+                    return {"err": "erreur decodage iq"}
             else:
                 self.result_iq = {"error": f'type iq [{reponse_iq["type"]}] '}
                 self.fin = True
@@ -774,6 +879,7 @@ class iq_custom_xep:
 
     def on_timeout(self, reponse_iq):
         self.reponse_iq = reponse_iq
+        peer_encodings.forget(self.to)
         er = f'IQ type get id [{reponse_iq["id"]}] to [{reponse_iq["to"]}] in Timeout'
         logger.error(er)
         self.result_iq = {"error": er}
@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; -*-
+# SPDX-FileCopyrightText: 2016-2023 Siveo <support@siveo.net>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+Payload of the custom_xep IQs.
+
+Legacy format: the base64 of the message is the namespace of an empty
+element, <{base64}data/>.
+
+New format: the message is compressed and carried as the text of
+<payload xmlns="custom_xep" encoding="zlib">...</payload>.
+
+A requester advertises the encodings it can decode in the accept attribute
+of the query element. A responder replies in the new format only when the
+request carries that attribute; the requester then remembers the encoding
+of the peer and sends its next requests in the new format. Peers that do
+not know the attribute ignore it and keep exchanging the legacy format.
+
+The encoding of a peer is forgotten when it answers in the legacy format,
+when a request to it fails or times out and when it comes back online (it
+may have been downgraded): the next request is sent in the legacy format.
+"""
+
+import base64
+import logging
+import threading
+import zlib
+import xml.etree.ElementTree as ET
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger()
+
+NAMESPACE = "custom_xep"
+PAYLOAD_TAG = "{%s}payload" % NAMESPACE
+ACCEPT_ATTRIBUTE = "accept"
+# Below this size the message is only base64 encoded.
+MIN_COMPRESS_SIZE = 256
+# Refuse to decompress a payload larger than this.
+MAX_PAYLOAD_SIZE = 64 * 1024 * 1024
+
+
+def supported_encodings():
+    """
+    Returns the encodings this agent can decode, by order of preference.
+    """
+    if zstandard is not None:
+        return ["zstd", "zlib", "none"]
+    return ["zlib", "none"]
+
+
+def choose_encoding(accept):
+    """
+    Returns the preferred encoding among those listed in accept
+    ("zstd,zlib,none"), or None if the peer only knows the legacy format.
+    """
+    if not accept:
+        return None
+    offered = [x.strip() for x in accept.split(",")]
+    for encoding in supported_encodings():
+        if encoding in offered:
+            return encoding
+    return None
+
+
+def encode_payload(data, encoding):
+    """
+    Compresses data (bytes) with encoding and returns the tuple
+    (encoding actually used, base64 text).
+    """
+    if len(data) < MIN_COMPRESS_SIZE:
+        encoding = "none"
+    if encoding == "zstd":
+        data = zstandard.ZstdCompressor().compress(data)
+    elif encoding == "zlib":
+        data = zlib.compress(data, 6)
+    elif encoding != "none":
+        raise ValueError("unknown payload encoding %s" % encoding)
+    return encoding, base64.b64encode(data).decode("ascii")
+
+
+def decode_payload(encoding, text):
+    """
+    Returns the bytes carried by the text of a payload element.
+    """
+    data = base64.b64decode(text or "")
+    if encoding == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd payload received but zstandard is not installed")
+        data = zstandard.ZstdDecompressor().decompress(
+            data, max_output_size=MAX_PAYLOAD_SIZE
+        )
+    elif encoding == "zlib":
+        decompressor = zlib.decompressobj()
+        data = decompressor.decompress(data, MAX_PAYLOAD_SIZE)
+        if decompressor.unconsumed_tail:
+            raise ValueError("payload larger than %s bytes" % MAX_PAYLOAD_SIZE)
+    elif encoding != "none":
+        raise ValueError("unknown payload encoding %s" % encoding)
+    return data
+
+
+def query_element(iq):
+    for child in iq.xml:
+        if child.tag.endswith("query"):
+            return child
+    return None
+
+
+def set_iq_payload(iq, data, encoding=None, accept=True):
+    """
+    Replaces the content of the custom_xep query of iq by data (bytes or str).
+
+    encoding None writes the legacy <{base64}data/> element. With accept,
+    the encodings we can decode are advertised to the peer.
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    query = query_element(iq)
+    if query is None:
+        raise ValueError("iq without custom_xep query")
+    for child in list(query):
+        query.remove(child)
+    if accept:
+        query.set(ACCEPT_ATTRIBUTE, ",".join(supported_encodings()))
+    elif ACCEPT_ATTRIBUTE in query.attrib:
+        del query.attrib[ACCEPT_ATTRIBUTE]
+    if encoding is None:
+        query.append(ET.Element("{%s}data" % base64.b64encode(data).decode("ascii")))
+        return
+    encoding, text = encode_payload(data, encoding)
+    element = ET.Element(PAYLOAD_TAG, {"encoding": encoding})
+    element.text = text
+    query.append(element)
+
+
+def get_iq_payload(iq):
+    """
+    Returns (data, new_format) for the custom_xep query of iq, data being
+    the bytes of the message or None if the query is empty.
+    """
+    query = query_element(iq)
+    if query is None:
+        return None, False
+    for element in query:
+        if element.tag == PAYLOAD_TAG:
+            return (
+                decode_payload(element.get("encoding", "none"), element.text),
+                True,
+            )
+        if element.tag.endswith("data"):
+            return base64.b64decode(element.tag[1:-5]), False
+    return None, False
+
+
+def peer_accept(iq):
+    """
+    Returns the encoding to use to answer the request iq (None: legacy).
+    """
+    query = query_element(iq)
+    if query is None:
+        return None
+    return choose_encoding(query.get(ACCEPT_ATTRIBUTE))
+
+
+class PeerEncodings:
+    """
+    Encoding known to be understood by each peer, learnt from the responses
+    in the new format. The agents answer from their bare JID, so the peers
+    are indexed by bare JID.
+    """
+
+    def __init__(self):
+        self._encodings = {}
+        self._lock = threading.Lock()
+
+    def get(self, jid):
+        return self._encodings.get(str(jid).split("/")[0])
+
+    def forget(self, jid):
+        """
+        Forgets the encoding of the peer jid, which gets the legacy format
+        until it answers in the new format again.
+        """
+        with self._lock:
+            self._encodings.pop(str(jid).split("/")[0], None)
+
+    def learn(self, iq):
+        """
+        Records the encoding of the peer that sent the response iq, or
+        forgets it if the response is in the legacy format.
+        """
+        query = query_element(iq)
+        if query is None:
+            return
+        for element in query:
+            if element.tag == PAYLOAD_TAG:
+                encoding = choose_encoding(query.get(ACCEPT_ATTRIBUTE) or "zlib")
+                with self._lock:
+                    self._encodings[str(iq["from"]).split("/")[0]] = encoding
+                return
+        self.forget(iq["from"])
+
+
+peer_encodings = PeerEncodings()
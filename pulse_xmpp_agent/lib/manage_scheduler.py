@@ -10,13 +10,14 @@ import os.path
 import traceback
 import logging
 import time
+import heapq
+import threading
 from datetime import datetime
 import croniter
 import json
 from random import randint
 
-
-# from lib.utils import
+from lib.utils import get_plugin_pool
 
 logger = logging.getLogger()
 
@@ -35,9 +36,24 @@ class manage_scheduler:
      # Nb -1 infinite
      SCHEDULE = {"schedule": "* / 1 * * * *", "nb": -1}
      Nb makes it possible to limit the operation a n times.
+
+     The next fire times are kept in a min-heap; a dedicated thread (start)
+     sleeps until the earliest one and hands the due plugins to the plugin
+     pool, in the lane scheduling_<name>. A plugin still running when it is
+     due again is skipped. A plugin due since more than misfire_grace_time
+     seconds (default 60) runs once ("misfire": "run", default) or waits
+     for its next fire time ("misfire": "skip"); both keys can be added to
+     SCHEDULE. stats() returns the next run, last duration and skipped
+     count of each plugin.
     """
 
     def __init__(self, objectxmpp):
+        # name -> job, heap of (exectime, name)
+        self.taches = {}
+        self._heap = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
         try:
             self.objectxmpp = objectxmpp
             objectxmpp.config.listcrontabforpluginscheduled = (
@@ -66,8 +82,6 @@ class manage_scheduler:
             objcromtabconf = {}
             logging.getLogger().warning(str(e))
 
-        self.taches = []
-
         self.now = datetime.now()
 
         # addition path to sys
@@ -173,27 +187,139 @@ class manage_scheduler:
             "timestart": str(self.now),
             "nbcount": nbcount,
             "count": 0,
+            "misfire": datascheduler.get("misfire", "run"),
+            "misfire_grace_time": datascheduler.get("misfire_grace_time", 60),
+            "running": False,
+            "runs": 0,
+            "skipped": 0,
+            "misfired": 0,
+            "last_start": None,
+            "last_duration": None,
+            "max_duration": 0,
+            "total_duration": 0,
+            "last_error": None,
         }
-        self.taches.append(obj)
+        with self._condition:
+            self.taches[name] = obj
+            heapq.heappush(self._heap, (obj["exectime"], name))
+            self._condition.notify()
+
+    def start(self):
+        """
+        Starts the thread dispatching the scheduled plugins.
+        """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            name="manage_scheduler", target=self._run, daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._stopped:
+                    return
+                timeout = self._heap[0][0] - time.time() if self._heap else 60
+                if timeout > 0:
+                    # re-evaluated every minute in case of clock change
+                    self._condition.wait(min(timeout, 60))
+                    continue
+            try:
+                self.process_on_event()
+            except Exception:
+                logging.getLogger().error("\n%s" % (traceback.format_exc()))
 
     def process_on_event(self):
-        now = datetime.now()
-        secondeunix = time.mktime(now.timetuple())
-        deleted = []
-        for t in self.taches:
-            if (secondeunix - t["exectime"]) > 0:
-                # Replace exectime
-                t["count"] = t["count"] + 1
-                if "nbcount" in t and t["nbcount"] != -1 and t["count"] > t["nbcount"]:
-                    deleted.append(t)
+        """
+        Dispatches the plugins whose fire time is reached.
+        """
+        secondeunix = time.time()
+        due = []
+        with self._condition:
+            while self._heap and self._heap[0][0] <= secondeunix:
+                exectime, name = heapq.heappop(self._heap)
+                t = self.taches.get(name)
+                if t is None or t["exectime"] != exectime:
+                    continue
+                if t["nbcount"] != -1 and t["count"] >= t["nbcount"]:
+                    del self.taches[name]
                     logging.getLogger().debug(f"terminate plugin {t}")
                     continue
-                cron = croniter.croniter(t["tabcron"], now)
-                nextd = cron.get_next(datetime)
-                t["exectime"] = time.mktime(nextd.timetuple())
-                self.call_scheduling_main(t["name"], self.objectxmpp)
-        for y in deleted:
-            self.taches.remove(y)
+                late = secondeunix - exectime
+                cron = croniter.croniter(t["tabcron"], datetime.now())
+                t["exectime"] = time.mktime(cron.get_next(datetime).timetuple())
+                heapq.heappush(self._heap, (t["exectime"], name))
+                if t["running"]:
+                    t["skipped"] += 1
+                    logging.getLogger().warning(
+                        f"scheduling_{name} still running: run skipped"
+                    )
+                    continue
+                if late > t["misfire_grace_time"]:
+                    t["misfired"] += 1
+                    if t["misfire"] == "skip":
+                        t["skipped"] += 1
+                        continue
+                t["count"] += 1
+                t["running"] = True
+                due.append(t)
+        for t in due:
+            future = get_plugin_pool(self.objectxmpp).submit(
+                f"scheduling_{t['name']}", self._run_job, (t,)
+            )
+            if future is None:
+                with self._condition:
+                    t["running"] = False
+                    t["skipped"] += 1
+
+    def _run_job(self, t):
+        start = time.monotonic()
+        t["last_start"] = time.time()
+        error = None
+        try:
+            self.call_scheduling_main(t["name"], self.objectxmpp)
+        except Exception as e:
+            error = str(e)
+            logging.getLogger().error("\n%s" % (traceback.format_exc()))
+        duration = time.monotonic() - start
+        with self._condition:
+            t["running"] = False
+            t["runs"] += 1
+            t["last_error"] = error
+            t["last_duration"] = duration
+            t["total_duration"] += duration
+            t["max_duration"] = max(t["max_duration"], duration)
+
+    def stats(self):
+        """
+        Returns for each scheduled plugin its next run, its run durations
+        and the number of skipped runs.
+        """
+        with self._condition:
+            return {
+                name: {
+                    "next_run": datetime.fromtimestamp(t["exectime"]).isoformat(),
+                    "running": t["running"],
+                    "runs": t["runs"],
+                    "skipped": t["skipped"],
+                    "misfired": t["misfired"],
+                    "last_start": t["last_start"]
+                    and datetime.fromtimestamp(t["last_start"]).isoformat(),
+                    "last_duration": t["last_duration"],
+                    "average_duration": (
+                        t["total_duration"] / t["runs"] if t["runs"] else None
+                    ),
+                    "max_duration": t["max_duration"],
+                    "last_error": t["last_error"],
+                }
+                for name, t in self.taches.items()
+            }
 
     def call_scheduling_main(self, name, *args, **kwargs):
         if self.objectxmpp.config.scheduling_plugin_action:
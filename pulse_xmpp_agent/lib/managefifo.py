@@ -2,22 +2,71 @@
 # SPDX-FileCopyrightText: 2016-2023 Siveo <support@siveo.net>
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import collections
+import functools
 import glob
+import heapq
+import itertools
 import os
 import json
 import logging
+import sqlite3
+import threading
 import time
 import traceback
 
 Logger = logging.getLogger()
 
 
+def locked(method):
+    """
+    Exécute la méthode sous le verrou de la file.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
 class fifodeploy:
-    def __init__(self):
-        # creation de la fifo en fonction des fichiers trouver dans le
-        # repertoire fifo
-        self.FIFOdeploy = []  # name des file fifo
-        self.SESSIONdeploy = {}  # liste des sessions deploy mis en file
+    """
+    File d'attente des déploiements d'un relais.
+
+    Les descripteurs de déploiement sont gardés en mémoire, indexés par
+    sessionid. L'ordre de sortie est un tas de (rang, sessionid) : un
+    déploiement "high" ou passé en priorité reçoit un rang négatif
+    décroissant et sort en premier. Un second tas indexé par enddate donne
+    les créneaux expirés en O(log n). Les suppressions sont paresseuses :
+    les entrées périmées des tas sont ignorées à la lecture.
+
+    getfifo_fair sert les commandes (idcmd) à tour de rôle : chaque commande
+    a son propre tas, et les déploiements "high" passent toujours en premier.
+
+    persistence vaut None (la file est vidée au redémarrage du relais),
+    "journal" (fichier fifo.journal en ajout seul) ou "sqlite" (fifo.db).
+    Les opérations sont mises en tampon et écrites par flush(), appelé à
+    chaque vérification des créneaux, jamais dans getfifo/setfifo.
+
+    setfifo est appelé depuis les threads du pool de plugins, getfifo_fair,
+    checking_deploy_slot_outdoor et flush depuis la boucle de l'agent :
+    toutes les méthodes publiques prennent le verrou de la file.
+    """
+
+    def __init__(self, persistence=None):
+        self._lock = threading.RLock()
+        self.SESSIONdeploy = {}  # sessionid -> [rang, descripteur]
+        self._order = []  # tas (rang, sessionid)
+        self._enddates = []  # tas (enddate, sessionid)
+        self._groups = {}  # idcmd -> tas (rang, sessionid)
+        self._turn = collections.deque()  # idcmd servis a tour de role
+        self._high = itertools.count(-1, -1)
+        self._low = itertools.count(1)
+        self._pending = []  # operations a persister
+        self._journal_lines = 0
+        self.persistence = persistence
         self.dirsavedatafifo = os.path.abspath(
             os.path.join(
                 os.path.dirname(os.path.realpath(__file__)), "..", "fifodeploy"
@@ -25,181 +74,333 @@ class fifodeploy:
         )
         if not os.path.exists(self.dirsavedatafifo):
             os.makedirs(self.dirsavedatafifo, mode=0o007)
-        Logger.debug(f"Manager fifo : {self.dirsavedatafifo}")
-        # load les sessions fifos
-        # parcoure le repertoire fifo, et charge les fifo dans FIFOdeploy
-        # self.loadfifo() #charge fifo for deployement decommente cette line
-        # si tu veux reprendre les fifo apres un restart de ARS.
-        # cleardirfifo supprime les fifo au redémarage de ARS
-        self.cleardirfifo()  # commente cette line cleardirfifo
-        # si tu veux reprendre les fifo apres un restart de ARS
-
-    def _InitSessiondeploy(self):
-        self.SESSIONdeploy = {}
-        suplist = []
-        for fifodata in self.FIFOdeploy:
-            data = self.readfifo(fifodata)
-            if "sessionid" in data:
-                self.SESSIONdeploy[data["sessionid"]] = fifodata
-            else:
-                suplist.append(fifodata)
-        for t in suplist:
-            self.FIFOdeploy.remove(t)
+        Logger.debug(f"Manager fifo : {self.dirsavedatafifo} ({persistence})")
+        self.journal = os.path.join(self.dirsavedatafifo, "fifo.journal")
+        self.database = os.path.join(self.dirsavedatafifo, "fifo.db")
+        # les fichiers .fifo des versions precedentes ne sont pas repris
+        self.cleardirfifo()
+        if persistence:
+            self.loadfifo()
 
+    @locked
     def loadfifo(self):
-        self.FIFOdeploy = [
-            os.path.basename(x)
-            for x in glob.glob(os.path.join(self.dirsavedatafifo, "*"))
-            if (os.path.isfile(x) and os.path.basename(x).endswith("fifo"))
-        ]
-        self.FIFOdeploy.sort()
-        self._InitSessiondeploy()
+        """
+        Recharge la file persistée après un redémarrage du relais.
+        """
+        try:
+            if self.persistence == "journal":
+                self._load_journal()
+            elif self.persistence == "sqlite":
+                self._load_sqlite()
+        except Exception:
+            Logger.error("\n%s" % (traceback.format_exc()))
+        Logger.debug(f"fifo loaded : {self.getcount()} deployments")
         return self.SESSIONdeploy
 
+    @staticmethod
+    def group(datajson):
+        """
+        Retourne la commande du déploiement.
+        """
+        return str(datajson.get("idcmd", ""))
+
+    @staticmethod
+    def package(datajson):
+        """
+        Retourne l'uuid du package du déploiement.
+        """
+        return str(datajson.get("path", "")).split("/")[-1]
+
+    def _add(self, rank, datajson):
+        sessionid = datajson["sessionid"]
+        self.SESSIONdeploy[sessionid] = [rank, datajson]
+        heapq.heappush(self._order, (rank, sessionid))
+        self._pushgroup(self.group(datajson), rank, sessionid)
+        if datajson.get("enddate") is not None:
+            heapq.heappush(self._enddates, (datajson["enddate"], sessionid))
+
+    def _load_journal(self):
+        if not os.path.isfile(self.journal):
+            return
+        ranks = {}
+        with open(self.journal, "r") as journal:
+            for line in journal:
+                try:
+                    op = json.loads(line)
+                except ValueError:
+                    # derniere ligne tronquee par un arret brutal
+                    continue
+                if op["op"] == "add":
+                    ranks[op["sessionid"]] = [op["rank"], op["data"]]
+                elif op["op"] == "rank" and op["sessionid"] in ranks:
+                    ranks[op["sessionid"]][0] = op["rank"]
+                elif op["op"] == "del":
+                    ranks.pop(op["sessionid"], None)
+        self._restore(ranks.values())
+        self._compact_journal()
+
+    def _load_sqlite(self):
+        with sqlite3.connect(self.database) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS fifo "
+                "(sessionid TEXT PRIMARY KEY, rank INTEGER, data TEXT)"
+            )
+            rows = connection.execute("SELECT rank, data FROM fifo").fetchall()
+        connection.close()
+        self._restore([[rank, json.loads(data)] for rank, data in rows])
+
+    def _restore(self, entries):
+        for rank, datajson in entries:
+            self._add(rank, datajson)
+        if self._order:
+            lowest = min(rank for rank, _ in self._order)
+            highest = max(rank for rank, _ in self._order)
+            self._high = itertools.count(min(lowest, 0) - 1, -1)
+            self._low = itertools.count(max(highest, 0) + 1)
+
+    @locked
+    def flush(self):
+        """
+        Écrit les opérations en attente dans le support de persistance.
+        """
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        try:
+            if self.persistence == "journal":
+                with open(self.journal, "a") as journal:
+                    for op in pending:
+                        journal.write(json.dumps(op) + "\n")
+                self._journal_lines += len(pending)
+                if self._journal_lines > 4 * self.getcount() + 1000:
+                    self._compact_journal()
+            elif self.persistence == "sqlite":
+                with sqlite3.connect(self.database) as connection:
+                    for op in pending:
+                        if op["op"] == "add":
+                            connection.execute(
+                                "INSERT OR REPLACE INTO fifo VALUES (?, ?, ?)",
+                                (op["sessionid"], op["rank"], json.dumps(op["data"])),
+                            )
+                        elif op["op"] == "rank":
+                            connection.execute(
+                                "UPDATE fifo SET rank = ? WHERE sessionid = ?",
+                                (op["rank"], op["sessionid"]),
+                            )
+                        else:
+                            connection.execute(
+                                "DELETE FROM fifo WHERE sessionid = ?",
+                                (op["sessionid"],),
+                            )
+                connection.close()
+        except Exception:
+            Logger.error("\n%s" % (traceback.format_exc()))
+
+    def _compact_journal(self):
+        tmp = self.journal + ".tmp"
+        with open(tmp, "w") as journal:
+            for sessionid, (rank, datajson) in self.SESSIONdeploy.items():
+                journal.write(
+                    json.dumps(
+                        {
+                            "op": "add",
+                            "sessionid": sessionid,
+                            "rank": rank,
+                            "data": datajson,
+                        }
+                    )
+                    + "\n"
+                )
+        os.replace(tmp, self.journal)
+        self._journal_lines = self.getcount()
+
+    def _persist(self, op):
+        if self.persistence:
+            self._pending.append(op)
+
+    @locked
     def checking_deploy_slot_outdoor(self):
+        """
+        Retourne les sessions dont le créneau de déploiement est passé.
+        """
+        sessionterminate = []
         try:
-            removefilefifo = []
             Logger.debug("Verify slot for fifo")
-            sessionterminate = []
-            for fifodata in self.FIFOdeploy:
-                data = self.readfifo(fifodata)
-                if data["enddate"] < time.time():
-                    Logger.debug(f"fifo file of deployment slot has passed.{fifodata}")
-                    sessionterminate.append(data["sessionid"])
-                    removefilefifo.append(fifodata)
-                else:
-                    Logger.debug(f"fifo waitting for deploy.{fifodata}")
-                if sessionterminate:
-                    Logger.debug(
-                        f"return abandons the deployment of the session the deployment slot has passed.{sessionterminate}"
-                    )
+            now = time.time()
+            while self._enddates and self._enddates[0][0] < now:
+                enddate, sessionid = heapq.heappop(self._enddates)
+                entry = self.SESSIONdeploy.get(sessionid)
+                if entry is None or entry[1].get("enddate") != enddate:
+                    continue
+                Logger.debug(f"fifo deployment slot has passed. {sessionid}")
+                sessionterminate.append(sessionid)
+            if sessionterminate:
+                Logger.debug(
+                    f"return abandons the deployment of the session the deployment slot has passed.{sessionterminate}"
+                )
+            self.flush()
         except Exception as e:
             Logger.error("\n%s" % (traceback.format_exc()))
         return sessionterminate
 
     def cleardirfifo(self):
-        self.FIFOdeploy = [
-            os.path.basename(x)
+        """
+        Supprime les fichiers .fifo et, sans persistance, la file sauvegardée.
+        """
+        files = [
+            x
             for x in glob.glob(os.path.join(self.dirsavedatafifo, "*"))
-            if (os.path.isfile(x) and os.path.basename(x).endswith("fifo"))
+            if os.path.isfile(x)
+            and (
+                x.endswith(".fifo")
+                or (not self.persistence and x in (self.journal, self.database))
+            )
         ]
-        for fifodata in self.FIFOdeploy:
-            pathnamefile = os.path.join(self.dirsavedatafifo, fifodata)
-            if os.path.isfile(pathnamefile):
-                os.remove(pathnamefile)
-                Logger.debug(f"file {pathnamefile} in Manager fifo is cleanned")
-        self.FIFOdeploy = []
+        for pathnamefile in files:
+            os.remove(pathnamefile)
+            Logger.debug(f"file {pathnamefile} in Manager fifo is cleanned")
 
+    @locked
     def getcount(self):
-        return len(self.FIFOdeploy)
+        return len(self.SESSIONdeploy)
 
+    @locked
     def setfifo(self, datajson, priority=None):
-        newfilefifo = f"{str(time.time())}.fifo"
-        pathnamefile = os.path.join(self.dirsavedatafifo, newfilefifo)
-        with open(pathnamefile, "w") as outfilejson:
-            json.dump(datajson, outfilejson, indent=4)
         if priority is not None and priority == "high":
-            self.FIFOdeploy.insert(0, newfilefifo)
-            Logger.debug(f"set fifo high file {newfilefifo}  fifo {self.FIFOdeploy}")
+            rank = next(self._high)
+            Logger.debug(f'set fifo high session {datajson["sessionid"]}')
         else:
-            self.FIFOdeploy.append(newfilefifo)
-            Logger.debug(f"set fifo low file {newfilefifo}  fifo {self.FIFOdeploy}")
-        self.SESSIONdeploy[datajson["sessionid"]] = newfilefifo
+            rank = next(self._low)
+            Logger.debug(f'set fifo low session {datajson["sessionid"]}')
+        self._add(rank, datajson)
+        self._persist(
+            {
+                "op": "add",
+                "sessionid": datajson["sessionid"],
+                "rank": rank,
+                "data": datajson,
+            }
+        )
+        self._compact()
 
+    @locked
     def getfifo(self):
         """
         fifo shift
             unstacking at the top of the list
             return descriptor déployement
-            rq: le deploy descriptor file is deleted
-        """
-        if self.getcount() == 0:
-            return {}
-        if len(self.FIFOdeploy) == 0:
-            self.SESSIONdeploy = {}
-            return {}
-        firstfileinput = self.FIFOdeploy.pop(0)
-        pathnamefile = os.path.join(self.dirsavedatafifo, firstfileinput)
-        if not os.path.isfile(pathnamefile):
-            return {}
-        try:
-            fichier_json = open(pathnamefile, "r")
-            with fichier_json as fichier:
-                data = json.load(fichier)  # load décode un fichier json
-            # add dans ressource ce transfert.
-            # self.currentresource.add(data['sessionid'])
-            os.remove(pathnamefile)
-            try:
-                del self.SESSIONdeploy[data["sessionid"]]
-            except Exception as e:
-                Logger.error(f"del session in FIFO : {str(e)}")
-            return data
-        except Exception as e:
-            if os.path.isfile(pathnamefile):
-                Logger.error(f"del fichier fifo on error json{pathnamefile}")
-                os.remove(pathnamefile)
-            Logger.error(
-                "look file %s in Manager fifo :\n[%s]" % (pathnamefile, str(e))
-            )
-            Logger.error("\n%s" % (traceback.format_exc()))
-            return {}
+        """
+        while self._order:
+            rank, sessionid = heapq.heappop(self._order)
+            entry = self.SESSIONdeploy.get(sessionid)
+            if entry is None or entry[0] != rank:
+                continue
+            del self.SESSIONdeploy[sessionid]
+            self._persist({"op": "del", "sessionid": sessionid})
+            return entry[1]
+        return {}
+
+    def _pushgroup(self, group, rank, sessionid):
+        if group not in self._groups:
+            self._groups[group] = []
+            self._turn.append(group)
+        heapq.heappush(self._groups[group], (rank, sessionid))
 
+    def _head(self, heap):
+        # premiere entree valide du tas, les entrees perimees sont retirees
+        while heap:
+            rank, sessionid = heap[0]
+            entry = self.SESSIONdeploy.get(sessionid)
+            if entry is not None and entry[0] == rank:
+                return entry
+            heapq.heappop(heap)
+        return None
+
+    def _pop(self, datajson):
+        sessionid = datajson["sessionid"]
+        del self.SESSIONdeploy[sessionid]
+        self._persist({"op": "del", "sessionid": sessionid})
+        return datajson
+
+    @locked
+    def getfifo_fair(self, accept=None):
+        """
+        Retourne le prochain descripteur à déployer, ou {}.
+
+        Les déploiements "high" sortent d'abord dans l'ordre de la file.
+        Les autres sont pris à tour de rôle dans chaque commande, pour
+        qu'une commande de milliers de machines ne bloque pas les suivantes.
+        accept(descripteur) peut refuser le premier déploiement d'une
+        commande (limite par package) : la commande est alors sautée.
+        """
+        entry = self._head(self._order)
+        if entry is not None and entry[0] < 0:
+            if accept is None or accept(entry[1]):
+                return self._pop(entry[1])
+        for _ in range(len(self._turn)):
+            group = self._turn.popleft()
+            entry = self._head(self._groups[group])
+            if entry is None:
+                del self._groups[group]
+                continue
+            self._turn.append(group)
+            if accept is None or accept(entry[1]):
+                return self._pop(entry[1])
+        return {}
+
+    @locked
     def delsessionfifo(self, sessionid):
         Logger.debug(f"del session id : {sessionid}")
-        try:
-            namefile = self.SESSIONdeploy[sessionid]
-            try:
-                self.FIFOdeploy.remove(self.SESSIONdeploy[sessionid])
-            except ValueError as e:
-                Logger.error("file missing for remove fifo" % (str(e)))
-            del self.SESSIONdeploy[sessionid]
-            pathnamefile = os.path.join(self.dirsavedatafifo, namefile)
-            os.remove(pathnamefile)
-        except KeyError:
+        if self.SESSIONdeploy.pop(sessionid, None) is None:
             Logger.warning(f"the session {sessionid} no longer exists.")
-        except Exception as e:
-            Logger.error(f"del session fifo {sessionid} err : [{str(e)}]")
-            Logger.error("\n%s" % (traceback.format_exc()))
+            return
+        self._persist({"op": "del", "sessionid": sessionid})
 
-    def readfifo(self, namefifo):
+    @locked
+    def readfifo(self, sessionid):
         """
-        return deploy descriptor data from file descriptor
+        return deploy descriptor data of the session
         """
-        if self.getcount() == 0:
-            return {}
-        pathnamefile = os.path.join(self.dirsavedatafifo, namefifo)
-        if not os.path.isfile(pathnamefile):
-            Logger.error(f"file {pathnamefile} in Manager fifo is missing")
-            return {}
-        try:
-            fichier_json = open(pathnamefile, "r")
-            with fichier_json as fichier:
-                data = json.load(fichier)  # load décode un fichier json
-            return data
-        except Exception as e:
-            Logger.error(
-                "look file %s in Manager fifo :\n[%s]" % (pathnamefile, str(e))
-            )
-            if os.path.isfile(pathnamefile):
-                Logger.error(f"del fichier fifo on error json{pathnamefile}")
-                os.remove(pathnamefile)
-            return {}
+        entry = self.SESSIONdeploy.get(sessionid)
+        return entry[1] if entry is not None else {}
 
+    @locked
     def displayfifo(self):
-        for fifodata in self.FIFOdeploy:
-            print(self.readfifo(fifodata))
-            Logger.info(f"{self.readfifo(fifodata)}")
+        for rank, sessionid in sorted(self._order):
+            entry = self.SESSIONdeploy.get(sessionid)
+            if entry is not None and entry[0] == rank:
+                Logger.info(f"{entry[1]}")
 
+    @locked
     def prioritydeploy(self, sessionid):
         """
         an id session is passed in parameter.
         This function passes the deployment of this priority session.
         """
-        # search dans la liste si cette id existe.
-        if sessionid in self.SESSIONdeploy:
-            filefifo = self.SESSIONdeploy[sessionid]
-            self.FIFOdeploy.remove(filefifo)
-            self.FIFOdeploy.insert(0, filefifo)
-            return True
-        else:
+        entry = self.SESSIONdeploy.get(sessionid)
+        if entry is None:
             return False
+        entry[0] = next(self._high)
+        heapq.heappush(self._order, (entry[0], sessionid))
+        self._pushgroup(self.group(entry[1]), entry[0], sessionid)
+        self._persist({"op": "rank", "sessionid": sessionid, "rank": entry[0]})
+        self._compact()
+        return True
+
+    def _compact(self):
+        # les tas gardent les entrees supprimees : reconstruits au-dela du double
+        if len(self._order) > 2 * len(self.SESSIONdeploy) + 64:
+            self._order = [
+                (entry[0], sessionid) for sessionid, entry in self.SESSIONdeploy.items()
+            ]
+            heapq.heapify(self._order)
+            self._enddates = [
+                (entry[1]["enddate"], sessionid)
+                for sessionid, entry in self.SESSIONdeploy.items()
+                if entry[1].get("enddate") is not None
+            ]
+            heapq.heapify(self._enddates)
+            for group in self._groups:
+                self._groups[group] = []
+            for sessionid, entry in self.SESSIONdeploy.items():
+                self._pushgroup(self.group(entry[1]), entry[0], sessionid)
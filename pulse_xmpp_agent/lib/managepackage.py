@@ -8,6 +8,8 @@ import os
 import os.path
 import json
 import logging
+import threading
+import time
 from lib.agentconffile import (
     conffilename,
     medullaPath,
@@ -130,35 +132,9 @@ class managepackage:
 
     @staticmethod
     def getdescriptorpackagename(packagename):
-        for package in managepackage.listpackages():
-            if not os.path.isfile(os.path.join(package, "xmppdeploy.json")):
-                logger.error(
-                    f'The {os.path.join(package, "xmppdeploy.json")} file is missing'
-                )
-                return None
-
-            try:
-                outputJSONFile = managepackage.loadjsonfile(
-                    os.path.join(package, "xmppdeploy.json")
-                )
-                if (
-                    "info" in outputJSONFile
-                    and (
-                        "software" in outputJSONFile["info"]
-                        and "version" in outputJSONFile["info"]
-                    )
-                    and (
-                        outputJSONFile["info"]["software"] == packagename
-                        or outputJSONFile["info"]["name"] == packagename
-                    )
-                ):
-                    return outputJSONFile
-            except Exception as e:
-                logger.error(
-                    "Please verify the format of the descriptor for"
-                    "the package %s." % packagename
-                )
-                logger.error(f"we are encountering the error: {str(e)}")
+        for entry in package_index.byname(packagename):
+            if entry["complete"]:
+                return PackageIndex.descriptor(entry)
         return None
 
     @staticmethod
@@ -172,35 +148,9 @@ class managepackage:
         Returns:
             It returns the version of the package
         """
-        for package in managepackage.listpackages():
-            if not os.path.isfile(os.path.join(package, "xmppdeploy.json")):
-                logger.error(
-                    f'The {os.path.join(package, "xmppdeploy.json")} file is missing'
-                )
-                return None
-
-            try:
-                outputJSONFile = managepackage.loadjsonfile(
-                    os.path.join(package, "xmppdeploy.json")
-                )
-                if (
-                    "info" in outputJSONFile
-                    and (
-                        "software" in outputJSONFile["info"]
-                        and "version" in outputJSONFile["info"]
-                    )
-                    and (
-                        outputJSONFile["info"]["software"] == packagename
-                        or outputJSONFile["info"]["name"] == packagename
-                    )
-                ):
-                    return outputJSONFile["info"]["version"]
-            except Exception as e:
-                logger.error(
-                    "Please verify the version for the package %s in the descriptor"
-                    "in the xmppdeploy.json file." % package
-                )
-                logger.error(f"we are encountering the error: {str(e)}")
+        for entry in package_index.byname(packagename):
+            if entry["complete"]:
+                return entry["version"]
         return None
 
     @staticmethod
@@ -212,34 +162,8 @@ class managepackage:
         Returns:
             It returns the name of the package
         """
-        for package in managepackage.listpackages():
-            if not os.path.isfile(os.path.join(package, "xmppdeploy.json")):
-                logger.error(
-                    f'The {os.path.join(package, "xmppdeploy.json")} file is missing'
-                )
-                return None
-
-            try:
-                outputJSONFile = managepackage.loadjsonfile(
-                    os.path.join(package, "xmppdeploy.json")
-                )
-                if "info" in outputJSONFile and (
-                    (
-                        "software" in outputJSONFile["info"]
-                        and outputJSONFile["info"]["software"] == packagename
-                    )
-                    or (
-                        "name" in outputJSONFile["info"]
-                        and outputJSONFile["info"]["name"] == packagename
-                    )
-                ):
-                    return package
-            except Exception as e:
-                logger.error(
-                    "Please verify the name for the package %s in the descriptor"
-                    "in the xmppdeploy.json file." % package
-                )
-                logger.error(f"we are encountering the error: {str(e)}")
+        for entry in package_index.byname(packagename):
+            return entry["path"]
         return None
 
     @staticmethod
@@ -252,22 +176,9 @@ class managepackage:
             We return the package, it returns None if any error or if
                 the package is not found.
         """
-        for package in managepackage.listpackages():
-            if not os.path.isfile(os.path.join(package, "xmppdeploy.json")):
-                logger.error(
-                    f'The {os.path.join(package, "xmppdeploy.json")} file is missing'
-                )
-                return None
-
-            try:
-                outputJSONFile = managepackage.loadjsonfile(
-                    os.path.join(package, "conf.json")
-                )
-                if "id" in outputJSONFile and outputJSONFile["id"] == uuidpackage:
-                    return package
-            except Exception as e:
-                logger.error(f"The conf.json for the package {package} is missing")
-                logger.error(f"we are encountering the error: {str(e)}")
+        entry = package_index.byuuid(uuidpackage)
+        if entry is not None:
+            return entry["path"]
         logger.error(f"We did not find the package {uuidpackage}")
         return None
 
@@ -282,63 +193,36 @@ class managepackage:
             We return the version of package, it returns None if
                 any error or if the package is not found.
         """
-        for package in managepackage.listpackages():
-            if not os.path.isfile(os.path.join(package, "xmppdeploy.json")):
-                logger.error(
-                    f'The {os.path.join(package, "xmppdeploy.json")} file is missing'
-                )
-                return None
-
-            if not os.path.isfile(os.path.join(package, "conf.json")):
-                logger.error(
-                    f'The file {os.path.join(package, "conf.json")} is missing. It cannot work witout it.'
-                )
-                return None
-
-            try:
-                outputJSONFile = managepackage.loadjsonfile(
-                    os.path.join(package, "conf.json")
-                )
-                if (
-                    "id" in outputJSONFile
-                    and outputJSONFile["id"] == packageuuid
-                    and "version" in outputJSONFile
-                ):
-                    return outputJSONFile["version"]
-            except Exception as e:
-                logger.error(
-                    f"package {packageuuid} verify format descriptor conf.json [{str(e)}]"
-                )
-        logger.error(
-            "package %s verify version" "in descriptor conf.json [%s]" % (packageuuid)
-        )
+        entry = package_index.byuuid(packageuuid)
+        if entry is not None and entry["confversion"] is not None:
+            return entry["confversion"]
+        logger.error(f"package {packageuuid} verify version in descriptor conf.json")
         return None
 
     @staticmethod
     def getnamepackagefromuuidpackage(uuidpackage):
-        pathpackage = os.path.join(
-            managepackage.packagedir(), uuidpackage, "xmppdeploy.json"
-        )
-        if os.path.isfile(pathpackage):
-            outputJSONFile = managepackage.loadjsonfile(pathpackage)
-            return outputJSONFile["info"]["name"]
+        pathpackage = os.path.join(managepackage.packagedir(), uuidpackage)
+        entry = package_index.bypath(pathpackage)
+        if entry is not None and entry["descriptor"] is not None:
+            return PackageIndex.descriptor(entry)["info"]["name"]
         else:
-            logger.error(f"The file {pathpackage} is missing")
+            logger.error(f"The file {pathpackage}/xmppdeploy.json is missing")
         return None
 
     @staticmethod
     def getdescriptorpackageuuid(packageuuid):
-        jsonfile = os.path.join(
-            managepackage.packagedir(), packageuuid, "xmppdeploy.json"
-        )
-        if os.path.isfile(jsonfile):
+        pathpackage = os.path.join(managepackage.packagedir(), packageuuid)
+        entry = package_index.bypath(pathpackage)
+        if entry is not None and entry["descriptor"] is not None:
             try:
-                return managepackage.loadjsonfile(jsonfile)
+                return PackageIndex.descriptor(entry)
             except Exception as error_loading:
-                logger.error(f"An error occured while loading the file {jsonfile}")
+                logger.error(
+                    f"An error occured while loading the file {pathpackage}/xmppdeploy.json"
+                )
                 return None
         else:
-            logger.error(f"The file {jsonfile} is missing")
+            logger.error(f"The file {pathpackage}/xmppdeploy.json is missing")
         return None
 
     @staticmethod
@@ -346,6 +230,193 @@ class managepackage:
         return os.path.join(managepackage.packagedir(), uuidpackage)
 
 
+class PackageIndex:
+    """
+    Index en mémoire des packages du répertoire des packages.
+
+    Pour chaque package sont gardés l'uuid (id de conf.json), le nom, le
+    logiciel et la version, le chemin et le texte de xmppdeploy.json. Un
+    package n'est relu que si la date de modification de son
+    xmppdeploy.json ou de son conf.json change.
+
+    L'index est resynchronisé avec le disque quand le répertoire des
+    packages change (package ajouté ou supprimé), et au plus tard toutes
+    les refresh_interval secondes. Une recherche par uuid vérifie en plus
+    les dates du package trouvé.
+    """
+
+    FILES = ("xmppdeploy.json", "conf.json")
+
+    def __init__(self, refresh_interval=10):
+        self.refresh_interval = refresh_interval
+        self._lock = threading.RLock()
+        self._directory = None
+        self._dirmtime = None
+        self._refreshed = 0
+        self._packages = {}  # chemin -> entrée
+        self._byuuid = {}
+        self._byname = {}
+
+    @staticmethod
+    def _signature(path):
+        signature = []
+        for filename in PackageIndex.FILES:
+            try:
+                signature.append(os.stat(os.path.join(path, filename)).st_mtime_ns)
+            except OSError:
+                signature.append(None)
+        return signature
+
+    def _load(self, path, signature):
+        entry = {
+            "path": path,
+            "signature": signature,
+            "uuid": None,
+            "names": [],
+            "version": None,
+            "confversion": None,
+            "descriptor": None,
+            "dependencies": [],
+            "complete": False,
+        }
+        if signature[0] is None:
+            logger.error(f'The {os.path.join(path, "xmppdeploy.json")} file is missing')
+            return entry
+        try:
+            with open(os.path.join(path, "xmppdeploy.json"), "r") as file:
+                entry["descriptor"] = file.read()
+            descriptor = json.loads(entry["descriptor"])
+            info = descriptor.get("info", {})
+            entry["names"] = [info[key] for key in ("software", "name") if key in info]
+            entry["version"] = info.get("version")
+            entry["complete"] = "software" in info and "version" in info
+            entry["dependencies"] = info.get("Dependency", [])
+        except Exception as e:
+            logger.error(f"Please verify the format of the descriptor of {path}")
+            logger.error(f"we are encountering the error: {str(e)}")
+        if signature[1] is None:
+            logger.error(
+                f'The file {os.path.join(path, "conf.json")} is missing. It cannot work witout it.'
+            )
+            return entry
+        try:
+            conf = managepackage.loadjsonfile(os.path.join(path, "conf.json"))
+            entry["uuid"] = conf.get("id")
+            entry["confversion"] = conf.get("version")
+        except Exception as e:
+            logger.error(f"The conf.json for the package {path} is unreadable")
+            logger.error(f"we are encountering the error: {str(e)}")
+        return entry
+
+    def _reindex(self):
+        self._byuuid = {}
+        self._byname = {}
+        for entry in self._packages.values():
+            if entry["uuid"] is not None:
+                self._byuuid.setdefault(entry["uuid"], entry)
+            for name in entry["names"]:
+                self._byname.setdefault(name, []).append(entry)
+
+    def refresh(self, force=False):
+        """
+        Resynchronise l'index avec le répertoire des packages si besoin.
+        """
+        directory = managepackage.packagedir()
+        try:
+            dirmtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            dirmtime = None
+        with self._lock:
+            if (
+                not force
+                and directory == self._directory
+                and dirmtime == self._dirmtime
+                and time.time() - self._refreshed < self.refresh_interval
+            ):
+                return
+            if directory != self._directory:
+                self._packages = {}
+            packages = {}
+            if dirmtime is not None:
+                for name in os.listdir(directory):
+                    if len(name) != 36:
+                        continue
+                    path = os.path.join(directory, name)
+                    signature = self._signature(path)
+                    entry = self._packages.get(path)
+                    if entry is None or entry["signature"] != signature:
+                        entry = self._load(path, signature)
+                    packages[path] = entry
+            self._packages = packages
+            self._directory = directory
+            self._dirmtime = dirmtime
+            self._refreshed = time.time()
+            self._reindex()
+
+    def _fresh(self, entry):
+        """
+        Relit l'entrée si le package a changé sur le disque.
+        """
+        signature = self._signature(entry["path"])
+        if signature == entry["signature"]:
+            return entry
+        with self._lock:
+            if signature == [None, None] and not os.path.isdir(entry["path"]):
+                self._packages.pop(entry["path"], None)
+                self._reindex()
+                return None
+            entry = self._load(entry["path"], signature)
+            self._packages[entry["path"]] = entry
+            self._reindex()
+        return entry
+
+    def byuuid(self, uuidpackage):
+        """
+        Retourne l'entrée du package d'id uuidpackage, ou None.
+        """
+        self.refresh()
+        entry = self._byuuid.get(uuidpackage)
+        if entry is not None:
+            entry = self._fresh(entry)
+            if entry is not None and entry["uuid"] != uuidpackage:
+                self.refresh(force=True)
+                entry = self._byuuid.get(uuidpackage)
+        return entry
+
+    def bypath(self, path):
+        """
+        Retourne l'entrée du package du répertoire path, ou None.
+        """
+        self.refresh()
+        entry = self._packages.get(path)
+        if entry is None:
+            if not os.path.isdir(path):
+                return None
+            entry = {"path": path, "signature": None}
+        return self._fresh(entry)
+
+    def byname(self, packagename):
+        """
+        Retourne les entrées des packages dont le logiciel ou le nom est
+        packagename.
+        """
+        self.refresh()
+        return list(self._byname.get(packagename, []))
+
+    @staticmethod
+    def descriptor(entry):
+        """
+        Retourne le descripteur xmppdeploy.json de l'entrée (un nouvel objet à
+        chaque appel).
+        """
+        if entry is None or entry["descriptor"] is None:
+            return None
+        return json.loads(entry["descriptor"])
+
+
+package_index = PackageIndex()
+
+
 class search_list_of_deployment_packages:
     """
     Recursively search for all dependencies for this package
@@ -361,10 +432,11 @@ class search_list_of_deployment_packages:
 
     def __recursif__(self, packageuuid):
         self.list_of_deployment_packages.add(packageuuid)
-        objdescriptor = managepackage.getdescriptorpackageuuid(packageuuid)
-        if objdescriptor is not None:
-            ll = self.__list_dependence__(objdescriptor)
-            for y in ll:
+        entry = package_index.bypath(
+            os.path.join(managepackage.packagedir(), packageuuid)
+        )
+        if entry is not None:
+            for y in entry["dependencies"]:
                 if y not in self.list_of_deployment_packages:
                     self.__recursif__(y)
 
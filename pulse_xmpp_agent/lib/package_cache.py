@@ -0,0 +1,304 @@
+# -*- coding: utf-8; -*-
+# SPDX-FileCopyrightText: 2016-2023 Siveo <support@siveo.net>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import pycurl
+
+logger = logging.getLogger()
+
+BLOCK_SIZE = 65535
+
+
+def file_hash(filename, hash_type="sha256"):
+    """
+    Retourne l'empreinte hexadécimale du fichier.
+    """
+    result = hashlib.new(hash_type)
+    with open(filename, "rb") as content:
+        block = content.read(BLOCK_SIZE)
+        while block:
+            result.update(block)
+            block = content.read(BLOCK_SIZE)
+    return result.hexdigest()
+
+
+class PackageCache:
+    """
+    Cache des fichiers de package d'une machine, adressé par contenu.
+
+    Chaque fichier est rangé sous son empreinte (packagefilehash du message
+    de déploiement) : un redéploiement du package, ou une nouvelle version
+    qui partage des fichiers, ne télécharge que les fichiers absents du
+    cache. Le fichier du cache est lié (hardlink, ou copie si le lien est
+    impossible) dans le répertoire du package.
+
+    Un téléchargement interrompu est gardé en .part et repris par une
+    requête Range au déploiement suivant. Ce .part n'est écrit que par un
+    transfert à la fois (voir part) : un téléchargement concurrent du même
+    fichier se fait dans un .part qui lui est propre. max_size (octets)
+    borne la taille du cache, les fichiers les moins récemment utilisés sont
+    supprimés (0 : pas de limite).
+    """
+
+    def __init__(self, directory, max_size=0, hash_type="sha256"):
+        self.directory = directory
+        self.max_size = max_size
+        self.hash_type = hash_type
+        self._lock = threading.Lock()
+        self._parts = set()
+        if not os.path.isdir(directory):
+            os.makedirs(directory, mode=0o700)
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def part(self, key):
+        """
+        Retourne le .part où télécharger key. Le .part partagé, repris d'un
+        déploiement à l'autre, est réservé au transfert qui le demande en
+        premier ; les autres reçoivent un .part temporaire. Le .part est
+        rendu par release.
+        """
+        with self._lock:
+            if key not in self._parts:
+                self._parts.add(key)
+                return self.path(key) + ".part"
+        handle, part = tempfile.mkstemp(
+            prefix=key + ".", suffix=".part", dir=self.directory
+        )
+        os.close(handle)
+        return part
+
+    def release(self, key, part):
+        """
+        Rend le .part obtenu par part. Un .part temporaire ne peut pas être
+        repris : il est supprimé.
+        """
+        if part == self.path(key) + ".part":
+            with self._lock:
+                self._parts.discard(key)
+            return
+        try:
+            os.remove(part)
+        except OSError:
+            pass
+
+    def get(self, key, dest):
+        """
+        Met le fichier key du cache en dest. Retourne False s'il est absent
+        ou si son contenu ne correspond plus à son empreinte.
+        """
+        filename = self.path(key)
+        if not os.path.isfile(filename):
+            return False
+        if file_hash(filename, self.hash_type) != key:
+            logger.warning(f"package cache : {key} is corrupted, it is removed")
+            self.discard(key)
+            return False
+        self._link(filename, dest)
+        now = time.time()
+        os.utime(filename, (now, now))
+        return True
+
+    def add(self, key, part, dest):
+        """
+        Range le téléchargement part sous key et le met en dest. Retourne
+        False, sans toucher à part, si son contenu ne correspond pas à key.
+        """
+        if file_hash(part, self.hash_type) != key:
+            return False
+        os.replace(part, self.path(key))
+        self._link(self.path(key), dest)
+        return True
+
+    def discard(self, key):
+        for filename in [self.path(key), self.path(key) + ".part"]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _link(source, dest):
+        if os.path.exists(dest):
+            os.remove(dest)
+        try:
+            os.link(source, dest)
+        except OSError:
+            shutil.copy2(source, dest)
+
+    def prune(self):
+        """
+        Supprime les fichiers les moins récemment utilisés au-delà de max_size.
+        """
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                # un .part peut être libéré ou renommé par add entre
+                # listdir et stat
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+            size = sum(entry[1] for entry in entries)
+            for _, filesize, name in sorted(entries):
+                if size <= self.max_size:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                    size -= filesize
+                except OSError:
+                    pass
+
+
+class Transfer:
+    """
+    Un fichier à télécharger : la réponse est écrite à la suite de part,
+    à partir de l'octet offset.
+    """
+
+    def __init__(self, url, part, dest, key=None):
+        self.url = url
+        self.part = part
+        self.dest = dest
+        self.key = key
+        self.attempts = 0
+        self.offset = 0
+        self.output = None
+        self.status = None
+
+    def start(self, handle):
+        self.attempts += 1
+        self.status = None
+        self.offset = os.path.getsize(self.part) if os.path.isfile(self.part) else 0
+        self.output = open(self.part, "ab")
+        handle.setopt(pycurl.URL, self.url.replace(" ", "%20"))
+        handle.setopt(pycurl.HEADERFUNCTION, self.header)
+        handle.setopt(pycurl.WRITEFUNCTION, self.write)
+        handle.setopt(pycurl.RESUME_FROM_LARGE, self.offset)
+
+    def header(self, line):
+        if line.startswith(b"HTTP/"):
+            self.status = int(line.split()[1])
+            if self.status == 200 and self.offset:
+                # le serveur ignore la reprise et renvoie tout le fichier
+                self.offset = 0
+                self.output.seek(0)
+                self.output.truncate()
+
+    def write(self, data):
+        self.output.write(data)
+
+    def close(self):
+        if self.output is not None:
+            self.output.close()
+            self.output = None
+
+
+class MultiDownloader:
+    """
+    Télécharge des fichiers en parallèle avec un CurlMulti.
+
+    Le CurlMulti et ses poignées Curl sont gardés d'un appel à l'autre dans
+    chaque thread : les connexions et les sessions TLS vers le serveur de
+    package sont réutilisées.
+    """
+
+    def __init__(self, parallel=4, retries=2, insecure=True):
+        self.parallel = max(1, parallel)
+        self.retries = retries
+        self.insecure = insecure
+        self._local = threading.local()
+
+    def _handles(self):
+        if not hasattr(self._local, "multi"):
+            self._local.multi = pycurl.CurlMulti()
+            self._local.free = []
+        while len(self._local.free) < self.parallel:
+            handle = pycurl.Curl()
+            if self.insecure:
+                handle.setopt(pycurl.SSL_VERIFYPEER, 0)
+                handle.setopt(pycurl.SSL_VERIFYHOST, 0)
+            handle.setopt(pycurl.FAILONERROR, 1)
+            handle.setopt(pycurl.NOSIGNAL, 1)
+            self._local.free.append(handle)
+        return self._local.multi, self._local.free
+
+    def download(self, transfers, headers=None, limit_rate_ko=0):
+        """
+        Télécharge les transfers. Un transfert en échec est repris depuis
+        son .part jusqu'à retries fois.
+
+        Retourne la liste des (transfer, message d'erreur) en échec.
+        """
+        if not transfers:
+            return []
+        multi, free = self._handles()
+        waiting = list(transfers)
+        running = {}
+        failed = []
+        rate = 0
+        if limit_rate_ko:
+            # la limite du package est partagée entre les téléchargements
+            rate = max(1, int(limit_rate_ko) * 1024 // min(self.parallel, len(waiting)))
+
+        while waiting or running:
+            while waiting and free:
+                transfer = waiting.pop(0)
+                handle = free.pop()
+                handle.setopt(pycurl.HTTPHEADER, headers or [])
+                handle.setopt(pycurl.MAX_RECV_SPEED_LARGE, rate)
+                try:
+                    transfer.start(handle)
+                except OSError as e:
+                    transfer.close()
+                    free.append(handle)
+                    failed.append((transfer, str(e)))
+                    continue
+                multi.add_handle(handle)
+                running[handle] = transfer
+
+            ret, _ = multi.perform()
+            while ret == pycurl.E_CALL_MULTI_PERFORM:
+                ret, _ = multi.perform()
+            ok_list, err_list = [], []
+            num_q = 1
+            while num_q:
+                num_q, ok, err = multi.info_read()
+                ok_list.extend(ok)
+                err_list.extend(err)
+            for handle in ok_list:
+                multi.remove_handle(handle)
+                running.pop(handle).close()
+                free.append(handle)
+            for handle, errno, errmsg in err_list:
+                multi.remove_handle(handle)
+                transfer = running.pop(handle)
+                transfer.close()
+                free.append(handle)
+                if transfer.status == 416:
+                    # le .part est déjà complet
+                    continue
+                if (
+                    transfer.status is None or not 400 <= transfer.status < 500
+                ) and transfer.attempts <= self.retries:
+                    logger.warning(
+                        f"download of {transfer.url} interrupted ({errmsg}), resuming"
+                    )
+                    waiting.append(transfer)
+                else:
+                    failed.append((transfer, errmsg))
+            if running:
+                multi.select(1.0)
+        return failed
@@ -0,0 +1,151 @@
+# -*- coding: utf-8; -*-
+# SPDX-FileCopyrightText: 2016-2023 Siveo <support@siveo.net>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import ast
+import hashlib
+import json
+import logging
+import os
+import threading
+import traceback
+
+logger = logging.getLogger()
+
+
+class PluginManifest:
+    """
+    Manifeste des fichiers de l'agent : empreinte md5 et dictionnaire
+    plugin (NAME, VERSION, ...) de chaque fichier.
+
+    Chaque entrée est conservée sous le chemin du fichier avec la signature
+    (mtime, taille) au moment de la lecture. Le fichier n'est relu que si
+    cette signature change ou après un appel à invalidate() (installplugin,
+    updateagent). Le dictionnaire plugin est lu dans l'arbre syntaxique du
+    fichier, sans importer le plugin.
+
+    Le manifeste est sauvegardé dans pluginmanifest.json par save(), et
+    rechargé au démarrage de l'agent.
+    """
+
+    def __init__(self, pathfile=None):
+        self.pathfile = pathfile
+        self._files = {}
+        self._changed = False
+        self._lock = threading.Lock()
+        if pathfile is not None:
+            self.load()
+
+    @staticmethod
+    def _signature(filename):
+        stat = os.stat(filename)
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def load(self):
+        try:
+            with open(self.pathfile) as manifest:
+                self._files = json.load(manifest)
+        except (OSError, ValueError):
+            self._files = {}
+
+    def save(self):
+        """
+        Écrit le manifeste s'il a changé depuis la dernière sauvegarde.
+        """
+        if self.pathfile is None or not self._changed:
+            return
+        with self._lock:
+            self._files = {
+                filename: entry
+                for filename, entry in self._files.items()
+                if os.path.isfile(filename)
+            }
+            files = dict(self._files)
+            self._changed = False
+        try:
+            tmp = self.pathfile + ".tmp"
+            with open(tmp, "w") as manifest:
+                json.dump(files, manifest)
+            os.replace(tmp, self.pathfile)
+        except OSError:
+            logger.error(f"{traceback.format_exc()}")
+
+    def _entry(self, filename):
+        filename = os.path.abspath(filename)
+        signature = self._signature(filename)
+        with self._lock:
+            entry = self._files.get(filename)
+            if entry is None or entry["signature"] != signature:
+                entry = {"signature": signature}
+                self._files[filename] = entry
+                self._changed = True
+        return entry
+
+    def md5(self, filename):
+        """
+        Retourne l'empreinte md5 du fichier.
+        """
+        entry = self._entry(filename)
+        if "md5" not in entry:
+            with open(filename, "rb") as content:
+                entry["md5"] = hashlib.md5(content.read()).hexdigest()
+            self._changed = True
+        return entry["md5"]
+
+    def plugin(self, filename):
+        """
+        Retourne le dictionnaire plugin du fichier, ou None s'il est illisible.
+        """
+        entry = self._entry(filename)
+        if "plugin" not in entry:
+            entry["plugin"] = None
+            try:
+                with open(filename, "rb") as content:
+                    tree = ast.parse(content.read(), filename)
+                for node in tree.body:
+                    if (
+                        isinstance(node, ast.Assign)
+                        and len(node.targets) == 1
+                        and isinstance(node.targets[0], ast.Name)
+                        and node.targets[0].id == "plugin"
+                    ):
+                        entry["plugin"] = ast.literal_eval(node.value)
+                        break
+            except Exception as e:
+                logger.error(
+                    f"error reading plugin {filename} : {str(e)} verify plugin {filename}"
+                )
+            self._changed = True
+        return entry["plugin"]
+
+    def versions(self, directory, prefix):
+        """
+        Retourne {NAME: VERSION} des plugins prefix*.py du répertoire.
+        """
+        result = {}
+        for element in os.listdir(directory):
+            if element.endswith(".py") and element.startswith(prefix):
+                plugin = self.plugin(os.path.join(directory, element))
+                if plugin is not None and "NAME" in plugin and "VERSION" in plugin:
+                    result[plugin["NAME"]] = plugin["VERSION"]
+        return result
+
+    def invalidate(self, filename=None):
+        """
+        Oublie l'entrée d'un fichier, ou de tous les fichiers si filename est None.
+        """
+        with self._lock:
+            if filename is None:
+                self._files.clear()
+            else:
+                self._files.pop(os.path.abspath(filename), None)
+            self._changed = True
+
+
+plugin_manifest = PluginManifest(
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), "..", "pluginmanifest.json"
+        )
+    )
+)
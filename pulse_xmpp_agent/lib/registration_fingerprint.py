@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; -*-
+# SPDX-FileCopyrightText: 2016-2023 Siveo <support@siveo.net>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+Fingerprint of the registration message (action infomachine).
+
+The agent adds to its registration a md5 of each section of the message,
+in the key registration_fingerprint. The substitute compares it with the
+fingerprint of the last registration it fully processed for this machine,
+and only rewrites the sections whose hash changed.
+"""
+
+import base64
+import hashlib
+import json
+
+# sections of the registration message, by key of the message. The keys of
+# completedatamachine are prefixed with "information.". The keys not listed
+# here are in the section "machine".
+SECTIONS = {
+    "agent": [
+        "versionagent",
+        "md5agentversion",
+        "md5agent",
+        "updatingagent",
+        "md5_conf_monitoring",
+    ],
+    "plugins": ["plugin", "pluginscheduled"],
+    "deployment": ["deployment", "who", "baseurlguacamole"],
+    "network": [
+        "xmppip",
+        "xmppmask",
+        "xmppbroadcast",
+        "xmppdhcp",
+        "xmppdhcpserver",
+        "xmppgateway",
+        "xmppmacaddress",
+        "xmppmacnotshortened",
+        "subnetxmpp",
+        "ipconnection",
+        "portconnection",
+        "portxmpp",
+        "serverxmpp",
+        "ippublic",
+        "information.listipinfo",
+        "information.listdns",
+        "information.dhcp",
+        "information.dhcpinfo",
+        "information.dnshostname",
+    ],
+    "users": [
+        "lastusersession",
+        "adorgbyuser",
+        "adorgbymachine",
+        "adusergroups",
+        "kiosk_presence",
+        "geolocalisation",
+        "information.users",
+    ],
+}
+DEFAULT_SECTION = "machine"
+
+# keys changing at each start of the agent, or decided by the agent at each
+# registration: they do not describe the machine.
+VOLATILE = ["countstart", "regcomplet", "registration_fingerprint"]
+
+_section_of = {key: section for section, keys in SECTIONS.items() for key in keys}
+
+
+def registration_fingerprint(dataobj):
+    """
+    Returns {section: md5} for the registration message dataobj.
+    """
+    values = {}
+    for key, value in dataobj.items():
+        if key in VOLATILE:
+            continue
+        if key == "completedatamachine":
+            information = json.loads(base64.b64decode(value))
+            for subkey, subvalue in information.items():
+                subkey = "information.%s" % subkey
+                section = _section_of.get(subkey, DEFAULT_SECTION)
+                values.setdefault(section, {})[subkey] = subvalue
+            continue
+        values.setdefault(_section_of.get(key, DEFAULT_SECTION), {})[key] = value
+    return {
+        section: hashlib.md5(
+            json.dumps(content, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+        for section, content in values.items()
+    }
+
+
+def changed_sections(fingerprint, previous):
+    """
+    Returns the set of the sections that differ between two fingerprints.
+    """
+    return {
+        section
+        for section in set(fingerprint) | set(previous)
+        if fingerprint.get(section) != previous.get(section)
+    }
@@ -0,0 +1,87 @@
+# -*- coding: utf-8; -*-
+# SPDX-FileCopyrightText: 2016-2023 Siveo <support@siveo.net>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import logging
+import threading
+import traceback
+
+logger = logging.getLogger()
+
+# evenements syncthing qui peuvent marquer la fin du transfert d'un partage
+EVENTS = "StateChanged,FolderSummary"
+
+
+def folder_complete(status):
+    """
+    Indique si le statut /db/status d'un partage est celui d'un transfert
+    terminé : le partage est au repos, ne manque d'aucun fichier et a reçu
+    l'index de l'ARS.
+    """
+    return (
+        isinstance(status, dict)
+        and status.get("state") == "idle"
+        and status.get("needTotalItems", 1) == 0
+        and status.get("globalFiles", 0) > 0
+    )
+
+
+class SyncthingDeployWatcher(threading.Thread):
+    """
+    Suit le flux d'événements de syncthing (/rest/events) et appelle
+    callback(folder) dès qu'un partage change d'état.
+
+    La requête des événements est bloquante côté syncthing (long polling,
+    timeout secondes) : le thread ne consomme rien tant qu'aucun partage
+    n'évolue. Si syncthing redémarre, le suivi reprend au dernier
+    événement du nouveau flux.
+    """
+
+    def __init__(self, syncthing, callback, timeout=60, retry=10):
+        threading.Thread.__init__(self, name="syncthingwatch", daemon=True)
+        self.syncthing = syncthing
+        self.callback = callback
+        self.timeout = timeout
+        self.retry = retry
+        self.since = 0
+        self.stopevent = threading.Event()
+
+    def stop(self):
+        self.stopevent.set()
+
+    def _folders(self, events):
+        folders = []
+        for event in events:
+            data = event.get("data") or {}
+            folder = data.get("folder")
+            if folder is None or folder in folders:
+                continue
+            if event["type"] == "StateChanged" and data.get("to") != "idle":
+                continue
+            folders.append(folder)
+        return folders
+
+    def run(self):
+        while not self.stopevent.is_set():
+            try:
+                events = self.syncthing.get_events(
+                    since=self.since, eventslist=EVENTS, timeout=self.timeout
+                )
+                if not events:
+                    # syncthing a pu redémarrer : ses identifiants repartent de 1
+                    latest = self.syncthing.get_events(since=0, limit=1, timeout=1)
+                    if latest and latest[-1]["id"] < self.since:
+                        self.since = latest[-1]["id"]
+                    continue
+            except Exception:
+                logger.warning(
+                    f"syncthing events are not available, retry in {self.retry} s"
+                )
+                self.stopevent.wait(self.retry)
+                continue
+            self.since = events[-1]["id"]
+            for folder in self._folders(events):
+                try:
+                    self.callback(folder)
+                except Exception:
+                    logger.error("\n%s" % (traceback.format_exc()))
@@ -5,7 +5,8 @@
 import hashlib
 import os
 import logging
-from .utils import file_get_contents, simplecommand, file_get_binarycontents
+from .utils import file_get_contents, simplecommand
+from .plugin_manifest import plugin_manifest
 import json
 
 import sys
@@ -90,6 +91,8 @@ class Update_Remote_Agent:
     def load_list_md5_agentbase(self):
         """
         This function fill the directory structure with the values
+        The md5 of the files come from the plugin manifest, they are only
+        computed again for the files modified since the last call.
         """
         self.directory = {
             "program_agent": {},
@@ -117,31 +120,27 @@ class Update_Remote_Agent:
         ]
 
         for filename in list_script_python_for_update:
-            self.directory["program_agent"][filename] = hashlib.md5(
-                file_get_binarycontents(os.path.join(self.dir_agent_base, filename))
-            ).hexdigest()
+            self.directory["program_agent"][filename] = plugin_manifest.md5(
+                os.path.join(self.dir_agent_base, filename)
+            )
             listmd5.append(self.directory["program_agent"][filename])
         for filename in [
             x
             for x in os.listdir(os.path.join(self.dir_agent_base, "lib"))
             if x[-3:] == ".py"
         ]:
-            self.directory["lib_agent"][filename] = hashlib.md5(
-                file_get_binarycontents(
-                    os.path.join(self.dir_agent_base, "lib", filename)
-                )
-            ).hexdigest()
+            self.directory["lib_agent"][filename] = plugin_manifest.md5(
+                os.path.join(self.dir_agent_base, "lib", filename)
+            )
             listmd5.append(self.directory["lib_agent"][filename])
         for filename in [
             x
             for x in os.listdir(os.path.join(self.dir_agent_base, "script"))
             if x[-4:] == ".ps1"
         ]:
-            self.directory["script_agent"][filename] = hashlib.md5(
-                file_get_binarycontents(
-                    os.path.join(self.dir_agent_base, "script", filename)
-                )
-            ).hexdigest()
+            self.directory["script_agent"][filename] = plugin_manifest.md5(
+                os.path.join(self.dir_agent_base, "script", filename)
+            )
             listmd5.append(self.directory["script_agent"][filename])
         listmd5.sort()
         self.directory["fingerprint"] = hashlib.md5(
@@ -9,7 +9,6 @@ import sys
 import os
 import socket
 import logging
-import pycurl
 import platform
 import urllib.request
 import urllib.parse
@@ -19,6 +18,7 @@ from lib.utils import file_get_contents
 from distutils.util import strtobool
 from urllib.parse import urlparse
 from lib import utils, managepackage, grafcetdeploy
+from lib.package_cache import PackageCache, MultiDownloader, Transfer
 from lib.agentconffile import (
     conffilename,
     medullaPath,
@@ -32,6 +32,7 @@ import traceback
 import time
 from subprocess import STDOUT, check_output
 import asyncio
+import threading
 
 if sys.platform == "win32":
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
@@ -43,9 +44,10 @@ if sys.platform.startswith("linux") or sys.platform.startswith("darwin"):
 elif sys.platform.startswith("win"):
     import win32net
 
-plugin = {"VERSION": "6.0", "NAME": "applicationdeploymentjson", "VERSIONAGENT": "2.0.0", "TYPE": "all"}  # fmt: skip
+plugin = {"VERSION": "6.3", "NAME": "applicationdeploymentjson", "VERSIONAGENT": "2.0.0", "TYPE": "all"}  # fmt: skip
 
 Globaldata = {"port_local": 22}
+package_cache_lock = threading.Lock()
 logger = logging.getLogger()
 DEBUGPULSEPLUGIN = 25
 """
@@ -2820,33 +2822,35 @@ def initialisesequence(datasend, objectxmpp, sessionid):
     logger.debug("outing graphcet end initiation")
 
 
-def curlgetdownloadfile(
-    destfile, urlfile, insecure=True, token=None, limit_rate_ko=None
-):
-    # As long as the file is opened in binary mode, both Python 2 and Python 3
-    # can write response body to it without decoding.
-    with open(destfile, "wb") as f:
-        if token is not None:
-            headers = ["X-Authorization: " + token]
-        c = pycurl.Curl()
-        urlfile = urlfile.replace(" ", "%20")
-        c.setopt(c.URL, urlfile)
-        c.setopt(c.WRITEDATA, f)
-        c.setopt(pycurl.HTTPHEADER, headers)
-        try:
-            limit_rate_ko = int(limit_rate_ko)
-        except:
-            limit_rate_ko = 0
-
-        if limit_rate_ko is not None and limit_rate_ko != "" and int(limit_rate_ko) > 0:
-            # limit_rate_ko en octed in curl
-            c.setopt(c.MAX_RECV_SPEED_LARGE, int(limit_rate_ko) * 1024)
-        if insecure:
-            # option equivalent a friser de --insecure
-            c.setopt(pycurl.SSL_VERIFYPEER, 0)
-            c.setopt(pycurl.SSL_VERIFYHOST, 0)
-        c.perform()
-        c.close()
+def package_downloader(objectxmpp):
+    """
+    Retourne le cache des fichiers de package (None s'il est désactivé) et
+    le téléchargeur pullcurl de l'agent.
+    """
+    with package_cache_lock:
+        if not hasattr(objectxmpp, "package_downloader"):
+            objectxmpp.package_cache = None
+            if not hasattr(objectxmpp.config, "package_cache") or bool(
+                strtobool(objectxmpp.config.package_cache)
+            ):
+                size = 4096
+                if hasattr(objectxmpp.config, "package_cache_size"):
+                    size = int(objectxmpp.config.package_cache_size)
+                try:
+                    objectxmpp.package_cache = PackageCache(
+                        os.path.join(
+                            os.path.dirname(managepackage.managepackage.packagedir()),
+                            "packagecache",
+                        ),
+                        max_size=size * 1024 * 1024,
+                    )
+                except OSError:
+                    logger.error("\n%s" % (traceback.format_exc()))
+            parallel = 4
+            if hasattr(objectxmpp.config, "download_parallel"):
+                parallel = int(objectxmpp.config.download_parallel)
+            objectxmpp.package_downloader = MultiDownloader(parallel=parallel)
+    return objectxmpp.package_cache, objectxmpp.package_downloader
 
 
 def pull_package_transfert_rsync(
@@ -3020,36 +3024,32 @@ def recuperefile(datasend, objectxmpp, ippackage, portpackage, sessionid):
         fromuser=datasend["data"]["advanced"]["login"],
     )
 
-    for filepackage in datasend["data"]["packagefile"]:
-        if datasend["data"]["methodetransfert"] == "pullcurl":
+    if (
+        "limit_rate_ko" in datasend["data"]["descriptor"]["info"]
+        and datasend["data"]["descriptor"]["info"]["limit_rate_ko"] != ""
+        and int(datasend["data"]["descriptor"]["info"]["limit_rate_ko"]) > 0
+    ):
+        limit_rate_ko = int(datasend["data"]["descriptor"]["info"]["limit_rate_ko"])
+    else:
+        limit_rate_ko = 0
+
+    # les fichiers dont l'empreinte est connue passent par le cache : seuls
+    # ceux qui n'y sont pas encore sont telecharges
+    cache, downloader = package_downloader(objectxmpp)
+    fileshash = {}
+    if cache is not None and "packagefilehash" in datasend["data"]:
+        fileshash = datasend["data"]["packagefilehash"]
+    transfers = []
+    parts = []
+    failed = []
+    try:
+        for filepackage in datasend["data"]["packagefile"]:
             dest = os.path.join(datasend["data"]["pathpackageonmachine"], filepackage)
-            urlfile = curlurlbase + filepackage
-
-            logger.info("###################################################")
-            logger.info("URL for downloading package using curl : " + urlfile)
-            logger.info("###################################################")
-            try:
-                if (
-                    "limit_rate_ko" in datasend["data"]["descriptor"]["info"]
-                    and datasend["data"]["descriptor"]["info"]["limit_rate_ko"] != ""
-                    and int(datasend["data"]["descriptor"]["info"]["limit_rate_ko"]) > 0
-                ):
-                    limit_rate_ko = datasend["data"]["descriptor"]["info"][
-                        "limit_rate_ko"
-                    ]
-                    msg = "Downloading file : %s Package : %s [transfer rate %s ko]" % (
-                        filepackage,
-                        datasend["data"]["name"],
-                        limit_rate_ko,
-                    )
-                else:
-                    limit_rate_ko = ""
-                    msg = "Downloading file : %s Package : %s" % (
-                        filepackage,
-                        datasend["data"]["name"],
-                    )
+            key = fileshash.get(filepackage)
+            if key is not None and cache.get(key, dest):
                 objectxmpp.xmpplog(
-                    msg,
+                    "File %s Package %s found in the package cache"
+                    % (filepackage, datasend["data"]["name"]),
                     type="deploy",
                     sessionname=datasend["sessionid"],
                     priority=-1,
@@ -3059,39 +3059,119 @@ def recuperefile(datasend, objectxmpp, ippackage, portpackage, sessionid):
                     date=None,
                     fromuser=datasend["data"]["advanced"]["login"],
                 )
-                curlgetdownloadfile(
-                    dest, urlfile, insecure=True, limit_rate_ko=limit_rate_ko
+                continue
+            urlfile = curlurlbase + filepackage
+            logger.debug("URL for downloading package using curl : " + urlfile)
+            if limit_rate_ko > 0:
+                msg = "Downloading file : %s Package : %s [transfer rate %s ko]" % (
+                    filepackage,
+                    datasend["data"]["name"],
+                    limit_rate_ko,
                 )
-                changown_dir_of_file(dest)  # owner pulseuser.
-            except Exception as e:
-                logger.error("\n%s" % (traceback.format_exc()))
-                logger.debug(str(e))
-                objectxmpp.xmpplog(
-                    '<span class="log_err">Transfer error : curl download [%s] package file: %s</span>'
-                    % (curlurlbase, filepackage),
-                    type="deploy",
-                    sessionname=datasend["sessionid"],
-                    priority=-1,
-                    action="xmpplog",
-                    who=strjidagent,
-                    module="Deployment | Download | Transfer | Notify | Error",
-                    date=None,
-                    fromuser=datasend["data"]["name"],
+            else:
+                msg = "Downloading file : %s Package : %s" % (
+                    filepackage,
+                    datasend["data"]["name"],
                 )
-                objectxmpp.xmpplog(
-                    "DEPLOYMENT TERMINATE",
-                    type="deploy",
-                    sessionname=datasend["sessionid"],
-                    priority=-1,
-                    action="xmpplog",
-                    who=strjidagent,
-                    module="Deployment | Error | Terminate | Notify",
-                    date=None,
-                    fromuser=datasend["data"]["name"],
+            objectxmpp.xmpplog(
+                msg,
+                type="deploy",
+                sessionname=datasend["sessionid"],
+                priority=-1,
+                action="xmpplog",
+                who=strjidagent,
+                module="Deployment | Download | Transfer",
+                date=None,
+                fromuser=datasend["data"]["advanced"]["login"],
+            )
+            if key is not None:
+                part = cache.part(key)
+                parts.append((key, part))
+            else:
+                # sans empreinte, un .part repris ne peut pas etre verifie
+                part = dest + ".part"
+                if os.path.exists(part):
+                    os.remove(part)
+            transfers.append(Transfer(urlfile, part, dest, key))
+
+        failed = [
+            transfer.dest
+            for transfer, _ in downloader.download(
+                transfers, limit_rate_ko=limit_rate_ko
+            )
+        ]
+        # un .part repris qui ne correspond pas a son empreinte est
+        # retelecharge entierement une fois
+        invalid = []
+        for transfer in transfers:
+            if transfer.dest in failed or transfer.key is None:
+                continue
+            if not cache.add(transfer.key, transfer.part, transfer.dest):
+                os.remove(transfer.part)
+                transfer.attempts = 0
+                invalid.append(transfer)
+        failed.extend(
+            transfer.dest
+            for transfer, _ in downloader.download(invalid, limit_rate_ko=limit_rate_ko)
+        )
+        for transfer in transfers:
+            if transfer.dest in failed:
+                continue
+            if transfer in invalid and not cache.add(
+                transfer.key, transfer.part, transfer.dest
+            ):
+                # le fichier du serveur de package n'est pas celui du
+                # substitute : il est utilise sans passer par le cache
+                logger.warning(
+                    "%s does not match its hash, it is not cached" % transfer.url
                 )
-                removeresource(datasend, objectxmpp, sessionid)
-                signalendsessionforARS(datasend, objectxmpp, sessionid, error=True)
-                return False
+                transfer.key = None
+            if transfer.key is None:
+                shutil.move(transfer.part, transfer.dest)
+    except Exception as e:
+        logger.error("\n%s" % (traceback.format_exc()))
+        logger.debug(str(e))
+        failed = [transfer.dest for transfer in transfers] or [
+            datasend["data"]["pathpackageonmachine"]
+        ]
+    finally:
+        for key, part in parts:
+            cache.release(key, part)
+    # le menage du cache suit la decision : il ne peut pas faire echouer un
+    # telechargement reussi
+    if cache is not None:
+        cache.prune()
+    if failed:
+        for dest in failed:
+            objectxmpp.xmpplog(
+                '<span class="log_err">Transfer error : curl download [%s] package file: %s</span>'
+                % (curlurlbase, os.path.basename(dest)),
+                type="deploy",
+                sessionname=datasend["sessionid"],
+                priority=-1,
+                action="xmpplog",
+                who=strjidagent,
+                module="Deployment | Download | Transfer | Notify | Error",
+                date=None,
+                fromuser=datasend["data"]["name"],
+            )
+        objectxmpp.xmpplog(
+            "DEPLOYMENT TERMINATE",
+            type="deploy",
+            sessionname=datasend["sessionid"],
+            priority=-1,
+            action="xmpplog",
+            who=strjidagent,
+            module="Deployment | Error | Terminate | Notify",
+            date=None,
+            fromuser=datasend["data"]["name"],
+        )
+        removeresource(datasend, objectxmpp, sessionid)
+        signalendsessionforARS(datasend, objectxmpp, sessionid, error=True)
+        return False
+    changown_dir_of_file(
+        os.path.join(datasend["data"]["pathpackageonmachine"], "")
+    )  # owner pulseuser.
     removeresource(datasend, objectxmpp, sessionid)
     signalendsessionforARS(datasend, objectxmpp, sessionid, error=False)
     return True
@@ -10,7 +10,7 @@ import traceback
 from lib import utils, managepackage
 from slixmpp import jid
 
-plugin = {"VERSION": "2.02", "VERSIONAGENT": "2.1", "NAME": "deploysyncthing", "TYPE": "all"}  # fmt: skip
+plugin = {"VERSION": "2.03", "VERSIONAGENT": "2.1", "NAME": "deploysyncthing", "TYPE": "all"}  # fmt: skip
 
 logger = logging.getLogger()
 DEBUGPULSEPLUGIN = 25
@@ -97,6 +97,8 @@ def action(objectxmpp, action, sessionid, data, message, dataerreur):
                     fromuser="",
                     touser="",
                 )
+                # le partage a pu etre recu avant le fichier .ars
+                objectxmpp.syncthing_deploy(data["objpartage"]["repertoiredeploy"])
             elif data["subaction"] == "cleandeploy":
                 if not objectxmpp.config.syncthing_on:
                     return
@@ -5,9 +5,10 @@
 import os
 import logging
 import json
-from lib.utils import set_logging_level
+from lib.utils import set_logging_level, plugin_registry
+from lib.plugin_manifest import plugin_manifest
 
-plugin = {"VERSION": "1.27", "NAME": "installplugin", "TYPE": "all"}  # fmt: skip
+plugin = {"VERSION": "1.29", "NAME": "installplugin", "TYPE": "all"}  # fmt: skip
 
 
 @set_logging_level
@@ -20,6 +21,8 @@ def action(objectxmpp, action, sessionid, data, message, dataerreur):
         try:
             with open(namefile, "w") as fileplugin:
                 fileplugin.write(str(data["datafile"]))
+            plugin_registry.invalidate(namefile)
+            plugin_manifest.invalidate(namefile)
             dataerreur["ret"] = 0
             dataerreur["data"][
                 "msg"
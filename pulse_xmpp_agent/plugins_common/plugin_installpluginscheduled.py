@@ -4,12 +4,13 @@
 
 import os
 from lib.utils import set_logging_level
+from lib.plugin_manifest import plugin_manifest
 
 import logging
 
 logger = logging.getLogger()
 DEBUGPULSEPLUGIN = 25
-plugin = {"VERSION": "1.1", "NAME": "installpluginscheduled", "TYPE": "all"}  # fmt: skip
+plugin = {"VERSION": "1.2", "NAME": "installpluginscheduled", "TYPE": "all"}  # fmt: skip
 
 
 @set_logging_level
@@ -31,6 +32,7 @@ def action(objetxmpp, action, sessionid, data, message, dataerreur):
             try:
                 with open(namefile, "w") as fileplugin:
                     fileplugin.write(str(data["datafile"]))
+                plugin_manifest.invalidate(namefile)
             except BaseException:
                 print("Error: cannor write on file")
                 return
@@ -10,8 +10,9 @@ import zlib
 import base64
 import traceback
 from lib import utils, update_remote_agent
+from lib.plugin_manifest import plugin_manifest
 
-plugin = {"VERSION": "2.3", "VERSIONAGENT": "2.0", "NAME": "updateagent", "TYPE": "all", "waittingmax": 35, "waittingmin": 5}  # fmt: skip
+plugin = {"VERSION": "2.4", "VERSIONAGENT": "2.0", "NAME": "updateagent", "TYPE": "all", "waittingmax": 35, "waittingmin": 5}  # fmt: skip
 
 logger = logging.getLogger()
 DEBUGPULSEPLUGIN = 25
@@ -302,6 +303,7 @@ def dump_file_in_img(objectxmpp, namescript, content, typescript):
         try:
             with open(file_name, "wb") as filescript:
                 filescript.write(content)
+            plugin_manifest.invalidate(file_name)
 
             # Update the remote agent
             newobjdescriptorimage = update_remote_agent.Update_Remote_Agent(
@@ -5,6 +5,7 @@
 from xml.etree import ElementTree
 from lib import utils
 from lib.utils import convert
+from lib import inventorydelta
 import os
 import sys
 import platform
@@ -36,7 +37,7 @@ from slixmpp import jid
 DEBUGPULSEPLUGIN = 25
 ERRORPULSEPLUGIN = 40
 WARNINGPULSEPLUGIN = 30
-plugin = {"VERSION": "3.75", "NAME": "inventory", "TYPE": "machine"}  # fmt: skip
+plugin = {"VERSION": "3.77", "NAME": "inventory", "TYPE": "machine"}  # fmt: skip
 
 
 @utils.set_logging_level
@@ -659,6 +660,8 @@ def action(xmppobject, action, sessionid, data, message, dataerreur):
                 )
             return
 
+    if "inventory" in result["data"] and (data["forced"] == "forced" or boolchange):
+        inventory_delta(xmppobject, result, full=data.get("full", False))
     if result["base64"] is True:
         result["data"] = base64.b64encode(json.dumps(result["data"]))
     if data["forced"] == "forced" or boolchange:
@@ -775,6 +778,52 @@ def compact_xml(inputfile, graine=""):
     return strinventorysave, True
 
 
+def inventory_delta(xmppobject, result, full=False):
+    """
+    Remplace l'inventaire complet de result par les seules sections qui ont
+    changé depuis le dernier inventaire envoyé.
+
+    Le différentiel n'est envoyé que si inventory_delta est à True dans
+    inventory.ini : un substitut d'inventaire qui ne sait pas le reconstruire
+    ne reçoit que des inventaires complets. L'inventaire complet est aussi
+    gardé si le substitut le demande (full) ou si aucun inventaire n'a encore
+    été envoyé : il sert de base aux différentiels suivants.
+    """
+    namefilesections = os.path.join(Setdirectorytempinfo(), "inventorysections")
+    if str(getattr(xmppobject.config, "inventory_delta", "False")).lower() != "true":
+        if os.path.exists(namefilesections):
+            os.remove(namefilesections)
+        return
+    content = convert.decompress_and_encode(result["data"]["inventory"])
+    try:
+        inventory = inventorydelta.split_inventory(content)
+        if inventorydelta.join_inventory(inventory) != content:
+            raise inventorydelta.InventoryDeltaError("the inventory cannot be rebuilt")
+    except inventorydelta.InventoryDeltaError as e:
+        logger.warning(f"the complete inventory is sent : {e}")
+        if os.path.exists(namefilesections):
+            os.remove(namefilesections)
+        return
+    previous = None
+    if not full and os.path.exists(namefilesections):
+        try:
+            previous = json.loads(utils.file_get_contents(namefilesections))
+        except ValueError:
+            previous = None
+    utils.file_put_contents_w_a(
+        namefilesections, json.dumps(inventorydelta.section_hashes(inventory))
+    )
+    if previous is None:
+        return
+    delta = inventorydelta.make_delta(inventory, previous)
+    del result["data"]["inventory"]
+    result["data"]["inventory_delta"] = convert.compress_and_encode(json.dumps(delta))
+    logger.debug(
+        f"sections {list(delta['sections'])} changed, "
+        f"{len(result['data']['inventory_delta'])} bytes are sent"
+    )
+
+
 def extend_xmlfile(xmppobject):
     """
     generation xml extend from json
@@ -7,7 +7,7 @@ import logging
 logger = logging.getLogger()
 
 DEBUGPULSEPLUGIN = 25
-plugin = {"VERSION": "1.14", "NAME": "cluster", "VERSIONAGENT": "2.0.0", "TYPE": "relayserver", "DESC": "update list ARS cluster"}  # fmt: skip
+plugin = {"VERSION": "1.15", "NAME": "cluster", "VERSIONAGENT": "2.0.0", "TYPE": "relayserver", "DESC": "update list ARS cluster"}  # fmt: skip
 
 
 def refreshremotears(objectxmpp, action, sessionid):
@@ -45,6 +45,7 @@ def action(objectxmpp, action, sessionid, data, message, dataerreur):
         if data["subaction"] == "startmmc":
             objectxmpp.levelcharge["charge"] = 0
             objectxmpp.levelcharge["machinelist"] = []
+            objectxmpp.deploydispatcher.reset()
             logger.debug("start mmc clear charge ARS")
         elif data["subaction"] == "initclusterlist":
             # update list cluster jid
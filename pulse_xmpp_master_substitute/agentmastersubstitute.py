@@ -150,6 +150,9 @@ def doTask(optsconsoledebug, optsdeamon, optfileconf):
     except RuntimeError:
         logging.error("RuntimeError during connection")
     finally:
+        xmpp.manage_scheduler.stop()
+        if getattr(xmpp, "plugin_pool", None) is not None:
+            xmpp.plugin_pool.shutdown(wait=False)
         xmpp.loop.close()
 
 
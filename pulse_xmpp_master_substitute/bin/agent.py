@@ -8,7 +8,6 @@ from slixmpp import ClientXMPP
 from slixmpp import jid
 from slixmpp.xmlstream import handler, matcher
 from slixmpp.exceptions import IqError, IqTimeout
-from slixmpp.xmlstream.stanzabase import ET
 from slixmpp.xmlstream.handler import CoroutineCallback
 from slixmpp.xmlstream.handler import Callback
 from slixmpp.xmlstream.matcher.xpath import MatchXPath
@@ -22,7 +21,7 @@ import slixmpp
 import sys
 import os
 import asyncio
-import zlib
+import functools
 
 if sys.platform == "win32":
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
@@ -42,6 +41,9 @@ from lib.utils import (
     ipfromdns,
     base_message_queue_posix,
 )
+from lib.iq_custom import PendingIqTable, PendingIqResult
+from lib.iq_payload import set_iq_payload, get_iq_payload, peer_encodings
+from lib.bigdata_transfer import BigDataTransfers
 import traceback
 import signal
 from lib.plugins.xmpp import XmppMasterDatabase
@@ -93,7 +95,7 @@ class MUCBot(slixmpp.ClientXMPP):
         # We define the type of the Agent
         self.config.agenttype = "substitute"
         self.manage_scheduler = manage_scheduler(self)
-        self.schedule("schedulerfunction", 10, self.schedulerfunction, repeat=True)
+        self.manage_scheduler.start()
 
         self.agentmaster = jid.JID(self.config.jidmaster)
         self.add_event_handler("register", self.register)
@@ -103,7 +105,10 @@ class MUCBot(slixmpp.ClientXMPP):
         self.add_event_handler("disconnected", self.handle_disconnected)
         self.add_event_handler("session_start", self.start)
         self.add_event_handler("message", self.message)
+        self.add_event_handler("presence_available", self.presence_available)
 
+        # IQ dont la réponse est attendue dans une file POSIX, indexés par id
+        self.datas_send = {}
         self.schedule("Clean_old_queue", 10, self.Clean_old_queue, [200], repeat=True)
         self.add_event_handler(
             "restartmachineasynchrone", self.restartmachineasynchrone
@@ -135,41 +140,16 @@ class MUCBot(slixmpp.ClientXMPP):
         Args:
             jid_receiver (str): Le JID du destinataire.
             data_utf8_json (str): Les données JSON à envoyer, en format UTF-8.
-            segment_size (int, optional): La taille maximale de chaque segment (par défaut: 65535).
+            segment_size (int, optional): La taille maximale de chaque segment (par défaut: 65535),
+                arrondie au multiple de 4 inférieur.
 
         Returns:
             None
         """
         # Vérification si le message est assez gros pour nécessiter un découpage en segments
         if len(data_utf8_json) > segment_size:
-            # Génération d'un identifiant de session
-            sessionid = getRandomName(6, "big_data")
-            # Compression et encodage en base64
-            data_compressed = zlib.compress(data_utf8_json.encode("utf-8"))
-            data_base64 = base64.b64encode(data_compressed).decode("utf-8")
-
-            # Calcul du nombre total de segments nécessaires
-            nb_segments_total = (len(data_base64) + segment_size - 1) // segment_size
-
-            # Envoi des segments
-            for i in range(nb_segments_total):
-                # Découpage des données en segments de taille segment_size
-                segment = data_base64[i * segment_size : (i + 1) * segment_size]
-                # Construction du message
-                message = {
-                    "action": "big_data",  # Action spécifiée pour le plugin à appeler
-                    "sessionid": sessionid,  # Identifiant de session
-                    "data": {
-                        "segment": segment,  # Données de ce segment
-                        "nb_segment": i + 1,  # Numéro du segment actuel
-                        "nb_segment_total": nb_segments_total,  # Nombre total de segments
-                        "from": self.boundjid.full,
-                    },  # JID de l'expéditeur
-                }
-                # Envoi du message à jid_receiver
-                self.send_message(
-                    mto=jid_receiver, mbody=json.dumps(message), mtype="chat"
-                )
+            # Envoi fenêtré avec acquittements (voir lib/bigdata_transfer.py)
+            BigDataTransfers.of(self).send(jid_receiver, data_utf8_json, segment_size)
         else:
             # Envoi direct du message sans découpage
             self.send_message(mto=jid_receiver, mbody=data_utf8_json, mtype="chat")
@@ -181,6 +161,17 @@ class MUCBot(slixmpp.ClientXMPP):
         Args:
             nbsecond: The number of seconds from which we delete the queue
         """
+        t = time.time()
+        for iqid in [
+            iqid for iqid, ta in list(self.datas_send.items()) if ta["time"] < t
+        ]:
+            ta = self.datas_send.pop(iqid, None)
+            if ta is not None:
+                logger.debug("delete queue %s" % ta["name_iq_queue"])
+                try:
+                    posix_ipc.unlink_message_queue(ta["name_iq_queue"])
+                except:
+                    pass
         queue_files = [
             queue_file
             for queue_file in os.listdir("/dev/mqueue")
@@ -265,6 +256,13 @@ class MUCBot(slixmpp.ClientXMPP):
         self._connect_loop_wait = 0
         self.reconnect(nbsecond, "from_handle_connection_failed")
 
+    def presence_available(self, presence):
+        """
+        Un pair revient en ligne : il a pu être mis à jour dans une version qui
+        ne connaît pas le nouveau format des IQ, son encodage est oublié.
+        """
+        peer_encodings.forget(presence["from"])
+
     def handle_disconnected(self, data):
         """
         Gère le scénario où la connexion est déconnectée.
@@ -449,6 +447,27 @@ class MUCBot(slixmpp.ClientXMPP):
     # ---------------------- END analyse strophe xmpp -----------------------
     # -----------------------------------------------------------------------
 
+    def send_message(self, *args, **kwargs):
+        """
+        Envoie un message stanza XMPP.
+
+        Appelée hors de la boucle slixmpp (plugins, travaux périodiques du
+        JobRunner), l'envoi est confié à la boucle, seule à écrire sur le flux.
+
+        Returns:
+            None
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.loop.call_soon_threadsafe(
+                functools.partial(
+                    slixmpp.ClientXMPP.send_message, self, *args, **kwargs
+                )
+            )
+            return
+        slixmpp.ClientXMPP.send_message(self, *args, **kwargs)
+
     def send_message_to_master(self, msg):
         """
         Envoie un message stanza XMPP au maître.
@@ -494,7 +513,7 @@ class MUCBot(slixmpp.ClientXMPP):
         Returns:
             None
         """
-        self.datas_send = []
+        self.datas_send = {}
         mg = base_message_queue_posix()
         mg.load_file(self.boundjid.user)
         mg.clean_file_all_message(prefixe=self.boundjid.user)
@@ -711,9 +730,6 @@ class MUCBot(slixmpp.ClientXMPP):
                 mtype="chat",
             )
 
-    def schedulerfunction(self):
-        self.manage_scheduler.process_on_event()
-
     def __bool_data(self, variable, default=False):
         """
         Convertit une variable en valeur booléenne.
@@ -924,23 +940,20 @@ class MUCBot(slixmpp.ClientXMPP):
         else:
             data = datain
         try:
-            data = base64.b64encode(bytes(data, "utf-8")).decode("utf8")
+            iq = self.make_iq_get(queryxmlns="custom_xep", ito=to)
+            set_iq_payload(iq, data, peer_encodings.get(to))
         except Exception as e:
-            logger.error("iqsendpulse : encode base64 : %s" % str(e))
+            logger.error("iqsendpulse : encode payload : %s" % str(e))
             return '{"err" : "%s"}' % str(e).replace('"', "'")
         try:
-            iq = self.make_iq_get(queryxmlns="custom_xep", ito=to)
             datafile["sesssioniq"] = iq["id"]
             logger.debug("iq id=%s" % iq["id"])
             logger.debug("iq datafile=%s" % datafile)
-            itemXML = ET.Element("{%s}data" % data)
-            for child in iq.xml:
-                if child.tag.endswith("query"):
-                    child.append(itemXML)
             try:
-                self.datas_send.append(datafile)
+                self.datas_send[iq["id"]] = datafile
                 result = iq.send(timeout=timeout)
             except IqError as e:
+                peer_encodings.forget(to)
                 err_resp = e.iq
                 logger.error(
                     "iqsendpulse : Iq error %s" % str(err_resp).replace('"', "'")
@@ -949,6 +962,7 @@ class MUCBot(slixmpp.ClientXMPP):
                 ret = '{"err" : "%s"}' % str(err_resp).replace('"', "'")
 
             except IqTimeout:
+                peer_encodings.forget(to)
                 logger.error("iqsendpulse : Timeout Error")
                 ret = '{"err" : "Timeout Error"}'
         except Exception as e:
@@ -957,6 +971,55 @@ class MUCBot(slixmpp.ClientXMPP):
             ret = '{"err" : "%s"}' % str(e).replace('"', "'")
 
     def iqsendpulse(self, destinataire, msg, mtimeout):
+        """
+        Envoie une requête IQ avec un délai d'attente et attend sa réponse.
+
+        La requête est enregistrée par son id dans la table des IQ en attente
+        (PendingIqTable) : les handlers result/error la résolvent en O(1) et le
+        timeout est armé sur la boucle slixmpp. Aucune file POSIX ni boucle
+        d'événements n'est créée par IQ. Avec iq_posix_queue = True dans
+        [global], la réponse passe par une file POSIX (_iqsendpulse_posix).
+
+        Args:
+            destinataire (str): L'adresse JID du destinataire.
+            msg (bytes or dict or list or str): Les données à envoyer.
+            mtimeout (int): Le délai d'attente en secondes.
+
+        Returns:
+            str: Le message reçu ou un message d'erreur en cas d'échec.
+        """
+        if self.config.iq_posix_queue:
+            return self._iqsendpulse_posix(destinataire, msg, mtimeout)
+        if isinstance(msg, (bytes)):
+            msg = msg.decode("utf-8")
+        if isinstance(msg, (dict, list)):
+            msg = json.dumps(msg, cls=ExtendedJSONEncoder)
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self.loop:
+            logger.error("iqsendpulse : cannot wait for an iq on the xmpp loop")
+            return '{"err" : "iqsendpulse called from the xmpp loop"}'
+        iq = self.make_iq_get(queryxmlns="custom_xep", ito=destinataire)
+        try:
+            set_iq_payload(iq, msg, peer_encodings.get(destinataire))
+        except Exception as e:
+            logger.error("iqsendpulse : encode payload : %s" % str(e))
+            return '{"err" : "%s"}' % str(e).replace('"', "'")
+        table = PendingIqTable.of(self)
+        request = PendingIqResult(iq, mtimeout)
+        table.add(request)
+        self.loop.call_soon_threadsafe(self._iqsendpulse_on_loop, table, request)
+        if not request.done.wait(mtimeout + 5):
+            table.discard(iq["id"])
+        return request.result
+
+    def _iqsendpulse_on_loop(self, table, request):
+        table.arm(request)
+        self.send(request.iq)
+
+    def _iqsendpulse_posix(self, destinataire, msg, mtimeout):
         """
         Envoie une requête IQ avec un délai d'attente et gère la réponse via une file d'attente POSIX.
 
@@ -992,21 +1055,18 @@ class MUCBot(slixmpp.ClientXMPP):
         tempo = time.time()
         datafile = {"sesssioniq": "", "time": tempo + mtimeout + 1, "name_iq_queue": ""}
         try:
-            data = base64.b64encode(bytes(msg, "utf-8")).decode("utf8")
+            iq = self.make_iq_get(queryxmlns="custom_xep", ito=destinataire)
+            set_iq_payload(iq, msg, peer_encodings.get(destinataire))
         except Exception as e:
-            logger.error("iqsendpulse : encode base64 : %s" % str(e))
+            logger.error("iqsendpulse : encode payload : %s" % str(e))
             return '{"err" : "%s"}' % str(e).replace('"', "'")
         try:
-            iq = self.make_iq_get(queryxmlns="custom_xep", ito=destinataire)
             datafile["sesssioniq"] = iq["id"]
             datafile["name_iq_queue"] = "/" + iq["id"]
-            itemXML = ET.Element("{%s}data" % data)
-            for child in iq.xml:
-                if child.tag.endswith("query"):
-                    child.append(itemXML)
-            self.datas_send.append(datafile)
+            self.datas_send[iq["id"]] = datafile
             result = iq.send(timeout=mtimeout)
         except IqError as e:
+            peer_encodings.forget(destinataire)
             err_resp = e.iq
             logger.error("iqsendpulse : Iq error %s" % str(err_resp).replace('"', "'"))
             logger.error("\n%s" % (traceback.format_exc()))
@@ -1044,12 +1104,26 @@ class MUCBot(slixmpp.ClientXMPP):
             close_posix_queue(datafile["name_iq_queue"])
             return msgout
         except posix_ipc.BusyError:
+            peer_encodings.forget(destinataire)
             logger.debug("*** rien recu dans %s" % datafile["name_iq_queue"])
             close_posix_queue(datafile["name_iq_queue"])
             logger.debug("***  timeout %s" % datafile["name_iq_queue"])
-            ret = '{"err" : "timeout %s" % }'
+            ret = '{"err" : "timeout %s"}' % datafile["name_iq_queue"]
             return ret
 
+    def _pop_iq_posix_queue(self, iqid):
+        """
+        Retourne la file POSIX attendant la réponse de l'IQ iqid, ou "".
+
+        Seuls les IQ envoyés par iqsendpulse1 ou _iqsendpulse_posix sont dans
+        self.datas_send ; les entrées expirées sont purgées par Clean_old_queue.
+        """
+        ta = self.datas_send.pop(iqid, None)
+        if ta is None or ta["time"] < time.time():
+            return ""
+        logger.debug("TRAITEMENT RESULT IN %s" % ta["name_iq_queue"])
+        return ta["name_iq_queue"]
+
     async def _handle_custom_iq_error(self, iq):
         if iq["type"] == "error":
             errortext = iq["error"]["text"]
@@ -1062,38 +1136,10 @@ class MUCBot(slixmpp.ClientXMPP):
                 self.isaccount = False
                 return
 
-            miqkeys = iq.keys()
             errortext = iq["error"]["text"]
-            t = time.time()
-            queue = ""
-            liststop = []
-            deleted_queue = []
-
-            # logger.debug("time ref %s" % t)
+            peer_encodings.forget(iq["from"])
+            queue = self._pop_iq_posix_queue(iq["id"])
             try:
-                for ta in self.datas_send:
-                    if ta["time"] < t:
-                        logger.debug(
-                            "The queue %s timed out, we remove it."
-                            % ta["name_iq_queue"]
-                        )
-                        deleted_queue.append(ta["name_iq_queue"])
-                        delqueue.append(ta["name_iq_queue"])
-                        continue
-                    if ta["sesssioniq"] == iq["id"]:
-                        queue = ta["name_iq_queue"]
-                        logger.debug("TRAITEMENT RESULT IN %s" % ta["name_iq_queue"])
-                    liststop.append(ta)
-                self.datas_send = liststop
-                logger.debug("The pending lists to remove %s" % deleted_queue)
-                # delete les queues terminees
-                # on supprime les ancienne liste.
-                for ta in deleted_queue:
-                    try:
-                        logger.debug("delete queue %s" % ta["name_iq_queue"])
-                        posix_ipc.unlink_message_queue(ta["name_iq_queue"])
-                    except:
-                        pass
                 if not queue:
                     # pas de message recu return
                     logger.debug("pas de queue trouver on quitte")
@@ -1157,28 +1203,7 @@ class MUCBot(slixmpp.ClientXMPP):
             logger.debug(
                 "we got an iq with result type. The id of this iq is: %s" % iq["id"]
             )
-            t = time.time()
-            queue = ""
-            liststop = []
-            deleted_queue = []
-
-            for ta in self.datas_send:
-                if ta["time"] < t:
-                    deleted_queue.append(ta["name_iq_queue"])
-                    continue
-                if ta["sesssioniq"] == iq["id"]:
-                    queue = ta["name_iq_queue"]
-                liststop.append(ta)
-            self.datas_send = liststop
-            logger.debug("The pending lists to remove %s" % deleted_queue)
-            # delete les queues terminees
-            # on supprime les ancienne liste.
-            for ta in deleted_queue:
-                try:
-                    logger.debug("delete queue %s" % ta["name_iq_queue"])
-                    posix_ipc.unlink_message_queue(ta["name_iq_queue"])
-                except:
-                    pass
+            queue = self._pop_iq_posix_queue(iq["id"])
             if not queue:
                 # pas de message recu return
                 logger.debug("pas de queue trouver on quitte")
@@ -1205,29 +1230,29 @@ class MUCBot(slixmpp.ClientXMPP):
             except Exception as e:
                 logger.error("exception %s" % e)
                 logger.error("\n%s" % (traceback.format_exc()))
-            for child in iq.xml:
-                if child.tag.endswith("query"):
-                    for z in child:
-                        if z.tag.endswith("data"):
-                            ret = base64.b64decode(bytes(z.tag[1:-5], "utf-8"))
-                            quposix.send(ret, 2)
-                            logger.debug("Result inject to %s" % (queue))
-                            try:
-                                strdatajson = base64.b64decode(
-                                    bytes(z.tag[1:-5], "utf-8")
-                                )
-                                data = json.loads(strdatajson.decode("utf-8"))
-                                quposix.send(data["result"], 2)
-                                return data["result"]
-                            except Exception as e:
-                                logger.error("_handle_custom_iq : %s" % str(e))
-                                logger.error("\n%s" % (traceback.format_exc()))
-                                ret = '{"err" : "%s"}' % str(e).replace('"', "'")
-                                quposix.send(ret, 2)
-                                return ret
-                            ret = "{}"
-                            quposix.send(ret, 2)
-                            return ret
+            try:
+                ret, _ = get_iq_payload(iq)
+            except Exception as e:
+                logger.error("_handle_custom_iq : %s" % str(e))
+                logger.error("\n%s" % (traceback.format_exc()))
+                ret = '{"err" : "%s"}' % str(e).replace('"', "'")
+                quposix.send(ret, 2)
+                return ret
+            if ret is None:
+                return
+            peer_encodings.learn(iq)
+            quposix.send(ret, 2)
+            logger.debug("Result inject to %s" % (queue))
+            try:
+                data = json.loads(ret.decode("utf-8"))
+                quposix.send(data["result"], 2)
+                return data["result"]
+            except Exception as e:
+                logger.error("_handle_custom_iq : %s" % str(e))
+                logger.error("\n%s" % (traceback.format_exc()))
+                ret = '{"err" : "%s"}' % str(e).replace('"', "'")
+                quposix.send(ret, 2)
+                return ret
         else:
             # ... This will capture error responses too
             ret = "{}"
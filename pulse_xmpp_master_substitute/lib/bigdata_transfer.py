@@ -0,0 +1,434 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; -*-
+# SPDX-FileCopyrightText: 2016-2023 Siveo <support@siveo.net>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+Transfer of the big messages in segments (action big_data).
+
+The message is compressed, base64 encoded and cut in segments. The sender
+keeps at most WINDOW unacknowledged segments on the wire. The receiver
+writes each segment at its offset in a spool file (in memory up to
+SPOOL_MEMORY bytes, on disk beyond), and every ACK_INTERVAL segments
+answers with the number of the last contiguous segment and the missing
+ones, which the sender sends again. Without progress after ACK_TIMEOUT
+seconds the unacknowledged segments are sent again, MAX_RETRIES times.
+
+A receiver that never answers is an agent without this protocol: the
+sender then sends the remaining segments back-to-back, as before. The
+segments of such a sender (no "window" key) are reassembled without acks.
+
+The bytes held by the receiver are capped per sender and in total; a
+session exceeding them is dropped and the sender told to abort.
+"""
+
+import base64
+import json
+import logging
+import tempfile
+import threading
+import time
+import zlib
+
+from lib.utils import getRandomName
+
+logger = logging.getLogger()
+
+SEGMENT_SIZE = 65532
+WINDOW = 8
+ACK_INTERVAL = 4
+ACK_TIMEOUT = 10
+MAX_RETRIES = 5
+SESSION_TIMEOUT = 300
+SPOOL_MEMORY = 1024 * 1024
+MAX_SENDER_BYTES = 64 * 1024 * 1024
+MAX_TOTAL_BYTES = 256 * 1024 * 1024
+MAX_MESSAGE_SIZE = 256 * 1024 * 1024
+
+
+def bare(jid):
+    return str(jid).split("/")[0]
+
+
+class BigDataSender:
+    """
+    Sending side of a transfer. All the methods except start run in the
+    slixmpp loop.
+    """
+
+    def __init__(self, transfers, jid_receiver, sessionid, data_base64, segment_size):
+        self.transfers = transfers
+        self.xmppobject = transfers.xmppobject
+        self.jid_receiver = jid_receiver
+        self.sessionid = sessionid
+        self.data = data_base64
+        self.segment_size = segment_size
+        self.nb_segments_total = (len(data_base64) + segment_size - 1) // segment_size
+        # last segment acknowledged in sequence, next segment to send
+        self.acked = 0
+        self.next_segment = 1
+        self.acknowledged = False
+        self.retries = 0
+        self.timer = None
+
+    def start(self):
+        self.xmppobject.loop.call_soon_threadsafe(self._pump)
+
+    def _send(self, number):
+        message = {
+            "action": "big_data",
+            "sessionid": self.sessionid,
+            "data": {
+                "segment": self.data[
+                    (number - 1) * self.segment_size : number * self.segment_size
+                ],
+                "nb_segment": number,
+                "nb_segment_total": self.nb_segments_total,
+                "segment_size": self.segment_size,
+                "window": WINDOW,
+                "from": self.xmppobject.boundjid.full,
+            },
+        }
+        self.transfers.send_json(self.jid_receiver, message)
+
+    def _pump(self):
+        last = min(self.nb_segments_total, self.acked + WINDOW)
+        while self.next_segment <= last:
+            self._send(self.next_segment)
+            self.next_segment += 1
+        self._arm()
+
+    def _arm(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.xmppobject.loop.call_later(ACK_TIMEOUT, self._on_timeout)
+
+    def on_ack(self, received_upto, missing):
+        self.acknowledged = True
+        if received_upto >= self.nb_segments_total:
+            self._finish()
+            return
+        if received_upto > self.acked:
+            self.acked = received_upto
+            self.retries = 0
+        for number in missing:
+            if self.acked < number < self.next_segment:
+                self._send(number)
+                self.transfers.count("resent")
+        self._pump()
+
+    def _on_timeout(self):
+        self.timer = None
+        if not self.acknowledged:
+            logger.debug(
+                "big_data %s : no ack from %s, sending without window"
+                % (self.sessionid, self.jid_receiver)
+            )
+            self.transfers.count("legacy")
+            while self.next_segment <= self.nb_segments_total:
+                self._send(self.next_segment)
+                self.next_segment += 1
+            self._finish()
+            return
+        self.retries += 1
+        if self.retries > MAX_RETRIES:
+            self.abort("no progress after %s retries" % MAX_RETRIES)
+            return
+        for number in range(self.acked + 1, self.next_segment):
+            self._send(number)
+            self.transfers.count("resent")
+        self._arm()
+
+    def abort(self, reason):
+        logger.error(
+            "big_data %s to %s aborted : %s"
+            % (self.sessionid, self.jid_receiver, reason)
+        )
+        self.transfers.count("aborted")
+        self._finish()
+
+    def _finish(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.transfers.senders.pop(self.sessionid, None)
+
+
+class BigDataSession:
+    """
+    Receiving side of a transfer: the base64 segments are written at their
+    offset in a spooled temporary file.
+    """
+
+    def __init__(self, sender, sessionid, nb_segments_total, segment_size, window):
+        self.sender = sender
+        self.sessionid = sessionid
+        self.nb_segments_total = nb_segments_total
+        self.segment_size = segment_size
+        self.window = window
+        self.spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY)
+        self.received = set()
+        self.received_upto = 0
+        self.size = 0
+        self.since_ack = 0
+        self.last = time.monotonic()
+
+    def add(self, number, segment):
+        """
+        Writes the segment; returns False if it was already received.
+        """
+        self.last = time.monotonic()
+        if number in self.received or not 1 <= number <= self.nb_segments_total:
+            return False
+        segment = segment.encode("ascii")
+        self.spool.seek((number - 1) * self.segment_size)
+        self.spool.write(segment)
+        self.received.add(number)
+        self.size += len(segment)
+        self.since_ack += 1
+        while self.received_upto + 1 in self.received:
+            self.received_upto += 1
+        return True
+
+    def complete(self):
+        return len(self.received) == self.nb_segments_total
+
+    def missing(self):
+        highest = max(self.received) if self.received else 0
+        return [
+            number
+            for number in range(self.received_upto + 1, highest)
+            if number not in self.received
+        ][: self.window]
+
+    def message(self):
+        """
+        Returns the reassembled message (str).
+        """
+        self.spool.seek(0)
+        decompressor = zlib.decompressobj()
+        parts = []
+        size = 0
+        # 65536 is a multiple of 4: each chunk is decoded on its own
+        for chunk in iter(lambda: self.spool.read(65536), b""):
+            parts.append(decompressor.decompress(base64.b64decode(chunk)))
+            size += len(parts[-1])
+            if size > MAX_MESSAGE_SIZE:
+                raise ValueError(
+                    "big_data message larger than %s bytes" % MAX_MESSAGE_SIZE
+                )
+        parts.append(decompressor.flush())
+        return b"".join(parts).decode("utf-8")
+
+    def close(self):
+        self.spool.close()
+
+
+class BigDataTransfers:
+    """
+    Transfers in progress of an agent, in both directions, and their metrics.
+    """
+
+    _lock_create = threading.Lock()
+
+    def __init__(self, xmppobject):
+        self.xmppobject = xmppobject
+        self.senders = {}
+        self.sessions = {}
+        # sessions dropped by the memory limits, ignored until they expire
+        self.rejected = {}
+        # sessions delivered, with their final ack, until they expire: the
+        # sender resends its segments when that ack is lost
+        self.completed = {}
+        self.bytes_by_sender = {}
+        self.in_flight_bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {
+            "sent": 0,
+            "received": 0,
+            "resent": 0,
+            "duplicates": 0,
+            "legacy": 0,
+            "aborted": 0,
+            "rejected": 0,
+            "expired": 0,
+        }
+
+    @classmethod
+    def of(cls, xmppobject):
+        """
+        Returns the transfers of the agent, created at the first call.
+        """
+        transfers = getattr(xmppobject, "big_data_transfers", None)
+        if transfers is None:
+            with cls._lock_create:
+                transfers = getattr(xmppobject, "big_data_transfers", None)
+                if transfers is None:
+                    transfers = cls(xmppobject)
+                    xmppobject.big_data_transfers = transfers
+        return transfers
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.stats[name] += value
+
+    def metrics(self):
+        with self._lock:
+            result = dict(self.stats)
+            result["sending"] = len(self.senders)
+            result["receiving"] = len(self.sessions)
+            result["in_flight_bytes"] = self.in_flight_bytes
+            result["in_flight_bytes_by_sender"] = dict(self.bytes_by_sender)
+        return result
+
+    def send_json(self, jid_receiver, message):
+        self.xmppobject.send_message(
+            mto=jid_receiver, mbody=json.dumps(message), mtype="chat"
+        )
+
+    def send(self, jid_receiver, data_utf8_json, segment_size=SEGMENT_SIZE):
+        """
+        Starts the transfer of data_utf8_json to jid_receiver.
+        """
+        # a multiple of 4 keeps the base64 segments independent
+        segment_size = max(4, segment_size - segment_size % 4)
+        data_base64 = base64.b64encode(
+            zlib.compress(data_utf8_json.encode("utf-8"))
+        ).decode("utf-8")
+        sender = BigDataSender(
+            self,
+            jid_receiver,
+            getRandomName(6, "big_data"),
+            data_base64,
+            segment_size,
+        )
+        self.senders[sender.sessionid] = sender
+        self.count("sent")
+        sender.start()
+        return sender.sessionid
+
+    def on_message(self, sessionid, data, msg):
+        """
+        Handles a big_data message. Returns the reassembled message (str)
+        when its last segment is received, None otherwise.
+        """
+        if "ack" in data or "abort" in data:
+            sender = self.senders.get(sessionid)
+            if sender is None or bare(msg["from"]) != bare(sender.jid_receiver):
+                return None
+            if "abort" in data:
+                self.xmppobject.loop.call_soon_threadsafe(sender.abort, data["abort"])
+            else:
+                self.xmppobject.loop.call_soon_threadsafe(
+                    sender.on_ack, int(data["ack"]), data.get("missing", [])
+                )
+            return None
+        jid_sender = bare(msg["from"])
+        key = (jid_sender, sessionid)
+        reply = None
+        with self._lock:
+            self._expire()
+            if key in self.rejected:
+                return None
+            complete = False
+            if key in self.completed:
+                # the final ack was lost: answer it again, without a session
+                self.stats["duplicates"] += 1
+                _, window, nb_segments_total = self.completed[key]
+                if window:
+                    reply = {"ack": nb_segments_total}
+            else:
+                session = self.sessions.get(key)
+                if session is None:
+                    session = BigDataSession(
+                        jid_sender,
+                        sessionid,
+                        int(data["nb_segment_total"]),
+                        int(data.get("segment_size", 65535)),
+                        int(data.get("window", 0)),
+                    )
+                    self.sessions[key] = session
+                segment = data["segment"]
+                if (
+                    self.bytes_by_sender.get(jid_sender, 0) + len(segment)
+                    > MAX_SENDER_BYTES
+                    or self.in_flight_bytes + len(segment) > MAX_TOTAL_BYTES
+                ):
+                    self._drop(key)
+                    self.rejected[key] = time.monotonic()
+                    self.stats["rejected"] += 1
+                    logger.error(
+                        "big_data %s from %s rejected : memory limit reached"
+                        % (sessionid, jid_sender)
+                    )
+                    if session.window:
+                        reply = {"abort": "memory limit reached on receiver"}
+                elif session.add(int(data["nb_segment"]), segment):
+                    self.bytes_by_sender[jid_sender] = self.bytes_by_sender.get(
+                        jid_sender, 0
+                    ) + len(segment)
+                    self.in_flight_bytes += len(segment)
+                else:
+                    self.stats["duplicates"] += 1
+                    # the sender resends: tell it where we are
+                    session.since_ack = ACK_INTERVAL
+                complete = reply is None and session.complete()
+                if complete:
+                    self._drop(key)
+                    self.completed[key] = (
+                        time.monotonic(),
+                        session.window,
+                        session.nb_segments_total,
+                    )
+                    self.stats["received"] += 1
+                if session.window and reply is None:
+                    if complete:
+                        reply = {"ack": session.nb_segments_total}
+                    elif session.since_ack >= ACK_INTERVAL:
+                        session.since_ack = 0
+                        reply = {
+                            "ack": session.received_upto,
+                            "missing": session.missing(),
+                        }
+        if reply is not None:
+            reply["from"] = self.xmppobject.boundjid.full
+            # the ack goes back to the sender of the stanza, not to the
+            # "from" it claims in its data
+            self.send_json(
+                msg["from"],
+                {"action": "big_data", "sessionid": sessionid, "data": reply},
+            )
+        if complete:
+            try:
+                return session.message()
+            finally:
+                session.close()
+        return None
+
+    def _drop(self, key):
+        session = self.sessions.pop(key, None)
+        if session is None:
+            return
+        self.in_flight_bytes -= session.size
+        remaining = self.bytes_by_sender.get(session.sender, 0) - session.size
+        if remaining > 0:
+            self.bytes_by_sender[session.sender] = remaining
+        else:
+            self.bytes_by_sender.pop(session.sender, None)
+        if not session.complete():
+            session.close()
+
+    def _expire(self):
+        limit = time.monotonic() - SESSION_TIMEOUT
+        for key in [
+            key for key, session in self.sessions.items() if session.last < limit
+        ]:
+            logger.warning("big_data %s from %s expired" % (key[1], key[0]))
+            self._drop(key)
+            self.stats["expired"] += 1
+        for key in [key for key, dropped in self.rejected.items() if dropped < limit]:
+            del self.rejected[key]
+        for key in [
+            key for key, (done, _, _) in self.completed.items() if done < limit
+        ]:
+            del self.completed[key]
@@ -106,6 +106,12 @@ class confParameter:
         if Config.has_option("global", "logfile"):
             self.logfile = Config.get("global", "logfile")
 
+        # iqsendpulse waits for the responses in memory. iq_posix_queue = True
+        # restores the POSIX message queue per IQ (response read by another process)
+        self.iq_posix_queue = False
+        if Config.has_option("global", "iq_posix_queue"):
+            self.iq_posix_queue = Config.getboolean("global", "iq_posix_queue")
+
         ################################################################
         # list des noms des plugins start executer au demarage.
         # le code de ces plugins est execute au demarage. il commence par start
@@ -116,6 +122,32 @@ class confParameter:
         self.pluginliststart = [
             x.strip() for x in self.pluginliststart.split(",") if x.strip() != ""
         ]
+
+        # Shared pool executing the plugin actions
+        # action_limits caps the concurrency per action, e.g.
+        # action_limits = applicationdeploymentjson:10, xmpplog:4
+        self.plugin_pool_max_workers = 20
+        if Config.has_option("plugin_pool", "max_workers"):
+            self.plugin_pool_max_workers = Config.getint("plugin_pool", "max_workers")
+        self.plugin_pool_max_queue = 500
+        if Config.has_option("plugin_pool", "max_queue"):
+            self.plugin_pool_max_queue = Config.getint("plugin_pool", "max_queue")
+        self.plugin_pool_queue_timeout = 30
+        if Config.has_option("plugin_pool", "queue_timeout"):
+            self.plugin_pool_queue_timeout = Config.getint(
+                "plugin_pool", "queue_timeout"
+            )
+        self.plugin_pool_action_limits = {}
+        if Config.has_option("plugin_pool", "action_limits"):
+            for limit in Config.get("plugin_pool", "action_limits").split(","):
+                if ":" in limit:
+                    actionname, nblimit = limit.split(":", 1)
+                    self.plugin_pool_action_limits[actionname.strip()] = int(nblimit)
+        # Results of the reflection of the databases kept between two starts
+        # (one snapshot per database, empty: tables reflected at each start)
+        self.schema_snapshot = "/var/lib/pulse2/schema_snapshot"
+        if Config.has_option("global", "schema_snapshot"):
+            self.schema_snapshot = Config.get("global", "schema_snapshot").strip()
         ################################################################
         self.dbpoolrecycle = 3600
         self.dbpoolsize = 60
@@ -392,12 +424,48 @@ class confParameter:
         if confiobject.has_option("glpi", "xmldumpactive"):
             self.xmldumpactive = confiobject.getboolean("glpi", "xmldumpactive")
 
+        self.inventory_store = "/var/lib/pulse2/inventory_store"
+        if confiobject.has_option("glpi", "inventory_store"):
+            self.inventory_store = confiobject.get("glpi", "inventory_store")
+
         self.inventory_enable_forward = True
         if confiobject.has_option("glpi", "enable_forward"):
             self.inventory_enable_forward = confiobject.getboolean(
                 "glpi", "enable_forward"
             )
 
+        # compression level of each url_to_forward (0 : no compression),
+        # the last one applies to the following urls
+        self.forward_compresslevel = "9"
+        if confiobject.has_option("glpi", "forward_compresslevel"):
+            self.forward_compresslevel = confiobject.get(
+                "glpi", "forward_compresslevel"
+            )
+
+        self.forward_workers = 2
+        if confiobject.has_option("glpi", "forward_workers"):
+            self.forward_workers = confiobject.getint("glpi", "forward_workers")
+
+        self.forward_queue_size = 100
+        if confiobject.has_option("glpi", "forward_queue_size"):
+            self.forward_queue_size = confiobject.getint("glpi", "forward_queue_size")
+
+        self.forward_spool = "/var/lib/pulse2/inventory_spool"
+        if confiobject.has_option("glpi", "forward_spool"):
+            self.forward_spool = confiobject.get("glpi", "forward_spool")
+
+        self.forward_retries = 3
+        if confiobject.has_option("glpi", "forward_retries"):
+            self.forward_retries = confiobject.getint("glpi", "forward_retries")
+
+        self.forward_backoff = 2
+        if confiobject.has_option("glpi", "forward_backoff"):
+            self.forward_backoff = confiobject.getfloat("glpi", "forward_backoff")
+
+        self.forward_timeout = 60
+        if confiobject.has_option("glpi", "forward_timeout"):
+            self.forward_timeout = confiobject.getint("glpi", "forward_timeout")
+
         self.inventory_enable_forward_ocsserver = False
         if confiobject.has_option("glpi", "enable_forward_ocsserver"):
             self.inventory_enable_forward_ocsserver = confiobject.getboolean(
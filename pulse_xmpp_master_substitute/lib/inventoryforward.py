@@ -0,0 +1,311 @@
+# -*- coding: utf-8; -*-
+# SPDX-FileCopyrightText: 2016-2023 Siveo <support@siveo.net>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import concurrent.futures
+import gzip
+import hashlib
+import logging
+import os
+import queue
+import threading
+import time
+import traceback
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger()
+
+
+class ForwardTarget:
+    """
+    Un serveur d'inventaire (GLPI/OCS) vers lequel les inventaires sont
+    transmis.
+
+    Les inventaires en attente sont dans une file bornée (queue_size). Quand
+    elle est pleine, ils sont écrits dans le répertoire spool et repris dès
+    que la file se vide ; tant que le spool n'est pas vide, les nouveaux
+    inventaires y sont écrits à la suite, pour qu'un inventaire récent ne
+    soit pas transmis avant un plus ancien de la même machine. workers threads les envoient, chacun avec sa
+    session HTTP : les connexions vers le serveur restent ouvertes d'un
+    inventaire à l'autre.
+    """
+
+    def __init__(
+        self,
+        url,
+        compresslevel=9,
+        workers=2,
+        queue_size=100,
+        spool=None,
+        retries=3,
+        backoff=2,
+        timeout=60,
+        user_agent="siveo-injector",
+        verbose=False,
+    ):
+        self.url = url
+        self.compresslevel = compresslevel
+        self.workers = max(1, workers)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.verbose = verbose
+        self.headers = {"User-Agent": user_agent, "Pragma": "no-cache"}
+        self.headers["Content-Type"] = (
+            "Application/x-gzip" if compresslevel else "Application/x-compress"
+        )
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.spool = spool
+        if spool and not os.path.isdir(spool):
+            os.makedirs(spool, mode=0o700)
+        self._spool_lock = threading.Lock()
+        # fin de transfert des inventaires du spool, par nom de fichier
+        self._spool_done = {}
+        # inventaires dans le spool, y compris ceux d'avant un redémarrage
+        self._spool_size = len(self._spooled())
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "sent": 0,
+            "failed": 0,
+            "retried": 0,
+            "spooled": 0,
+            "dropped": 0,
+            "total_duration": 0.0,
+        }
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for index in range(self.workers):
+            thread = threading.Thread(
+                target=self._run,
+                name="forward-%s-%s" % (index, self.url),
+                daemon=True,
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+
+    def _count(self, name, value=1):
+        with self._stats_lock:
+            self._stats[name] += value
+
+    def stats(self):
+        with self._stats_lock:
+            result = dict(self._stats)
+        result["queued"] = self.queue.qsize()
+        result["spool"] = len(self._spooled())
+        return result
+
+    def put(self, payload, done=None):
+        """
+        Met en file l'inventaire payload (déjà compressé pour cette cible).
+
+        done(sent) est appelé quand l'inventaire a été transmis (sent True),
+        ou abandonné (sent False).
+        """
+        with self._spool_lock:
+            if not self._spool_size:
+                try:
+                    self.queue.put_nowait((payload, done))
+                    return
+                except queue.Full:
+                    pass
+            if self.spool:
+                name = "%.6f-%s" % (time.time(), uuid.uuid4().hex)
+                filename = os.path.join(self.spool, name)
+                with open(filename + ".tmp", "wb") as output:
+                    output.write(payload)
+                if done is not None:
+                    self._spool_done[name] = done
+                os.replace(filename + ".tmp", filename)
+                self._spool_size += 1
+                self._count("spooled")
+                return
+        self._count("dropped")
+        logger.error(
+            "inventory forward queue to %s is full, an inventory is dropped" % self.url
+        )
+        self._done(done, False)
+
+    @staticmethod
+    def _done(done, sent):
+        if done is None:
+            return
+        try:
+            done(sent)
+        except Exception:
+            logger.error("\n%s" % (traceback.format_exc()))
+
+    def _spooled(self):
+        if not self.spool:
+            return []
+        return sorted(x for x in os.listdir(self.spool) if not x.endswith(".tmp"))
+
+    def _unspool(self):
+        """
+        Retourne le plus ancien inventaire du spool, (payload, done), ou
+        None. done est None pour un inventaire spoolé avant un redémarrage.
+        """
+        with self._spool_lock:
+            names = self._spooled()
+            for index, name in enumerate(names):
+                filename = os.path.join(self.spool, name)
+                try:
+                    with open(filename, "rb") as content:
+                        payload = content.read()
+                    os.remove(filename)
+                except OSError:
+                    continue
+                self._spool_size = len(names) - index - 1
+                return payload, self._spool_done.pop(name, None)
+            self._spool_size = 0
+        return None
+
+    def _run(self):
+        session = requests.Session()
+        session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        session.headers.update(self.headers)
+        while not self._stop.is_set():
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                item = self._unspool()
+            if item is None:
+                try:
+                    item = self.queue.get(timeout=1)
+                except queue.Empty:
+                    continue
+            payload, done = item
+            sent = False
+            try:
+                sent = self._send(session, payload)
+            except Exception:
+                self._count("failed")
+                logger.error("\n%s" % (traceback.format_exc()))
+            self._done(done, sent)
+
+    def _send(self, session, payload):
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._count("retried")
+                self._stop.wait(min(self.backoff * 2 ** (attempt - 1), 300))
+            start = time.time()
+            try:
+                response = session.post(self.url, data=payload, timeout=self.timeout)
+            except requests.RequestException as e:
+                logger.warning("inventory forward to %s : %s" % (self.url, e))
+                continue
+            self._count("total_duration", time.time() - start)
+            if response.status_code == 200:
+                self._count("sent")
+                if self.verbose:
+                    logger.info(
+                        "inventory forwarded to %s in %.3f s"
+                        % (self.url, time.time() - start)
+                    )
+                return True
+            logger.error(
+                "inventory forward to %s : %s %s"
+                % (self.url, response.status_code, response.content[:200])
+            )
+            if 400 <= response.status_code < 500:
+                break
+        self._count("failed")
+        logger.error("inventory forward to %s failed" % self.url)
+        return False
+
+
+class InventoryForwarder:
+    """
+    Transmet les inventaires reçus aux serveurs d'inventaire sans bloquer
+    le plugin qui les reçoit.
+
+    submit() compresse l'inventaire une fois par niveau de compression et
+    le met en file de chaque cible : les cibles reçoivent l'inventaire en
+    parallèle, une cible lente ou en panne ne retarde pas les autres.
+    submit() retourne un Future terminé quand toutes les cibles ont transmis
+    ou abandonné l'inventaire (résultat True si toutes l'ont reçu). Un
+    envoi en échec (erreur réseau ou 5xx) est retenté retries fois, après
+    backoff, 2 * backoff, ... secondes.
+    """
+
+    def __init__(self, targets):
+        self.targets = targets
+        for target in self.targets:
+            target.start()
+
+    @classmethod
+    def from_config(cls, config):
+        urls = [x.strip() for x in config.url_to_forward.split(",") if x.strip()]
+        levels = [int(x) for x in str(config.forward_compresslevel).split(",")]
+        targets = []
+        for index, url in enumerate(urls):
+            spool = None
+            if config.forward_spool:
+                spool = os.path.join(
+                    config.forward_spool,
+                    hashlib.md5(url.encode("utf-8")).hexdigest(),
+                )
+            targets.append(
+                ForwardTarget(
+                    url,
+                    compresslevel=levels[min(index, len(levels) - 1)],
+                    workers=config.forward_workers,
+                    queue_size=config.forward_queue_size,
+                    spool=spool,
+                    retries=config.forward_retries,
+                    backoff=config.forward_backoff,
+                    timeout=config.forward_timeout,
+                    user_agent=config.user_agent,
+                    verbose=config.inventory_verbose,
+                )
+            )
+        return cls(targets)
+
+    def submit(self, content):
+        """
+        Met en file l'inventaire content (str ou bytes) pour chaque cible.
+
+        Retourne un concurrent.futures.Future dont le résultat est True si
+        toutes les cibles ont reçu l'inventaire.
+        """
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        future = concurrent.futures.Future()
+        results = []
+        lock = threading.Lock()
+
+        def done(sent):
+            with lock:
+                results.append(sent)
+                if len(results) < len(self.targets):
+                    return
+            future.set_result(all(results))
+
+        if not self.targets:
+            future.set_result(True)
+        payloads = {}
+        for target in self.targets:
+            if target.compresslevel not in payloads:
+                if target.compresslevel:
+                    payloads[target.compresslevel] = gzip.compress(
+                        content, compresslevel=target.compresslevel
+                    )
+                else:
+                    payloads[target.compresslevel] = content
+            target.put(payloads[target.compresslevel], done)
+        return future
+
+    def stats(self):
+        return {target.url: target.stats() for target in self.targets}
+
+    def stop(self):
+        for target in self.targets:
+            target.stop()
@@ -6,6 +6,7 @@
 import os
 import sys
 import json
+import base64
 from lib.utils import (
     name_random,
     getRandomName,
@@ -22,7 +23,6 @@ if sys.platform == "win32":
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
 import datetime
-import time
 
 # this import will be used later
 import types
@@ -36,21 +36,154 @@ import ipaddress
 import inspect
 
 from slixmpp import ClientXMPP
-import xml.etree.ElementTree as ET
+from slixmpp.xmlstream.handler import Callback
+from slixmpp.xmlstream.matcher.stanzapath import StanzaPath
+from lib.iq_payload import set_iq_payload, get_iq_payload, peer_encodings
 
 import logging
+import threading
 import traceback
 
 DEBUGPULSE = 25
 logger = logging.getLogger()
 
 
+class PendingIqTable:
+    """
+    Table des IQ custom_xep en attente de réponse, indexée par id.
+
+    Une seule table et un seul handler slixmpp sont créés par agent. Les
+    réponses (result ou error) sont retrouvées par leur id en O(1), et les
+    timeouts sont armés sur la boucle principale de slixmpp avec call_later.
+    L'appelant attend sur un threading.Event : aucun thread ni boucle
+    d'événements n'est créé par IQ.
+    """
+
+    _lock_create = threading.Lock()
+
+    def __init__(self, xmppobject):
+        self.xmppobject = xmppobject
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def of(cls, xmppobject):
+        """
+        Retourne la table de l'agent, créée et branchée sur slixmpp au premier appel.
+        """
+        table = getattr(xmppobject, "pending_iq_table", None)
+        if table is None:
+            with cls._lock_create:
+                table = getattr(xmppobject, "pending_iq_table", None)
+                if table is None:
+                    table = cls(xmppobject)
+                    xmppobject.loop.call_soon_threadsafe(table._register_handlers)
+                    xmppobject.pending_iq_table = table
+        return table
+
+    def _register_handlers(self):
+        for typeiq in ("result", "error"):
+            self.xmppobject.register_handler(
+                Callback(
+                    "pending_iq_%s" % typeiq,
+                    StanzaPath("iq@type=%s" % typeiq),
+                    self._on_iq,
+                )
+            )
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, request):
+        """
+        Enregistre un iq_custom_xep en attente de sa réponse.
+        """
+        with self._lock:
+            self._pending[request.iq["id"]] = request
+
+    def arm(self, request):
+        """
+        Arme le timeout de la requête. Doit être appelée dans la boucle slixmpp.
+        """
+        request.timer = self.xmppobject.loop.call_later(
+            request.timeout, self._on_timeout, request.iq["id"]
+        )
+
+    def discard(self, iqid):
+        with self._lock:
+            request = self._pending.pop(iqid, None)
+        if request is not None and request.timer is not None:
+            self.xmppobject.loop.call_soon_threadsafe(request.timer.cancel)
+
+    def _on_iq(self, iq):
+        with self._lock:
+            request = self._pending.pop(iq["id"], None)
+        if request is None:
+            return
+        if request.timer is not None:
+            request.timer.cancel()
+        try:
+            request.on_response(iq)
+        finally:
+            request.done.set()
+
+    def _on_timeout(self, iqid):
+        with self._lock:
+            request = self._pending.pop(iqid, None)
+        if request is None:
+            return
+        try:
+            request.on_timeout(request.iq)
+        finally:
+            request.done.set()
+
+
+class PendingIqResult:
+    """
+    Réponse attendue par MUCBot.iqsendpulse, résolue par PendingIqTable.
+
+    result contient la donnée décodée de la réponse, ou '{"err" : "..."}'
+    en cas d'erreur ou de timeout.
+    """
+
+    def __init__(self, iq, timeout):
+        self.iq = iq
+        self.timeout = timeout
+        self.timer = None
+        self.done = threading.Event()
+        self.result = '{"err" : "timeout %s"}' % iq["id"]
+
+    def on_response(self, iq):
+        if iq["type"] == "error":
+            peer_encodings.forget(self.iq["to"])
+            self.result = '{"err" : "%s"}' % iq["error"]["text"]
+            return
+        self.result = "{}"
+        try:
+            data, _ = get_iq_payload(iq)
+        except Exception as e:
+            peer_encodings.forget(self.iq["to"])
+            logger.error("iqsendpulse : decoding error : %s" % str(e))
+            self.result = '{"err" : "%s"}' % str(e).replace('"', "'")
+            return
+        peer_encodings.learn(iq)
+        if data is not None:
+            self.result = data.decode("utf-8")
+
+    def on_timeout(self, iq):
+        peer_encodings.forget(self.iq["to"])
+        logger.debug("iqsendpulse : timeout iq %s" % iq["id"])
+        self.result = '{"err" : "timeout %s"}' % iq["id"]
+
+
 class iq_custom_xep:
     def __init__(self, xmppobject, to, dict_str, timeout=30, sessionid=None):
         # verification ressource dans JID
         self.iq = None
         self.fin = False
         self.result_iq = {}
+        self.done = threading.Event()
+        self.timer = None
         try:
             self.data = None
             self.timeout = int(30)
@@ -95,10 +228,11 @@ class iq_custom_xep:
                     self.iq = self.xmppobject.make_iq_get(
                         queryxmlns="custom_xep", ito=self.to
                     )
-                    itemXML = ET.Element("{%s}data" % self.data)
-                    for child in self.iq.xml:
-                        if child.tag.endswith("query"):
-                            child.append(itemXML)
+                    set_iq_payload(
+                        self.iq,
+                        base64.b64decode(self.data),
+                        peer_encodings.get(self.to),
+                    )
                     self.iq["id"] = self.sessionid
                 except Exception as e:
                     logger.error("%s" % (traceback.format_exc()))
@@ -118,56 +252,42 @@ class iq_custom_xep:
             logger.error("%s" % (traceback.format_exc()))
 
     def iq_send(self):
-        logger.debug("#############################################################")
-        logger.debug("####################### iq_send #######################")
-        logger.debug("#############################################################")
-        logger.debug(
-            "#############################################################%s " % self.iq
-        )
+        """
+        Envoie l'IQ et bloque le thread appelant jusqu'à la réponse ou au timeout.
 
+        L'envoi et le timeout sont confiés à la boucle slixmpp ; la réponse est
+        résolue par la table des IQ en attente. Cette fonction ne peut pas être
+        appelée depuis la boucle slixmpp elle-même (un plugin appelé par
+        call_plugin s'exécute dans le pool de plugins).
+        """
         if not self.iq:
-            logger.debug("######################BYBYBY########################")
             return '{"error" : "initialisation erreur"}'
-        timeoutloop = float(self.timeout + 5)
-        logger.debug("#############################################################")
-        logger.debug("####################### send #######################")
-        logger.debug("#############################################################")
-
-        logger.debug(" iq class %s  " % self.iq.__class__.__name__)
-
-        self.iq.send(
-            callback=self.on_response,
-            timeout=int(self.timeout),
-            timeout_callback=self.on_timeout,
-        )
-        logger.debug("#############################################################")
-        logger.debug("####################### send #######################")
-        logger.debug("#############################################################")
-        while True:
-            if not timeoutloop:
-                er = "IQ type get id [%s] to [%s] in Timeout" % (
-                    self.iq["id"],
-                    self.iq["to"],
-                )
-                self.result_iq = {"error": er}
-                return self.result_iq
-            timeoutloop = timeoutloop - 0.5
-            if self.fin:
-                logger.debug(
-                    "#############################################################"
-                )
-                logger.debug(
-                    "####################### termine on fin #######################"
-                )
-                logger.debug(
-                    "#############################################################"
-                )
-                break
-            time.sleep(0.5)
-        # la reponse
-        self.reponse_iq = self.iq
+        loop = self.xmppobject.loop
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is loop:
+            er = "IQ id [%s] : iq_send cannot wait on the xmpp loop" % self.iq["id"]
+            logger.error(er)
+            return {"error": er}
+        table = PendingIqTable.of(self.xmppobject)
+        table.add(self)
+        loop.call_soon_threadsafe(self._send_on_loop, table)
+        if not self.done.wait(self.timeout + 5):
+            table.discard(self.iq["id"])
+            peer_encodings.forget(self.to)
+            er = "IQ type get id [%s] to [%s] in Timeout" % (
+                self.iq["id"],
+                self.iq["to"],
+            )
+            self.result_iq = {"error": er}
         return self.result_iq
 
+    def _send_on_loop(self, table):
+        table.arm(self)
+        self.xmppobject.send(self.iq)
+
     def on_response(self, reponse_iq):
         logger.debug("#############################################################")
         logger.debug(
@@ -178,6 +298,7 @@ class iq_custom_xep:
         try:
             self.reponse_iq = reponse_iq
             if reponse_iq["type"] == "error":
+                peer_encodings.forget(self.to)
                 texterror = ""
                 actionerror = ""
                 logger.error("on_response1 %s" % reponse_iq["type"])
@@ -219,20 +340,17 @@ class iq_custom_xep:
             elif reponse_iq["type"] == "result":
                 # traitement du result
                 logger.debug("traitement de iq get custom_xep")
-                for child in reponse_iq.xml:
-                    if child.tag.endswith("query"):
-                        # select data element query
-                        for z in child:
-                            # recuperation (bytes data) encode en base64
-                            data = z.tag[1:-5]
-                            try:
-                                self.result_iq = convert.decode_base64_to_string_(data)
-                                return self.result_iq
-                            except Exception as e:
-                                logger.error("on_response custom_xep : %s" % str(e))
-                                logger.error("\n%s" % (traceback.format_exc()))
-                                logger.error("xml reponse : %s " % str(e))
-                                return {"err": "erreur decodage iq"}
+                try:
+                    data, _ = get_iq_payload(reponse_iq)
+                    peer_encodings.learn(reponse_iq)
+                    if data is not None:
+                        self.result_iq = data.decode("utf-8")
+                    return self.result_iq
+                except Exception as e:
+                    peer_encodings.forget(self.to)
+                    logger.error("on_response custom_xep : %s" % str(e))
+                    logger.error("\n%s" % (traceback.format_exc()))
+                    return {"err": "erreur decodage iq"}
             else:
                 self.result_iq = {"error": "type iq [%s] " % reponse_iq["type"]}
                 self.fin = True
@@ -244,6 +362,7 @@ class iq_custom_xep:
 
     def on_timeout(self, reponse_iq):
         self.reponse_iq = reponse_iq
+        peer_encodings.forget(self.to)
         er = "IQ type get id [%s] to [%s] in Timeout" % (
             reponse_iq["id"],
             reponse_iq["to"],
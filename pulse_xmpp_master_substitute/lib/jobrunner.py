@@ -0,0 +1,111 @@
+# -*- coding: utf-8; -*-
+# SPDX-FileCopyrightText: 2016-2023 Siveo <support@siveo.net>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import logging
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger()
+
+
+class JobRunner:
+    """
+    Exécute les travaux périodiques d'un plugin hors de la boucle slixmpp.
+
+    Chaque travail est déclaré par add(), qui le programme avec le
+    scheduler de l'agent. À l'échéance, la boucle ne fait que confier le
+    travail aux threads du runner (max_workers) : les requêtes en base ne
+    bloquent plus la réception des stanzas. Les messages envoyés par le
+    travail sont remis à la boucle par send_message de l'agent.
+
+    Un travail dont l'exécution précédente n'est pas terminée n'est pas
+    relancé. La durée de chaque exécution est gardée dans stats().
+    """
+
+    def __init__(self, objectxmpp, name, max_workers=4):
+        self.objectxmpp = objectxmpp
+        self.name = name
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=name
+        )
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    def add(self, name, interval, function):
+        """
+        Programme function toutes les interval secondes.
+        """
+        self._jobs[name] = {
+            "function": function,
+            "interval": interval,
+            "running": False,
+            "runs": 0,
+            "skipped": 0,
+            "failed": 0,
+            "last_start": None,
+            "last_duration": 0.0,
+            "max_duration": 0.0,
+            "total_duration": 0.0,
+        }
+        self.objectxmpp.schedule(name, interval, self.submit, args=(name,), repeat=True)
+
+    def submit(self, name):
+        """
+        Lance le travail name dans un thread du runner, sauf s'il tourne encore.
+        """
+        job = self._jobs[name]
+        with self._lock:
+            if job["running"]:
+                job["skipped"] += 1
+                logger.warning(
+                    "%s : job %s is still running (started %.1f s ago), "
+                    "this run is skipped"
+                    % (self.name, name, time.time() - job["last_start"])
+                )
+                return
+            job["running"] = True
+            job["last_start"] = time.time()
+        self._executor.submit(self._run, name, job)
+
+    def _run(self, name, job):
+        start = time.time()
+        try:
+            job["function"]()
+        except Exception:
+            job["failed"] += 1
+            logger.error("%s : job %s\n%s" % (self.name, name, traceback.format_exc()))
+        finally:
+            duration = time.time() - start
+            with self._lock:
+                job["running"] = False
+                job["runs"] += 1
+                job["last_duration"] = duration
+                job["total_duration"] += duration
+                job["max_duration"] = max(job["max_duration"], duration)
+            if duration > job["interval"]:
+                logger.warning(
+                    "%s : job %s took %.1f s, more than its interval of %s s"
+                    % (self.name, name, duration, job["interval"])
+                )
+            else:
+                logger.debug("%s : job %s took %.3f s" % (self.name, name, duration))
+
+    def stats(self):
+        """
+        Retourne les compteurs et les durées de chaque travail.
+        """
+        with self._lock:
+            return {
+                name: {
+                    key: value
+                    for key, value in job.items()
+                    if key not in ["function", "last_start"]
+                }
+                for name, job in self._jobs.items()
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8; -*-
+# SPDX-FileCopyrightText: 2016-2023 Siveo <support@siveo.net>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+Résolution des packages kiosk d'une machine.
+
+Un package d'un profil kiosk est proposé en Install/Ask, ou en
+Launch/Delete/Update s'il est déjà installé : il l'est si l'éditeur ou le
+nom d'un logiciel de l'inventaire GLPI de la machine commence par le
+logiciel du package (Qsoftware, sans tenir compte de la casse).
+"""
+
+import re
+import threading
+
+from lib.managepackage import managepackage, package_index
+
+# caractères spéciaux de regex non échappés dans le logiciel d'un package :
+# avec eux, le logiciel reste évalué comme une expression régulière
+_REGEX_CHARS = re.compile(r"[\\^$?\[\]{}|]")
+
+
+def software_pattern(software):
+    """
+    Retourne l'expression régulière du logiciel software d'un package.
+    """
+    return "(?i)" + (
+        software.replace("+", r"\+")
+        .replace("*", r"\*")
+        .replace("(", r"\(")
+        .replace(")", r"\)")
+        .replace(".", r"\.")
+    )
+
+
+class KioskResolver:
+    """
+    Caches de la résolution kiosk, partagés par toutes les machines.
+
+    Garde les expressions régulières compilées des logiciels des packages
+    et, pour chaque package, la commande de lancement et la présence d'une
+    étape de désinstallation lues dans son xmppdeploy.json. Les
+    informations d'un package sont relues quand package_index recharge son
+    descripteur (date de modification de xmppdeploy.json ou de conf.json).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rules = {}
+        self._packages = {}
+
+    def rule(self, software):
+        """
+        Retourne l'expression régulière compilée du logiciel software.
+        """
+        rule = self._rules.get(software)
+        if rule is None:
+            rule = re.compile(software_pattern(software))
+            with self._lock:
+                self._rules[software] = rule
+        return rule
+
+    def package(self, package_uuid):
+        """
+        Retourne {"launcher": commande, "uninstall": bool} pour le package
+        package_uuid, ou None si son descripteur est absent.
+        """
+        entry = package_index.bypath(managepackage.getpathpackage(package_uuid))
+        cached = self._packages.get(package_uuid)
+        if cached is not None and cached[0] is entry:
+            return cached[1]
+        info = None
+        descriptor = managepackage.getdescriptorpackageuuid(package_uuid)
+        if descriptor is not None:
+            info = {
+                "launcher": descriptor.get("info", {}).get("launcher", ""),
+                "uninstall": any(
+                    step.get("action") == "action_section_uninstall"
+                    for step in descriptor.get("win", {}).get("sequence", [])
+                ),
+            }
+        with self._lock:
+            self._packages[package_uuid] = (entry, info)
+        return info
+
+    def softwares(self, softwares, packages):
+        """
+        Retourne le SoftwareIndex des logiciels softwares ([éditeur, nom,
+        version] de l'inventaire GLPI) pour les logiciels des packages.
+        """
+        return SoftwareIndex(self, softwares, packages)
+
+
+class SoftwareIndex:
+    """
+    Logiciels installés sur une machine, indexés par préfixe.
+
+    Pour chaque longueur de logiciel de package, le dict des préfixes de
+    cette longueur des éditeurs et noms des logiciels donne le premier
+    logiciel de la liste qui commence par ce préfixe : trouver le logiciel
+    d'un package ne parcourt plus la liste. Seuls les logiciels de package
+    contenant un caractère spécial de regex sont évalués sur toute la liste.
+    """
+
+    def __init__(self, resolver, softwares, packages):
+        self.resolver = resolver
+        self.softwares = softwares
+        self.lengths = {
+            len(package.lower())
+            for package in packages
+            if package is not None and not _REGEX_CHARS.search(package)
+        }
+        self.prefixes = {}
+        for index, software in enumerate(softwares):
+            for value in (str(software[0]).lower(), str(software[1]).lower()):
+                for length in self.lengths:
+                    if len(value) >= length:
+                        self.prefixes.setdefault((length, value[:length]), index)
+
+    def find(self, package, version):
+        """
+        Retourne le premier logiciel installé correspondant au logiciel
+        package en version version, ou None.
+        """
+        if package is None:
+            return None
+        key = package.lower()
+        if len(key) in self.lengths and not _REGEX_CHARS.search(package):
+            index = self.prefixes.get((len(key), key))
+            return None if index is None else self.softwares[index]
+        rule = self.resolver.rule(package)
+        for software in self.softwares:
+            if (
+                rule.match(str(software[0]))
+                or rule.match(str(software[1]))
+                or (software[1] == package and software[2] == version)
+            ):
+                return software
+        return None
+
+
+kiosk_resolver = KioskResolver()
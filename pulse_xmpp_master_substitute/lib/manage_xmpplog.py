@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; -*-
+# SPDX-FileCopyrightText: 2016-2023 Siveo <support@siveo.net>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+Buffered writer for the xmpp logs received by the log substitute.
+
+The log lines and the deploy states found in them are queued in memory and
+written by a dedicated thread as multi-row INSERT / UPDATE batches, when
+batch_size entries are pending or after flush_interval seconds.
+"""
+
+import atexit
+import logging
+import queue
+import threading
+import time
+import traceback
+from datetime import datetime
+
+logger = logging.getLogger()
+
+LOG_COLUMNS = (
+    "text",
+    "type",
+    "sessionname",
+    "priority",
+    "who",
+    "how",
+    "why",
+    "module",
+    "action",
+    "touser",
+    "fromuser",
+)
+
+
+class XmppLogWriter:
+    """
+    Accumulates the Logs rows and the deploy state updates and flushes them
+    in batches through XmppMasterDatabase.
+
+    The in-memory queue is bounded by max_queue. When it is full, the caller
+    waits up to put_timeout seconds, then the entry is dropped and counted.
+    A batch the database refuses is retried by halves: only the rows that
+    cannot be written are dropped, logged and counted in errors.
+    """
+
+    def __init__(
+        self,
+        database,
+        batch_size=500,
+        flush_interval=1.0,
+        max_queue=20000,
+        put_timeout=5,
+    ):
+        self.database = database
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.stats = {"logs": 0, "status": 0, "flush": 0, "dropped": 0, "errors": 0}
+        self._stop = object()
+        self._stopped = False
+        self.thread = threading.Thread(
+            name="xmpplogwriter", target=self._run, daemon=True
+        )
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def add_log(self, text, **fields):
+        """
+        Queue a line for the logs table. The keyword arguments are the
+        columns of the table (type, sessionname, priority, who, ...).
+        """
+        row = {column: fields.get(column, "") for column in LOG_COLUMNS}
+        row["text"] = text
+        row["type"] = row["type"] or "noset"
+        row["priority"] = row["priority"] or 0
+        row["date"] = datetime.now()
+        self._put(("log", row))
+
+    def set_deploy_status(self, sessionid, status):
+        """
+        Queue the update of the deploy state of a session. If several states
+        are queued for the same session before a flush, the last one wins.
+        """
+        self._put(("status", (sessionid, status)))
+
+    def _put(self, item):
+        try:
+            self.queue.put(item, timeout=self.put_timeout)
+        except queue.Full:
+            self.stats["dropped"] += 1
+            logger.error(
+                "xmpplog queue full (%s entries): entry dropped" % self.queue.maxsize
+            )
+
+    def _run(self):
+        logs = []
+        status = {}
+        deadline = time.monotonic() + self.flush_interval
+        stopping = False
+        while not stopping:
+            try:
+                item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                if item is self._stop:
+                    stopping = True
+                elif item[0] == "log":
+                    logs.append(item[1])
+                else:
+                    sessionid, state = item[1]
+                    status.pop(sessionid, None)
+                    status[sessionid] = state
+            except queue.Empty:
+                pass
+            if (
+                stopping
+                or len(logs) + len(status) >= self.batch_size
+                or time.monotonic() >= deadline
+            ):
+                self._flush(logs, status)
+                logs = []
+                status = {}
+                deadline = time.monotonic() + self.flush_interval
+
+    def _flush(self, logs, status):
+        if not logs and not status:
+            return
+        if status:
+            self._write(
+                "status",
+                self.database.updatedeploytosessionid_bulk,
+                list(status.items()),
+                dict,
+            )
+        if logs:
+            self._write("logs", self.database.setlogxmpp_bulk, logs, list)
+        self.stats["flush"] += 1
+
+    def _write(self, kind, function, rows, build, failed=False):
+        """
+        Write the rows with function(build(rows)). When the batch fails, it is
+        split in two halves written separately, so that only the rows that
+        cannot be written are dropped.
+        """
+        try:
+            function(build(rows))
+            self.stats[kind] += len(rows)
+            return
+        except Exception:
+            if not failed:
+                logger.error(
+                    "xmpplog batch of %s %s failed, retrying it by halves\n%s"
+                    % (len(rows), kind, traceback.format_exc())
+                )
+            if len(rows) == 1:
+                self.stats["errors"] += 1
+                logger.error("xmpplog %s entry dropped: %s" % (kind, rows[0]))
+                return
+        half = len(rows) // 2
+        self._write(kind, function, rows[:half], build, True)
+        self._write(kind, function, rows[half:], build, True)
+
+    def stop(self, timeout=30):
+        """
+        Flush the pending entries and stop the writer thread.
+        """
+        if self._stopped:
+            return
+        self._stopped = True
+        self.queue.put(self._stop)
+        self.thread.join(timeout)
@@ -3,14 +3,31 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import glob
+import heapq
 import os
 import json
 import logging
+import sqlite3
+import threading
 from lib.utils import loadjsonfile
 from os import listdir
 import time
 import traceback
 
+# sessions saved by the session manager, one row per session
+SESSION_DATABASE = "sessions.db"
+
+
+def sessionreloadable(datasession):
+    """
+    True if the session is signaled to be reloaded after a restart.
+    """
+    return (
+        isinstance(datasession, dict)
+        and isinstance(datasession.get("data"), dict)
+        and datasession["data"].get("sessionreload") is True
+    )
+
 
 def clean_session(folder_session):
     tt = time.time()
@@ -34,6 +51,16 @@ def clean_session(folder_session):
         except BaseException:
             os.remove(fic)
             errorstr = "%s" % traceback.format_exc()
+    database = os.path.join(folder_session, SESSION_DATABASE)
+    if os.path.isfile(database):
+        try:
+            with sqlite3.connect(database) as connection:
+                connection.execute(
+                    "DELETE FROM session WHERE timevalid + updated < ?", (tt,)
+                )
+            connection.close()
+        except sqlite3.Error:
+            logging.getLogger().error("%s" % traceback.format_exc())
 
 
 class Session(Exception):
@@ -64,6 +91,9 @@ class sessiondatainfo:
     ):
         if datasession is None:
             datasession = {}
+        # manager session owning this session, set by session.addsessiondatainfo
+        self.manager = None
+        self._deadline = None
         self.sessionid = sessionid
         self.timevalid = timevalid
         self.datasession = datasession
@@ -74,6 +104,22 @@ class sessiondatainfo:
             raise Sessionpathsauvemissing
         logging.getLogger().debug("Creation manager session")
 
+    @property
+    def timevalid(self):
+        """
+        Number of ticks of the manager before the end of the session.
+        """
+        if self.manager is None:
+            return self._timevalid
+        return self._deadline - self.manager.tick
+
+    @timevalid.setter
+    def timevalid(self, value):
+        if self.manager is None:
+            self._timevalid = value
+        else:
+            self.manager.schedule(self, value)
+
     def jsonsession(self):
         session = {
             "sessionid": self.sessionid,
@@ -84,12 +130,15 @@ class sessiondatainfo:
 
     def sauvesession(self):
         """
-        Create file with the sessionid in the name.
-        It saves the file in the python pulse_xmpp_master_substitute folder.
+        Save the session now.
+        A session owned by a manager is written in its database, a standalone
+        session in a file named with the sessionid.
         Return:
-            It returns True if the file is well created.
+            It returns True if the session is well saved.
             False, otherwise
         """
+        if self.manager is not None:
+            return self.manager.flush([self.sessionid])
         namefilesession = os.path.join(self.pathfile, self.sessionid)
         session = {
             "sessionid": self.sessionid,
@@ -126,6 +175,7 @@ class sessiondatainfo:
             return False
         self.datasession = session["datasession"]
         self.timevalid = session["timevalid"]
+        self.setdirty()
         return True
 
     def removesessionfile(self):
@@ -136,21 +186,32 @@ class sessiondatainfo:
     def getdatasession(self):
         return self.datasession
 
+    def setdirty(self):
+        """
+        Mark the session to be saved at the next tick of the manager.
+        """
+        if self.manager is not None:
+            self.manager.setdirty(self)
+
     def setdatasession(self, data):
         self.datasession = data
-        return self.sauvesession()
+        if self.manager is None or sessionreloadable(data):
+            # a reloadable session precedes a restart of the machine
+            return self.sauvesession()
+        self.setdirty()
+        return True
 
     def decrementation(self):
         self.timevalid = self.timevalid - 1
-        if self.timevalid <= 0:
-            logging.getLogger().debug("call function end session")
-            self.callend()
+        if self.timevalid > 0:
             return True
-        else:
-            return self.sauvesession()
+        logging.getLogger().debug("call function end session")
+        self.callend()
+        return True
 
     def settimeout(self, timeminute=10):
         self.timevalid = timeminute
+        self.setdirty()
 
     def isexiste(self, sessionid):
         return sessionid == self.sessionid
@@ -172,9 +233,29 @@ class sessiondatainfo:
 
 
 class session:
+    """
+    Sessions of the agent, indexed by sessionid.
+
+    timevalid counts the calls of decrementesessiondatainfo (the ticks). The
+    end of each session is a deadline in a heap, so a tick only visits the
+    expired sessions. The removed or rescheduled entries of the heap are
+    ignored when they are popped.
+
+    The sessions are saved in the sqlite file sessions.db. A modified session
+    is only marked dirty, and the dirty sessions are written at the next tick;
+    a reloadable session is written at once, a restart may follow. The files
+    named after the sessionid written by the previous versions are still read
+    by loadsessions.
+    """
+
     def __init__(self, typemachine=None):
-        self.sessiondata = []
-        self.sessiondata = []
+        self.sessions = {}
+        self.tick = 0
+        self._deadlines = []  # heap (deadline, sessionid)
+        self._dirty = set()
+        self._removed = set()
+        self._lock = threading.RLock()
+        self._lock_write = threading.Lock()
         if typemachine is None:
             typemachine = "sessions"
         self.dirsavesession = os.path.join(
@@ -182,8 +263,117 @@ class session:
         )
         if not os.path.exists(self.dirsavesession):
             os.makedirs(self.dirsavesession, mode=0o007)
+        self.database = os.path.join(self.dirsavesession, SESSION_DATABASE)
+        self._execute(
+            "CREATE TABLE IF NOT EXISTS session "
+            "(sessionid TEXT PRIMARY KEY, timevalid INTEGER, "
+            "updated REAL, datasession TEXT)"
+        )
         logging.getLogger().debug("Manager Session : %s" % self.dirsavesession)
 
+    @property
+    def sessiondata(self):
+        with self._lock:
+            return list(self.sessions.values())
+
+    def _execute(self, request, parameters=(), many=False):
+        with self._lock_write:
+            try:
+                with sqlite3.connect(self.database) as connection:
+                    if many:
+                        connection.executemany(request, parameters)
+                    else:
+                        connection.execute(request, parameters)
+                connection.close()
+                return True
+            except sqlite3.Error:
+                logging.getLogger().error("%s" % traceback.format_exc())
+                return False
+
+    def schedule(self, sessiondatainfo, timevalid):
+        with self._lock:
+            sessiondatainfo._deadline = self.tick + timevalid
+            heapq.heappush(
+                self._deadlines, (sessiondatainfo._deadline, sessiondatainfo.sessionid)
+            )
+            if len(self._deadlines) > 2 * len(self.sessions) + 64:
+                self._deadlines = [
+                    (x._deadline, x.sessionid) for x in self.sessions.values()
+                ]
+                heapq.heapify(self._deadlines)
+
+    def setdirty(self, sessiondatainfo):
+        with self._lock:
+            if self.sessions.get(sessiondatainfo.sessionid) is sessiondatainfo:
+                self._dirty.add(sessiondatainfo.sessionid)
+
+    def flush(self, sessionids=None):
+        """
+        Write the dirty sessions (or the sessions sessionids) and delete the
+        removed ones from sessions.db.
+        """
+        rows = []
+        result = True
+        with self._lock:
+            if sessionids is None:
+                sessionids, self._dirty = self._dirty, set()
+            else:
+                self._dirty.difference_update(sessionids)
+            removed, self._removed = self._removed, set()
+            now = time.time()
+            for sessionid in sessionids:
+                obj = self.sessions.get(sessionid)
+                if obj is None:
+                    continue
+                try:
+                    rows.append(
+                        (
+                            sessionid,
+                            obj.timevalid,
+                            now,
+                            json.dumps(obj.datasession, separators=(",", ":")),
+                        )
+                    )
+                except (TypeError, ValueError) as e:
+                    logging.getLogger().error(
+                        "We encountered an issue while saving the session %s"
+                        % sessionid
+                    )
+                    logging.getLogger().error("The error is %s" % str(e))
+                    result = False
+        if removed:
+            result = (
+                self._execute(
+                    "DELETE FROM session WHERE sessionid = ?",
+                    [(x,) for x in removed],
+                    many=True,
+                )
+                and result
+            )
+        if rows:
+            result = (
+                self._execute(
+                    "INSERT OR REPLACE INTO session VALUES (?, ?, ?, ?)",
+                    rows,
+                    many=True,
+                )
+                and result
+            )
+        return result
+
+    def _remove(self, sessionid):
+        """
+        Remove the session from the index; returns it or None.
+        """
+        with self._lock:
+            obj = self.sessions.pop(sessionid, None)
+            if obj is not None:
+                self._dirty.discard(sessionid)
+                self._removed.add(sessionid)
+        if obj is not None:
+            obj.removesessionfile()
+        return obj
+
     def clearallfilesession(self):
         listfilesession = [
             x
@@ -192,14 +382,23 @@ class session:
         ]
         for filesession in listfilesession:
             os.remove(filesession)
-        self.sessiondata = []
+        with self._lock:
+            self.sessions = {}
+            self._deadlines = []
+            self._dirty = set()
+            self._removed = set()
+        self._execute("DELETE FROM session")
 
     def addsessiondatainfo(self, sessiondatainfo):
-        if self.isexist(sessiondatainfo.sessionid):
-            raise SessionAssertion
-        else:
-            self.sessiondata.append(sessiondatainfo)
-            return sessiondatainfo
+        with self._lock:
+            if self.isexist(sessiondatainfo.sessionid):
+                raise SessionAssertion
+            timevalid = sessiondatainfo.timevalid
+            sessiondatainfo.manager = self
+            self.sessions[sessiondatainfo.sessionid] = sessiondatainfo
+            self._removed.discard(sessiondatainfo.sessionid)
+            self.schedule(sessiondatainfo, timevalid)
+        return sessiondatainfo
 
     def createsessiondatainfo(
         self, sessionid, datasession={}, timevalid=10, eventend=None
@@ -208,9 +407,12 @@ class session:
         obj = sessiondatainfo(
             sessionid, datasession, timevalid, eventend, pathfile=self.dirsavesession
         )
-        self.sessiondata.append(obj)
+        with self._lock:
+            # a new session replaces the session with the same sessionid
+            self.sessions.pop(sessionid, None)
+            self.addsessiondatainfo(obj)
         if len(datasession) != 0:
-            obj.sauvesession()
+            obj.setdirty()
         return obj
 
     def removefilesessionifnotsignal(self, namefilesession):
@@ -223,12 +425,7 @@ class session:
             if os.path.isfile(namefilesession):
                 os.remove(namefilesession)
             return False
-        if (
-            "datasession" in session
-            and "data" in session["datasession"]
-            and "sessionreload" in session["datasession"]["data"]
-            and session["datasession"]["data"]["sessionreload"] is True
-        ):
+        if isinstance(session, dict) and sessionreloadable(session.get("datasession")):
             logging.getLogger().debug(
                 "Reload Session %s :  signaled reloadable" % self.dirsavesession
             )
@@ -250,6 +447,32 @@ class session:
         except Session as e:
             logging.getLogger().error("unable to read the list of session files")
             return False
+        try:
+            with sqlite3.connect(self.database) as connection:
+                rows = connection.execute(
+                    "SELECT sessionid, timevalid, datasession FROM session"
+                ).fetchall()
+            connection.close()
+        except sqlite3.Error:
+            logging.getLogger().error("%s" % traceback.format_exc())
+            rows = []
+        for sessionid, timevalid, datasession in rows:
+            try:
+                datasession = json.loads(datasession)
+            except ValueError:
+                datasession = {}
+            if not sessionreloadable(datasession):
+                logging.getLogger().debug("do not load session %s" % sessionid)
+                with self._lock:
+                    self._removed.add(sessionid)
+                continue
+            objsession = self.sessionfromsessiondata(sessionid)
+            if objsession is None:
+                objsession = self.createsessiondatainfo(sessionid)
+            objsession.datasession = datasession
+            objsession.timevalid = timevalid
+            logging.getLogger().debug("load session %s" % objsession)
+        # sessions saved in files by the previous versions
         for filesession in listfilesession:
             if self.removefilesessionifnotsignal(filesession):
                 try:
@@ -267,35 +490,47 @@ class session:
                     )
                     objsession.updatesessionfromfile()
                     logging.getLogger().debug("creation sesssion %s" % objsession)
+                objsession.removesessionfile()
             else:
                 logging.getLogger().debug("do not load session %s" % filesession)
+        self.flush()
         return True
 
     def sauvesessions(self):
-        for i in self.sessiondata:
-            i.sauvesession()
+        with self._lock:
+            self._dirty.update(self.sessions)
+        return self.flush()
 
     def sauvesessionid(self, sessionid):
-        for i in self.sessiondata:
-            for i in self.sessiondata:
-                if i.sessionid == sessionid:
-                    i.sauvesession()
-                    return i
-            return None
-
-    def __decr__(self, x):
-        if not x.decrementation():
-            self.clear(x.sessionid)
+        obj = self.sessionfromsessiondata(sessionid)
+        if obj is not None:
+            obj.sauvesession()
+        return obj
 
     def decrementesessiondatainfo(self):
-        list(filter(self.__decr__, self.sessiondata))
-        self.__suppsessiondatainfo__()
-
-    def __suppsessiondatainfo__(self):
-        datasessioninfo = [x for x in self.sessiondata if x.timevalid <= 0]
-        self.sessiondata = [x for x in self.sessiondata if x.timevalid > 0]
-        for i in datasessioninfo:
-            i.removesessionfile()
+        """
+        Advance the manager by one tick, end the expired sessions and write
+        the dirty ones.
+        """
+        expired = []
+        with self._lock:
+            self.tick += 1
+            while self._deadlines and self._deadlines[0][0] <= self.tick:
+                deadline, sessionid = heapq.heappop(self._deadlines)
+                obj = self.sessions.get(sessionid)
+                if obj is None or obj._deadline != deadline:
+                    continue
+                expired.append(obj)
+        for obj in expired:
+            logging.getLogger().debug("call function end session")
+            try:
+                obj.callend()
+            except Exception:
+                logging.getLogger().error("%s" % traceback.format_exc())
+            with self._lock:
+                if self.sessions.get(obj.sessionid) is obj and obj.timevalid <= 0:
+                    self._remove(obj.sessionid)
+        self.flush()
 
     def __aff__(self, x):
         if x is not None:
@@ -306,69 +541,56 @@ class session:
             print(x.sessionid)
 
     def len(self):
-        return len(self.sessiondata)
+        return len(self.sessions)
 
     def affiche(self):
         list(map(self.__aff__, self.sessiondata))
 
     def afficheid(self):
-        if len(self.sessiondata) != 0:
+        if len(self.sessions) != 0:
             print("liste session existe")
             list(map(self.__affid__, self.sessiondata))
 
     def sessionfromsessiondata(self, sessionid):
-        for i in self.sessiondata:
-            if i.sessionid == sessionid:
-                return i
-        return None
+        return self.sessions.get(sessionid)
 
     def reactualisesession(self, sessionid, timeminute=10):
-        for i in self.sessiondata:
-            if i.sessionid == sessionid:
-                i.settimeout(timeminute)
-                break
+        obj = self.sessions.get(sessionid)
+        if obj is not None:
+            obj.settimeout(timeminute)
 
     def clear(self, sessionid, objectxmpp=None):
-        for i in range(0, self.len()):
-            if sessionid == self.sessiondata[i].sessionid:
-                self.sessiondata[i].callend()
-                self.sessiondata[i].removesessionfile()
-                self.sessiondata.remove(self.sessiondata[i])
-                break
+        obj = self._remove(sessionid)
+        if obj is not None:
+            obj.callend()
         if objectxmpp is not None:
             objectxmpp.eventmanage.clear(sessionid)
 
     def clearnoevent(self, sessionid):
-        for i in range(0, self.len()):
-            if sessionid == self.sessiondata[i].sessionid:
-                self.sessiondata[i].removesessionfile()
-                self.sessiondata.remove(self.sessiondata[i])
-                break
+        self._remove(sessionid)
 
     def isexist(self, sessionid):
-        for i in self.sessiondata:
-            if i.sessionid == sessionid:
-                return True
-        return False
+        return sessionid in self.sessions
 
     def sessionevent(self, sessionid):
-        for i in self.sessiondata:
-            if i.sessionid == sessionid and i.eventend is not None:
-                return i
+        obj = self.sessions.get(sessionid)
+        if obj is not None and obj.eventend is not None:
+            return obj
         return None
 
     def sessionstop(self):
-        for i in range(0, self.len()):
-            self.sessiondata[i].sauvesession()
-        self.sessiondata = []
+        self.sauvesessions()
+        with self._lock:
+            self.sessions = {}
+            self._deadlines = []
 
     def sessionsetdata(self, sessionid, data):
-        for i in self.sessiondata:
-            if i.sessionid == sessionid:
-                i.setdatasession(data)
+        obj = self.sessions.get(sessionid)
+        if obj is not None:
+            obj.setdatasession(data)
 
     def sessiongetdata(self, sessionid):
-        for i in self.sessiondata:
-            if i.sessionid == sessionid:
-                return i.getdatasession()
+        obj = self.sessions.get(sessionid)
+        if obj is not None:
+            return obj.getdatasession()
         return None
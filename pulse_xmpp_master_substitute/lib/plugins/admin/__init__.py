@@ -23,6 +23,7 @@ from sqlalchemy.ext.automap import automap_base
 import functools
 
 from lib.configuration import confParameter
+from lib.plugins.utils.database_utils import schema_snapshot
 
 import traceback
 
@@ -113,7 +114,11 @@ class AdminDatabase(DatabaseHelper):
 
             self.is_activated = True
             self.logger.debug("Admin activation done")
-            if self.map() is True:
+            with schema_snapshot(
+                self.engine_admin_base, "admin", self.config.schema_snapshot
+            ):
+                mapped = self.map()
+            if mapped is True:
                 self.logger.debug("Admin mapping done")
             else:
                 self.logger.error("Admin mapping failed")
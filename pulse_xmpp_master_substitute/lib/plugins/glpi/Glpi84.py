@@ -58,6 +58,7 @@ from sqlalchemy.ext.automap import automap_base
 # TODO rename location into entity (and locations in location)
 
 from lib.plugins.utils.database_utils import fromUUID, toUUID, setUUID
+from lib.plugins.utils.database_utils import schema_snapshot
 
 from lib.plugins.utils.database_utils import DbTOA  # pyflakes.ignore
 
@@ -232,7 +233,8 @@ class Glpi84(DatabaseHelper):
             convert_unicode=True,
         )
         self.metadata = MetaData(self.engine_glpi)
-        self.initMappers()
+        with schema_snapshot(self.engine_glpi, "glpi", self.config.schema_snapshot):
+            self.initMappers()
         self.logger.info("Glpi is in version %s" % (self.glpi_version))
         self.metadata.create_all()
         logging.getLogger().debug(
@@ -25,6 +25,7 @@ from lib.plugins.kiosk.schema import (
 import logging
 import time
 from lib.configuration import confParameter
+from lib.plugins.utils.database_utils import session_registry, schema_snapshot
 import functools
 from datetime import datetime
 
@@ -33,7 +34,6 @@ try:
 except ImportError:
     from sqlalchemy.orm.base import _entity_descriptor
 
-from sqlalchemy.orm import scoped_session
 from sqlalchemy.ext.automap import automap_base
 
 Session = sessionmaker()
@@ -69,14 +69,22 @@ class DatabaseHelper(Singleton):
     def _sessionm(self, func):
         @functools.wraps(func)
         def __sessionm(self, *args, **kw):
-            session_factory = sessionmaker(bind=self.engine_kiosk_base)
-            sessionmultithread = scoped_session(session_factory)
-            result = func(self, sessionmultithread, *args, **kw)
-            sessionmultithread.remove()
-            return result
+            return session_registry(self.engine_kiosk_base).call(func, self, *args, **kw)
 
         return __sessionm
 
+    def unit_of_work(self):
+        """
+        Context manager running the decorated calls made inside the block
+        in one transaction.
+
+        eg:
+            with KioskDatabase().unit_of_work():
+                KioskDatabase().delete_profile(...)
+                KioskDatabase().create_profile(...)
+        """
+        return session_registry(self.engine_kiosk_base).unit_of_work()
+
 
 class KioskDatabase(DatabaseHelper):
     """
@@ -129,7 +137,10 @@ class KioskDatabase(DatabaseHelper):
             self.Sessionkiosk = sessionmaker(bind=self.engine_kiosk_base)
 
             Base = automap_base()
-            Base.prepare(self.engine_kiosk_base, reflect=True)
+            with schema_snapshot(
+                self.engine_kiosk_base, "kiosk", self.config.schema_snapshot
+            ):
+                Base.prepare(self.engine_kiosk_base, reflect=True)
 
             # Only federated tables (beginning by local_) are automatically mapped
             # If needed, excludes tables from this list
@@ -779,3 +790,72 @@ class KioskDatabase(DatabaseHelper):
                     }
                 )
         return result
+
+    @DatabaseHelper._sessionm
+    def get_acknowledges_for_package_profiles(self, session, ids_package_profil, user):
+        """
+        Same as get_acknowledges_for_package_profile for all the
+        package_has_profil ids of ids_package_profil, in one query.
+        """
+        if not ids_package_profil:
+            return []
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        result = []
+        try:
+            query = (
+                session.query(Acknowledgements, Profile_has_package.package_uuid)
+                .join(
+                    Profile_has_package,
+                    Profile_has_package.id == Acknowledgements.id_package_has_profil,
+                )
+                .filter(
+                    and_(
+                        Acknowledgements.id_package_has_profil.in_(
+                            list(ids_package_profil)
+                        ),
+                        Acknowledgements.askuser == user,
+                        Acknowledgements.startdate <= now,
+                        or_(
+                            Acknowledgements.enddate > now,
+                            Acknowledgements.enddate == None,
+                            Acknowledgements.enddate == "",
+                        ),
+                    )
+                )
+                .all()
+            )
+        except Exception as e:
+            self.logger.error(e)
+            return result
+
+        for element, package_uuid in query:
+            result.append(
+                {
+                    "askuser": element.askuser if element.askuser is not None else "",
+                    "askdate": (
+                        element.askdate.strftime("%Y-%m-%d %H:%M:%S")
+                        if element.askdate is not None
+                        else ""
+                    ),
+                    "acknowledgedbyuser": (
+                        element.acknowledgedbyuser
+                        if element.acknowledgedbyuser is not None
+                        else ""
+                    ),
+                    "startdate": (
+                        element.startdate.strftime("%Y-%m-%d %H:%M:%S")
+                        if element.startdate is not None
+                        else ""
+                    ),
+                    "enddate": (
+                        element.enddate.strftime("%Y-%m-%d %H:%M:%S")
+                        if element.enddate is not None
+                        else ""
+                    ),
+                    "status": element.status if element.status is not None else "",
+                    "id": element.id if element.id is not None else "",
+                    "id_package_has_profil": element.id_package_has_profil,
+                    "package_uuid": package_uuid,
+                }
+            )
+        return result
@@ -33,8 +33,6 @@ from sqlalchemy import (
 from sqlalchemy.orm import create_session, mapper, relation
 from sqlalchemy.exc import NoSuchTableError, TimeoutError
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm import scoped_session
 from sqlalchemy.ext.automap import automap_base
 import datetime
 
@@ -47,6 +45,7 @@ from lib.plugins.msc.orm.target import Target
 from lib.plugins.msc.orm.pull_targets import PullTargets
 from lib.plugins.msc.orm.bundle import Bundle
 from lib.configuration import confParameter
+from lib.plugins.utils.database_utils import session_registry, schema_snapshot
 from lib.plugins.xmpp import XmppMasterDatabase
 
 from lib.utils import Locker
@@ -200,14 +199,22 @@ class DatabaseHelper(Singleton):
     def _sessionm(self, func):
         @functools.wraps(func)
         def __sessionm(self, *args, **kw):
-            session_factory = sessionmaker(bind=self.engine_mscmmaster_base)
-            sessionmultithread = scoped_session(session_factory)
-            result = func(self, sessionmultithread, *args, **kw)
-            sessionmultithread.remove()
-            return result
+            return session_registry(self.engine_mscmmaster_base).call(func, self, *args, **kw)
 
         return __sessionm
 
+    def unit_of_work(self):
+        """
+        Context manager running the decorated calls made inside the block
+        in one transaction.
+
+        eg:
+            with MscDatabase().unit_of_work():
+                MscDatabase()._force_command_type(...)
+                MscDatabase()._set_command_ready(...)
+        """
+        return session_registry(self.engine_mscmmaster_base).unit_of_work()
+
 
 # TODO need to check for useless function (there should be many unused one...)
 
@@ -261,10 +268,13 @@ class MscDatabase(DatabaseHelper):
             )
 
             self.metadata = MetaData(self.engine_mscmmaster_base)
-            if not self.initTables():
-                return False
+            with schema_snapshot(
+                self.engine_mscmmaster_base, "msc", self.config.schema_snapshot
+            ):
+                if not self.initTables():
+                    return False
 
-            self.initMappers()
+                self.initMappers()
             self.metadata.create_all()
             # FIXME: should be removed
             self.session = create_session(bind=self.engine_mscmmaster_base)
@@ -1190,6 +1200,26 @@ class MscDatabase(DatabaseHelper):
                 self.logger.error("%s" % (traceback.format_exc()))
         return nb_machine_select_for_deploy_cycle, updatemachine
 
+    def _in_deployment_intervals(self, deployment_intervals, hour):
+        """
+        Tell if the hour is in the deployment intervals of a command
+        ("" means no constraint).
+        """
+        if deployment_intervals == "":
+            return True
+        # analyse si deploy true or false
+        tb = [
+            re.sub("[-'*;|@#\"]{1}", "-", x)
+            for x in deployment_intervals.split(",")
+            if self.pattern.match(x.strip())
+        ]
+        for c in tb:
+            start, end = c.split("-")
+            if hour >= int(start) and hour <= int(end):
+                # on a trouver 1 cas on deploy
+                return True
+        return False
+
     @DatabaseHelper._sessionm
     def test_deploy_in_partiel_slot(self, session, title):
         """
@@ -1212,20 +1242,35 @@ class MscDatabase(DatabaseHelper):
         res = query.first()
         if not res:
             return False
-        if res.deployment_intervals == "":
-            return True
-        # analyse si deploy true or false
-        tb = [
-            re.sub("[-'*;|@#\"]{1}", "-", x)
-            for x in res.deployment_intervals.split(",")
-            if self.pattern.match(x.strip())
-        ]
-        for c in tb:
-            start, end = c.split("-")
-            if hactuel >= int(start) and hactuel <= int(end):
-                # on a trouver 1 cas on deploy
-                return True
-        return False
+        return self._in_deployment_intervals(res.deployment_intervals, hactuel)
+
+    @DatabaseHelper._sessionm
+    def test_deploy_in_partiel_slots(self, session, titles):
+        """
+        Same as test_deploy_in_partiel_slot for several deployments, with one
+        query for all of them.
+        Args:
+            session: The SQL Alchemy session
+            titles: les noms des deployements.
+            Returns:
+                {title: True si la machine peut etre deployee}
+        """
+        hactuel = int(datetime.datetime.now().strftime("%H"))
+        result = {title: False for title in titles}
+        if not result:
+            return result
+        query = session.query(Commands.title, Commands.deployment_intervals).filter(
+            Commands.title.in_(list(result))
+        )
+        seen = set()
+        for res in query.all():
+            if res.title in seen or res.title not in result:
+                continue
+            seen.add(res.title)
+            result[res.title] = self._in_deployment_intervals(
+                res.deployment_intervals, hactuel
+            )
+        return result
 
     @DatabaseHelper._sessionm
     def get_deploy_inprogress_by_team_member(
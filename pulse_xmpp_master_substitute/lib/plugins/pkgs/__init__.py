@@ -22,8 +22,6 @@ from sqlalchemy import (
 )
 from sqlalchemy.orm import create_session, mapper
 from sqlalchemy.exc import NoSuchTableError
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm import scoped_session
 from sqlalchemy.ext.automap import automap_base
 
 # ORM mappings
@@ -40,6 +38,7 @@ from lib.plugins.pkgs.orm.pkgs_shares_ars_web import Pkgs_shares_ars_web
 from lib.plugins.pkgs.orm.pkgs_shares import Pkgs_shares
 
 from lib.configuration import confParameter
+from lib.plugins.utils.database_utils import session_registry, schema_snapshot
 from lib.plugins.xmpp import XmppMasterDatabase
 
 # Imported last
@@ -63,14 +62,22 @@ class DatabaseHelper(Singleton):
     def _sessionm(self, func1):
         @functools.wraps(func1)
         def __sessionm(self, *args, **kw):
-            session_factory = sessionmaker(bind=self.engine_pkgsmmaster_base)
-            sessionmultithread = scoped_session(session_factory)
-            result = func1(self, sessionmultithread, *args, **kw)
-            sessionmultithread.remove()
-            return result
+            return session_registry(self.engine_pkgsmmaster_base).call(func1, self, *args, **kw)
 
         return __sessionm
 
+    def unit_of_work(self):
+        """
+        Context manager running the decorated calls made inside the block
+        in one transaction.
+
+        eg:
+            with PkgsDatabase().unit_of_work():
+                PkgsDatabase().remove_package(...)
+                PkgsDatabase().refresh_dependencies(...)
+        """
+        return session_registry(self.engine_pkgsmmaster_base).unit_of_work()
+
 
 # TODO need to check for useless function (there should be many unused one...)
 
@@ -124,10 +131,13 @@ class PkgsDatabase(DatabaseHelper):
             )
 
             self.metadata = MetaData(self.engine_pkgsmmaster_base)
-            if not self.initTables():
-                return False
+            with schema_snapshot(
+                self.engine_pkgsmmaster_base, "pkgs", self.config.schema_snapshot
+            ):
+                if not self.initTables():
+                    return False
 
-            self.initMappers()
+                self.initMappers()
             self.metadata.create_all()
             # FIXME: should be removed
             self.session = create_session(bind=self.engine_pkgsmmaster_base)
@@ -8,8 +8,19 @@
 This module just give access to small functions needed by both 0.7 and 0.8 backend
 """
 
+import copy
+import hashlib
 import logging
+import os
+import pickle
 import re
+import threading
+from contextlib import contextmanager
+
+import sqlalchemy
+from sqlalchemy import text
+from sqlalchemy.engine.reflection import Inspector
+from sqlalchemy.orm import sessionmaker, scoped_session
 
 
 def grepv(string, list):
@@ -71,3 +82,291 @@ def setUUID(obj):
     else:
         logging.getLogger().error("Can't get id for %s => no UUID" % (str(obj)))
     return obj
+
+
+class UnitOfWorkSession(object):
+    """
+    Session given to the decorated methods called inside a unit of work.
+
+    commit() only flushes and close() does nothing: the transaction is
+    committed once, when the unit of work ends. A rollback() done by one of
+    the methods rolls back the whole unit.
+    """
+
+    def __init__(self, session):
+        self._session = session
+        self.rolled_back = False
+
+    def commit(self):
+        self._session.flush()
+
+    def close(self):
+        pass
+
+    def remove(self):
+        pass
+
+    def rollback(self):
+        self.rolled_back = True
+        self._session.rollback()
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+
+class SessionRegistry(object):
+    """
+    sessionmaker and scoped_session of an engine, built once and shared by
+    all the methods decorated with DatabaseHelper._sessionm.
+
+    A decorated method called from another one on the same thread reuses the
+    session of the caller; the session is removed when the outermost call
+    returns.
+    """
+
+    def __init__(self, engine):
+        self.factory = sessionmaker(bind=engine)
+        self.scoped = scoped_session(self.factory)
+        self._local = threading.local()
+
+    def call(self, func, obj, *args, **kw):
+        local = self._local
+        unit = getattr(local, "unit", None)
+        if unit is not None:
+            return func(obj, unit, *args, **kw)
+        depth = getattr(local, "depth", 0)
+        local.depth = depth + 1
+        try:
+            return func(obj, self.scoped, *args, **kw)
+        finally:
+            local.depth = depth
+            if depth == 0:
+                self.scoped.remove()
+
+    @contextmanager
+    def unit_of_work(self):
+        """
+        Run all the decorated calls made on this thread inside the block in
+        one transaction, committed at the end of the block or rolled back if
+        an exception is raised. A nested unit of work joins the current one.
+        """
+        local = self._local
+        if getattr(local, "unit", None) is not None:
+            yield local.unit
+            return
+        session = self.factory()
+        unit = UnitOfWorkSession(session)
+        local.unit = unit
+        try:
+            yield unit
+            if unit.rolled_back:
+                session.rollback()
+                logging.getLogger().error(
+                    "unit of work rolled back by one of its operations"
+                )
+            else:
+                session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            local.unit = None
+            session.close()
+
+
+_session_registries = {}
+_session_registries_lock = threading.Lock()
+
+
+def session_registry(engine):
+    """
+    Return the SessionRegistry of the engine, created on the first call.
+    """
+    registry = _session_registries.get(engine)
+    if registry is None:
+        with _session_registries_lock:
+            registry = _session_registries.get(engine)
+            if registry is None:
+                registry = SessionRegistry(engine)
+                _session_registries[engine] = registry
+    return registry
+
+
+# information_schema queries whose results change with the schema of the
+# database: columns, indexes, constraints and tables
+_MYSQL_SCHEMA_VERSION = [
+    "SELECT COUNT(*), COALESCE(SUM(CRC32(CONCAT_WS('|', TABLE_NAME, COLUMN_NAME,"
+    " ORDINAL_POSITION, COLUMN_TYPE, IS_NULLABLE, COLUMN_KEY,"
+    " IFNULL(COLUMN_DEFAULT, 'NULL'), EXTRA))), 0)"
+    " FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE()",
+    "SELECT COUNT(*), COALESCE(SUM(CRC32(CONCAT_WS('|', TABLE_NAME, INDEX_NAME,"
+    " SEQ_IN_INDEX, COLUMN_NAME, NON_UNIQUE))), 0)"
+    " FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE()",
+    "SELECT COUNT(*), COALESCE(SUM(CRC32(CONCAT_WS('|', TABLE_NAME,"
+    " CONSTRAINT_NAME, COLUMN_NAME, ORDINAL_POSITION,"
+    " IFNULL(REFERENCED_TABLE_NAME, ''), IFNULL(REFERENCED_COLUMN_NAME, '')))), 0)"
+    " FROM information_schema.KEY_COLUMN_USAGE WHERE TABLE_SCHEMA = DATABASE()",
+    "SELECT COUNT(*), COALESCE(SUM(CRC32(CONCAT_WS('|', TABLE_NAME, TABLE_TYPE,"
+    " IFNULL(ENGINE, ''), IFNULL(TABLE_COLLATION, '')))), 0)"
+    " FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE()",
+]
+
+
+def schema_version(connection):
+    """
+    Return a string which changes whenever the schema of the database of the
+    connection changes. It is computed from the catalog of the database, in
+    a few queries whatever the number of tables.
+    """
+    dialect = connection.dialect.name
+    if dialect == "sqlite":
+        queries = ["PRAGMA schema_version"]
+    elif dialect == "mysql":
+        queries = _MYSQL_SCHEMA_VERSION
+    else:
+        return None
+    result = [dialect]
+    for query in queries:
+        result.extend(str(x) for x in connection.execute(text(query)).fetchone())
+    return ":".join(result)
+
+
+class _SnapshotCache(dict):
+    """
+    Reflection cache whose results are copied : reflect_table() reorders the
+    lists it gets from the cache, which would change the order of the
+    columns of the tables reflected afterwards.
+    """
+
+    def get(self, key, default=None):
+        if key in self:
+            return copy.deepcopy(dict.__getitem__(self, key))
+        return default
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, copy.deepcopy(value))
+
+
+class SchemaSnapshot(object):
+    """
+    Results of the reflection of a database, kept on disk between two starts.
+
+    SQLAlchemy reflects a table (Table(..., autoload=True),
+    automap_base().prepare(reflect=True)) through the Inspector of the
+    engine, which queries the database for each table. While the snapshot
+    is installed, every Inspector of the engine shares the cache of the
+    snapshot: a table found in the snapshot is not queried again.
+
+    The snapshot is saved when it is uninstalled if it learnt new results.
+    It is discarded if the schema version of the database (see
+    schema_version), the SQLAlchemy version or the url of the database
+    changed since it was saved.
+    """
+
+    FORMAT = 1
+
+    def __init__(self, engine, name, directory):
+        self.engine = engine
+        self.name = name
+        self.directory = directory
+        self.filename = os.path.join(directory, "%s.snapshot" % name)
+        self.cache = _SnapshotCache()
+        self.loaded = 0
+        self.key = None
+        self._inspector = None
+
+    def _key(self):
+        with self.engine.connect() as connection:
+            version = schema_version(connection)
+        if version is None:
+            return None
+        url = repr(self.engine.url)
+        return hashlib.md5(
+            (
+                "%s|%s|%s|%s" % (self.FORMAT, sqlalchemy.__version__, url, version)
+            ).encode("utf-8")
+        ).hexdigest()
+
+    def load(self):
+        try:
+            self.key = self._key()
+        except Exception as e:
+            logging.getLogger().warning(
+                "schema version of %s not available : %s" % (self.name, e)
+            )
+            self.key = None
+        if self.key is None or not os.path.isfile(self.filename):
+            return
+        try:
+            with open(self.filename, "rb") as snapshot:
+                content = pickle.load(snapshot)
+        except Exception as e:
+            logging.getLogger().warning(
+                "schema snapshot %s is unreadable : %s" % (self.filename, e)
+            )
+            return
+        if content.get("key") != self.key:
+            logging.getLogger().info(
+                "schema of %s changed, its tables are reflected again" % self.name
+            )
+            return
+        for key, value in content["cache"].items():
+            dict.__setitem__(self.cache, key, value)
+        self.loaded = len(self.cache)
+
+    def save(self):
+        if self.key is None or len(self.cache) == self.loaded:
+            return
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory, mode=0o700)
+            with open(self.filename + ".tmp", "wb") as snapshot:
+                pickle.dump({"key": self.key, "cache": dict(self.cache)}, snapshot)
+            os.replace(self.filename + ".tmp", self.filename)
+            self.loaded = len(self.cache)
+        except Exception as e:
+            logging.getLogger().warning(
+                "schema snapshot %s cannot be saved : %s" % (self.filename, e)
+            )
+
+    def install(self):
+        dialect = self.engine.dialect
+        self._inspector = dialect.__dict__.get("inspector")
+        base = getattr(dialect, "inspector", Inspector)
+        cache = self.cache
+
+        class SnapshotInspector(base):
+            # Inspector sets info_cache to a new dict when it is created :
+            # every Inspector of the engine uses the cache of the snapshot
+            info_cache = property(lambda self: cache, lambda self, value: None)
+
+        dialect.inspector = SnapshotInspector
+
+    def uninstall(self):
+        dialect = self.engine.dialect
+        if self._inspector is None:
+            del dialect.inspector
+        else:
+            dialect.inspector = self._inspector
+
+
+@contextmanager
+def schema_snapshot(engine, name, directory):
+    """
+    Reflect the tables of the engine inside the block from the snapshot name
+    kept in directory (no snapshot if directory is empty).
+
+    The Inspectors of the engine created after the block query the database
+    again, so that a table created at runtime is seen.
+    """
+    if not directory:
+        yield None
+        return
+    snapshot = SchemaSnapshot(engine, name, directory)
+    snapshot.load()
+    snapshot.install()
+    try:
+        yield snapshot
+    finally:
+        snapshot.uninstall()
+    snapshot.save()
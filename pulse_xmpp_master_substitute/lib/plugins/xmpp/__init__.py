@@ -103,6 +103,7 @@ if sys.platform == "win32":
 # without this iqsendpulse can't work.
 
 from lib.configuration import confParameter
+from lib.plugins.utils.database_utils import session_registry, schema_snapshot
 from lib.utils import (
     getRandomName,
     simplecommandstr,
@@ -118,7 +119,6 @@ try:
 except ImportError:
     from sqlalchemy.orm.base import _entity_descriptor
 
-from sqlalchemy.orm import scoped_session
 import random
 
 if sys.version_info >= (3, 0, 0):
@@ -205,14 +205,22 @@ class DatabaseHelper(Singleton):
     def _sessionm(self, func):
         @functools.wraps(func)
         def __sessionm(self, *args, **kw):
-            session_factory = sessionmaker(bind=self.engine_xmppmmaster_base)
-            sessionmultithread = scoped_session(session_factory)
-            result = func(self, sessionmultithread, *args, **kw)
-            sessionmultithread.remove()
-            return result
+            return session_registry(self.engine_xmppmmaster_base).call(func, self, *args, **kw)
 
         return __sessionm
 
+    def unit_of_work(self):
+        """
+        Context manager running the decorated calls made inside the block
+        in one transaction.
+
+        eg:
+            with XmppMasterDatabase().unit_of_work():
+                XmppMasterDatabase().updatedeploystate(...)
+                XmppMasterDatabase().setlogxmpp(...)
+        """
+        return session_registry(self.engine_xmppmmaster_base).unit_of_work()
+
 
 class XmppMasterDatabase(DatabaseHelper):
     """
@@ -276,7 +284,10 @@ class XmppMasterDatabase(DatabaseHelper):
             self.Sessionxmpp = sessionmaker(bind=self.engine_xmppmmaster_base)
 
             Base = automap_base()
-            Base.prepare(self.engine_xmppmmaster_base, reflect=True)
+            with schema_snapshot(
+                self.engine_xmppmmaster_base, "xmppmaster", self.config.schema_snapshot
+            ):
+                Base.prepare(self.engine_xmppmmaster_base, reflect=True)
 
             # Only federated tables (beginning by local_) are automatically mapped
             # If needed, excludes tables from this list
@@ -506,6 +517,28 @@ class XmppMasterDatabase(DatabaseHelper):
         except Exception as e:
             logging.getLogger().error(str(e))
 
+    @DatabaseHelper._sessionm
+    def setlogxmpp_bulk(self, session, logs):
+        """
+        this functions addition several log lines in table log xmpp
+        with one multi-row insert.
+
+        Args:
+            logs: list of dict, the keys are the columns of the logs table.
+                All the dicts must have the same keys.
+
+        Raises:
+            Exception: the insert failed, nothing was written.
+        """
+        if not logs:
+            return
+        try:
+            session.execute(Logs.__table__.insert(), logs)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
     @DatabaseHelper._sessionm
     def search_machines_from_state(self, session, state):
         dateend = datetime.now()
@@ -638,6 +671,32 @@ class XmppMasterDatabase(DatabaseHelper):
         except Exception as e:
             logging.getLogger().error(str(e))
 
+    @DatabaseHelper._sessionm
+    def update_state_deploys(self, session, sql_ids, state):
+        """
+        Set the state of the deploiements `sql_ids` to `state`,
+        with one UPDATE for 1000 deploiements
+        Args:
+            session: The SQL Alchemy session
+            sql_ids: The ids of the deploiements to update
+            state: The new state of the deploiements
+        """
+        sql_ids = [int(x) for x in sql_ids]
+        try:
+            for index in range(0, len(sql_ids), 1000):
+                sql = """UPDATE `xmppmaster`.`deploy`
+                         SET `state`='%s'
+                         WHERE `id` IN (%s);""" % (
+                    state,
+                    ",".join([str(x) for x in sql_ids[index : index + 1000]]),
+                )
+                session.execute(sql)
+            session.commit()
+            session.flush()
+        except Exception as e:
+            session.rollback()
+            logging.getLogger().error(str(e))
+
     def replaydeploysessionid(self, sessionid, force_redeploy=0, reschedule=0):
         """
         Call the mmc_restart_deploy_sessionid stored procedure
@@ -732,6 +791,30 @@ class XmppMasterDatabase(DatabaseHelper):
         except Exception as e:
             logging.getLogger().error(str(e))
 
+    @DatabaseHelper._sessionm
+    def updatedeploytosessionid_bulk(self, session, status_by_sessionid):
+        """
+        Update the state of several deployments, with one UPDATE per state.
+
+        Args:
+            status_by_sessionid: dict sessionid -> new state.
+
+        Raises:
+            Exception: the update failed, no state was changed.
+        """
+        sessionids_by_status = {}
+        for sessionid, status in status_by_sessionid.items():
+            sessionids_by_status.setdefault(status, []).append(sessionid)
+        try:
+            for status, sessionids in sessionids_by_status.items():
+                session.query(Deploy).filter(Deploy.sessionid.in_(sessionids)).update(
+                    {Deploy.state: status}, synchronize_session=False
+                )
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
     @DatabaseHelper._sessionm
     def updatedeploytosyncthing(self, session, sessionid, syncthing=1):
         try:
@@ -770,6 +853,42 @@ class XmppMasterDatabase(DatabaseHelper):
             logging.getLogger().error(str(e))
             return 0
 
+    @DatabaseHelper._sessionm
+    def nbsyncthingdeploys(self, session, grp_cmds):
+        """
+        Count the syncthing deploiements of several (group, command), in one
+        query
+        Args:
+            session: The SQL Alchemy session
+            grp_cmds: list of (group_uuid, command)
+        Returns:
+            {(group_uuid, command): number of syncthing deploiements}
+        """
+        result = {(grp, cmd): 0 for grp, cmd in grp_cmds}
+        if not result:
+            return result
+        try:
+            sql = """SELECT
+                        group_uuid, command, COUNT(*) as nb
+                    FROM
+                        deploy
+                    WHERE
+                        command IN (%s)
+                            AND syncthing > 1
+                    GROUP BY group_uuid, command;""" % ",".join(
+                set([str(int(cmd)) for _, cmd in result])
+            )
+            req = session.execute(sql)
+            session.commit()
+            session.flush()
+            for grp, cmd, nb in req:
+                if (grp, cmd) in result:
+                    result[(grp, cmd)] = nb
+            return result
+        except Exception as e:
+            logging.getLogger().error(str(e))
+            return result
+
     @DatabaseHelper._sessionm
     def getQAforMachine(self, session, cmd_id, uuidmachine):
         try:
@@ -6285,6 +6404,92 @@ class XmppMasterDatabase(DatabaseHelper):
                 "We encountered the backtrace: \n%s" % traceback.format_exc()
             )
 
+    @DatabaseHelper._sessionm
+    def update_Presence_Relays(self, session, jids, presence=0):
+        """
+        Update the presence of several relays in the relay and machine SQL
+        Tables, in one transaction
+        Args:
+            session: The SQL Alchemy session
+            jids: list of the jids of the relays to update
+            presence: Availability of the relays
+                      0: Set the relays as offline
+                      1: Set the relays as online
+        """
+        if not jids:
+            return
+        try:
+            for jid in jids:
+                user = str(jid).split("@")[0]
+                for table in ["machines", "relayserver"]:
+                    sql = """UPDATE
+                                `xmppmaster`.`%s`
+                            SET
+                                `enabled` = '%s'
+                            WHERE
+                                `xmppmaster`.`%s`.`jid` like('%s@%%') limit 1;""" % (
+                        table,
+                        presence,
+                        table,
+                        user,
+                    )
+                    session.execute(sql)
+            session.commit()
+            session.flush()
+        except Exception as e:
+            session.rollback()
+            logging.getLogger().error(
+                "Function : update_Presence_Relays, we got the error: %s" % str(e)
+            )
+            logging.getLogger().error(
+                "We encountered the backtrace: \n%s" % traceback.format_exc()
+            )
+
+    @DatabaseHelper._sessionm
+    def is_machines_reconf_needed(self, session, jids, reconf=1):
+        """
+        Tell if we need to start a reconfiguration of the machines assigned to
+        several relays, in one query.
+        Args:
+            session: The SQL Alchemy session
+            jids: list of the jids of the relays
+            reconf: Tell if we need to reconfigure the machines.
+                    0: No reconf needed
+                    1: A reconfigurtion is needed
+        """
+        if not jids:
+            return
+        try:
+            groupdeploy = " OR ".join(
+                [
+                    "`xmppmaster`.`machines`.`groupdeploy` like('%s@%%')"
+                    % str(jid).split("@")[0]
+                    for jid in jids
+                ]
+            )
+            set_reconf = """UPDATE
+                        `xmppmaster`.`machines`
+                     SET
+                        `need_reconf` = '%s'
+                     WHERE
+                        `xmppmaster`.`machines`.`agenttype` like ("machine")
+                        AND
+                        (%s);""" % (
+                reconf,
+                groupdeploy,
+            )
+            session.execute(set_reconf)
+            session.commit()
+            session.flush()
+        except Exception as e:
+            session.rollback()
+            logging.getLogger().error(
+                "Function : is_machines_reconf_needed, we got the error: %s " % str(e)
+            )
+            logging.getLogger().error(
+                "We encountered the backtrace: \n%s" % traceback.format_exc()
+            )
+
     @DatabaseHelper._sessionm
     def delPresenceMachine(self, session, jid):
         result = ["-1"]
@@ -7790,6 +7995,67 @@ class XmppMasterDatabase(DatabaseHelper):
             logging.getLogger().error("we encounterd the error: %s" % str(e))
             return False
 
+    @DatabaseHelper._sessionm
+    def updateMachineRegistration(self, session, jid, hostname, sections):
+        """
+        Applies in one transaction a registration whose only changes are in
+        the sections of the dict sections, and sets the machine online.
+        Args:
+            session: The sqlalchemy session
+            jid: The jid of the machine
+            hostname: The hostname of the machine (table uptime_machine)
+            sections: dict section -> values to write. Known sections are
+                      "agent" (md5agentversion, versionagent) and
+                      "deployment" (groupdeploy, urlguacamole).
+        Returns:
+            True if the machine was found and updated, False otherwise.
+        """
+        try:
+            values = {Machines.enabled: 1}
+            if "deployment" in sections:
+                values[Machines.groupdeploy] = sections["deployment"]["groupdeploy"]
+                values[Machines.urlguacamole] = sections["deployment"]["urlguacamole"]
+            updated = (
+                session.query(Machines)
+                .filter(Machines.jid == jid)
+                .update(values, synchronize_session=False)
+            )
+            if not updated:
+                session.rollback()
+                return False
+            if "agent" in sections:
+                uptime = (
+                    session.query(Uptime_machine.id)
+                    .filter(
+                        and_(
+                            Uptime_machine.hostname.like(hostname),
+                            Uptime_machine.status == 1,
+                        )
+                    )
+                    .order_by(desc(Uptime_machine.id))
+                    .first()
+                )
+                if uptime is not None:
+                    session.query(Uptime_machine).filter(
+                        Uptime_machine.id == uptime.id
+                    ).update(
+                        {
+                            Uptime_machine.md5agentversion: sections["agent"][
+                                "md5agentversion"
+                            ],
+                            Uptime_machine.version: sections["agent"]["versionagent"],
+                        },
+                        synchronize_session=False,
+                    )
+            session.commit()
+            return True
+        except Exception as e:
+            session.rollback()
+            logging.getLogger().error(
+                "We failed to update the registration of %s : %s" % (jid, str(e))
+            )
+            return False
+
     @DatabaseHelper._sessionm
     def last_event_presence_xmpp(self, session, jid, nb=1):
         """
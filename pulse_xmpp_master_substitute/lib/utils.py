@@ -40,6 +40,7 @@ import string
 import asyncio as aio
 
 import importlib.util
+from concurrent.futures import ThreadPoolExecutor, Future
 
 if sys.platform == "win32":
     aio.set_event_loop_policy(aio.WindowsSelectorEventLoopPolicy())
@@ -56,7 +57,7 @@ import inspect
 
 import xml.dom.minidom
 import xml.etree.ElementTree as ET
-from collections import OrderedDict
+from collections import OrderedDict, deque
 
 
 if sys.platform.startswith("win"):
@@ -754,6 +755,39 @@ def md5(fname):
     return hash.hexdigest()
 
 
+_package_files_hash = {}
+_package_files_hash_lock = threading.Lock()
+
+
+def package_files_hash(path):
+    """
+    Retourne {nom du fichier: sha256} des fichiers du package path.
+
+    Les agents machine rangent les fichiers téléchargés en pullcurl sous
+    cette empreinte. Elle n'est recalculée que si la taille ou la date de
+    modification du fichier change.
+    """
+    result = {}
+    for filename in os.listdir(path):
+        filepath = os.path.join(path, filename)
+        if not os.path.isfile(filepath):
+            continue
+        stat = os.stat(filepath)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        with _package_files_hash_lock:
+            entry = _package_files_hash.get(filepath)
+        if entry is None or entry[0] != signature:
+            hash = hashlib.sha256()
+            with open(filepath, "rb") as f:
+                for chunk in iter(lambda: f.read(65536), b""):
+                    hash.update(chunk)
+            entry = (signature, hash.hexdigest())
+            with _package_files_hash_lock:
+                _package_files_hash[filepath] = entry
+        result[filename] = entry[1]
+    return result
+
+
 # def load_plugin(name):
 # mod = __import__("plugin_%s" % name)
 # return mod
@@ -800,6 +834,293 @@ def loadModule(filename):
     return module
 
 
+class PluginRegistry:
+    """
+    Registre des modules de plugins déjà chargés.
+
+    Chaque module est conservé sous son chemin avec la signature
+    (mtime, taille) du fichier au moment du chargement. Le plugin n'est
+    réimporté que si cette signature change, par exemple après un
+    installplugin ou un updateagent, ou après un appel à invalidate().
+    """
+
+    def __init__(self):
+        self._modules = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _signature(filename):
+        stat = os.stat(filename)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def get(self, filename):
+        """
+        Retourne le module du plugin, chargé depuis le cache si le fichier
+        n'a pas changé.
+
+        :param filename: Le chemin d'accès au fichier du plugin.
+        :type filename: str
+        :return: Le module chargé ou None si le fichier n'existe pas ou ne se
+            charge pas.
+        :rtype: module
+        """
+        try:
+            signature = self._signature(filename)
+        except OSError:
+            self.invalidate(filename)
+            return None
+        with self._lock:
+            entry = self._modules.get(filename)
+        if entry is not None and entry[0] == signature:
+            return entry[1]
+        module = loadModule(filename)
+        with self._lock:
+            if module is None:
+                self._modules.pop(filename, None)
+            else:
+                self._modules[filename] = (signature, module)
+        return module
+
+    def invalidate(self, filename=None):
+        """
+        Oublie le module d'un plugin, ou de tous les plugins si filename est None.
+        """
+        with self._lock:
+            if filename is None:
+                self._modules.clear()
+            else:
+                self._modules.pop(filename, None)
+
+
+plugin_registry = PluginRegistry()
+
+
+class PluginWorkerPool:
+    """
+    Pool de threads partagé qui exécute les actions des plugins d'un agent.
+
+    Un seul ThreadPoolExecutor borné est créé par agent. Chaque action peut
+    avoir une limite de concurrence (voie) : au-delà, les messages attendent
+    dans la file de leur action sans occuper de thread. Le nombre total de
+    messages en attente ou en cours est borné par max_queue ; quand la borne
+    est atteinte, submit rejette le message appelé depuis la boucle asyncio
+    (elle ne doit jamais attendre), et bloque les autres appelants au plus
+    queue_timeout secondes (contre-pression) avant de le rejeter.
+
+    Le pool appartient à un agent (MUCBot) : shutdown() est appelé quand
+    l'agent s'arrête, les actions en attente sont alors annulées.
+    """
+
+    def __init__(
+        self, max_workers=20, max_queue=500, queue_timeout=30, action_limits=None
+    ):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.action_limits = dict(action_limits or {})
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="plugin"
+        )
+        self._condition = threading.Condition()
+        self._pending = 0
+        self._waiting = {}
+        self._actions = {}
+        self._shutdown = False
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Construit le pool à partir des paramètres plugin_pool_* de la configuration.
+        """
+        return cls(
+            max_workers=getattr(config, "plugin_pool_max_workers", 20),
+            max_queue=getattr(config, "plugin_pool_max_queue", 500),
+            queue_timeout=getattr(config, "plugin_pool_queue_timeout", 30),
+            action_limits=getattr(config, "plugin_pool_action_limits", {}),
+        )
+
+    def _action_stats(self, action):
+        if action not in self._actions:
+            self._actions[action] = {
+                "running": 0,
+                "waiting": 0,
+                "submitted": 0,
+                "completed": 0,
+                "failed": 0,
+                "rejected": 0,
+            }
+        return self._actions[action]
+
+    def submit(self, action, function, args=(), kwargs=None):
+        """
+        Soumet l'exécution de function(*args, **kwargs) dans la voie de l'action.
+
+        :param action: Le nom de l'action (plugin) qui détermine la voie.
+        :type action: str
+        :return: Un concurrent.futures.Future, ou None si le message est rejeté
+            parce que la file est pleine.
+        :rtype: Future
+        """
+        kwargs = kwargs or {}
+        future = Future()
+        try:
+            aio.get_running_loop()
+            # appel depuis la boucle d'evenements : pas d'attente
+            deadline = time.monotonic()
+        except RuntimeError:
+            deadline = time.monotonic() + self.queue_timeout
+        with self._condition:
+            stats = self._action_stats(action)
+            if self._shutdown:
+                stats["rejected"] += 1
+                return None
+            while self._pending >= self.max_queue:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._shutdown:
+                    stats["rejected"] += 1
+                    logging.getLogger().error(
+                        "plugin pool full (%s messages): action %s rejected"
+                        % (self._pending, action)
+                    )
+                    return None
+                self._condition.wait(remaining)
+            self._pending += 1
+            stats["submitted"] += 1
+            limit = self.action_limits.get(action, 0)
+            if limit and stats["running"] >= limit:
+                stats["waiting"] += 1
+                self._waiting.setdefault(action, deque()).append(
+                    (future, function, args, kwargs)
+                )
+                return future
+            stats["running"] += 1
+        try:
+            self._executor.submit(self._run, action, future, function, args, kwargs)
+        except RuntimeError:
+            # pool arrete entre-temps
+            self._cancel(action, future)
+            return None
+        return future
+
+    def _cancel(self, action, future):
+        """
+        Annule future, que l'exécuteur arrêté n'a pas accepté, et libère sa
+        place dans la file et dans la voie de l'action.
+        """
+        future.cancel()
+        with self._condition:
+            self._pending -= 1
+            self._actions[action]["running"] -= 1
+            self._condition.notify()
+
+    def _run(self, action, future, function, args, kwargs):
+        failed = False
+        if self._shutdown:
+            future.cancel()
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(function(*args, **kwargs))
+            except Exception as e:
+                failed = True
+                logging.getLogger().error(
+                    "plugin %s failed\n%s" % (action, traceback.format_exc())
+                )
+                future.set_exception(e)
+        following = None
+        with self._condition:
+            stats = self._actions[action]
+            stats["failed" if failed else "completed"] += 1
+            self._pending -= 1
+            self._condition.notify()
+            waiting = self._waiting.get(action)
+            if waiting:
+                following = waiting.popleft()
+                stats["waiting"] -= 1
+            else:
+                stats["running"] -= 1
+        if following is not None:
+            try:
+                self._executor.submit(self._run, action, *following)
+            except RuntimeError:
+                # pool arrete
+                self._cancel(action, following[0])
+
+    def stats(self):
+        """
+        Retourne la profondeur de file et les compteurs par action.
+        """
+        with self._condition:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "pending": self._pending,
+                "actions": {
+                    action: dict(stats, limit=self.action_limits.get(action, 0))
+                    for action, stats in self._actions.items()
+                },
+            }
+
+    def shutdown(self, wait=True):
+        """
+        Arrête le pool : les actions en attente sont annulées, les actions en
+        cours se terminent.
+        """
+        with self._condition:
+            self._shutdown = True
+            waiting = [x for queue in self._waiting.values() for x in queue]
+            self._waiting = {}
+            self._condition.notify_all()
+        for future, function, args, kwargs in waiting:
+            future.cancel()
+        self._executor.shutdown(wait=wait)
+
+
+_plugin_pool_lock = threading.Lock()
+
+
+def get_plugin_pool(xmppobject):
+    """
+    Retourne le pool de plugins de l'agent, créé au premier appel à partir de
+    sa configuration.
+    """
+    pool = getattr(xmppobject, "plugin_pool", None)
+    if pool is None:
+        with _plugin_pool_lock:
+            pool = getattr(xmppobject, "plugin_pool", None)
+            if pool is None:
+                pool = PluginWorkerPool.from_config(xmppobject.config)
+                xmppobject.plugin_pool = pool
+    return pool
+
+
+def plugin_rejected(xmppobject, action, sessionid=None, data=None, msg=None, *args):
+    """
+    Répond à l'émetteur du message quand l'action n'a pas été acceptée par
+    le pool de plugins (file pleine ou substitute arrêté), comme l'agent.
+
+    Les actions result... sont elles-mêmes des réponses : leur émetteur
+    n'attend rien.
+    """
+    if msg is None or action.startswith("result"):
+        return
+    try:
+        if str(msg["from"]) == xmppobject.boundjid.bare:
+            # action lancée par le substitute lui-même (plugins de démarrage)
+            return
+        dataerreur = {
+            "action": "result%s" % action,
+            "sessionid": sessionid,
+            "ret": 255,
+            "base64": False,
+            "data": {"msg": "ERROR : plugin %s rejected, substitute busy" % action},
+        }
+        xmppobject.send_message(
+            mto=msg["from"], mbody=json.dumps(dataerreur), mtype="chat"
+        )
+    except Exception:
+        logging.getLogger().error("%s" % traceback.format_exc())
+
+
 def call_plugin_separate(name, *args, **kwargs):
     # add compteur appel plugins
     loop = aio.get_event_loop()
@@ -810,7 +1131,7 @@ def call_plugin_separate(name, *args, **kwargs):
     except AttributeError:
         count = 0
         setattr(args[0], "num_call%s" % args[1], count)
-    pluginaction = loadModule(name)
+    pluginaction = plugin_registry.get(name)
     loop.call_soon_threadsafe(pluginaction.action, *args, **kwargs)
 
 
@@ -823,9 +1144,9 @@ def call_plugin(name, *args, **kwargs):
     dans un attribut nommé "num_call<nom_du_plugin>", où <nom_du_plugin> est le
     nom du plugin passé en argument.
 
-    Cette fonction utilise un thread indépendant pour exécuter la fonction
-    d'action du plugin, ce qui permet de ne pas bloquer la boucle d'événements
-    asyncio en cours.
+    La fonction d'action du plugin est exécutée dans le pool de threads partagé
+    de l'agent (voir PluginWorkerPool), ce qui permet de ne pas bloquer la boucle
+    d'événements asyncio en cours.
 
     :param name: Le nom du plugin à appeler.
     :type name: str
@@ -833,24 +1154,25 @@ def call_plugin(name, *args, **kwargs):
     :type args: tuple
     :param kwargs: Les arguments nommés à passer à la fonction d'action du plugin.
     :type kwargs: dict
-    :return: Le résultat de l'appel à la fonction d'action du plugin.
-    :rtype: Any
+    :return: Le Future de l'exécution de l'action, ou None si elle est rejetée.
+    :rtype: concurrent.futures.Future
     """
-    loop = aio.new_event_loop()
-    time.sleep(0.0001)
     count = 0
-    time.sleep(0.0001)  # 0,1 milliseconde permet au thread de monter
     try:
         count = getattr(args[0], "num_call%s" % args[1])
         setattr(args[0], "num_call%s" % args[1], count + 1)
     except AttributeError:
         setattr(args[0], "num_call%s" % args[1], 0)
         count = getattr(args[0], "num_call%s" % args[1])
-    pluginaction = loadModule(name)
+    pluginaction = plugin_registry.get(name)
 
     try:
-        result = loop.run_in_executor(None, pluginaction.action, *args, **kwargs)
-        return result
+        future = get_plugin_pool(args[0]).submit(
+            args[1], pluginaction.action, args, kwargs
+        )
+        if future is None:
+            plugin_rejected(*args)
+        return future
     except Exception:
         logging.getLogger().error("call_plugin %s" % traceback.format_exc())
 
@@ -871,7 +1193,7 @@ def call_plugin_sequentially(name, *args, **kwargs):
             % (args[1], numcall)
         )
     try:
-        pluginaction = loadModule(name)
+        pluginaction = plugin_registry.get(name)
         pluginaction.action(*args, **kwargs)
     except:
         logging.getLogger().error(
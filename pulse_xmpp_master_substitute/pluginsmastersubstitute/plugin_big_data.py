@@ -24,20 +24,17 @@
 # Ce plugin cree 1 serveur multithead pour servir les demandes xmpp venant des des instances de mmc
 # file pulse_xmpp_master_substitute/pluginsmastersubstitute/plugin_big_data.py
 
-import zlib
-import base64
 import traceback
 import os
 import json
 import logging
 from slixmpp import jid
 from lib.utils import call_plugin
-import time
-
+from lib.bigdata_transfer import BigDataTransfers
 
 logger = logging.getLogger()
 
-plugin = {"VERSION": "1.0", "NAME": "big_data", "TYPE": "substitute"}  # fmt: skip
+plugin = {"VERSION": "1.2", "NAME": "big_data", "TYPE": "substitute"}  # fmt: skip
 
 
 def action(xmppobject, action, sessionid, data, msg, ret, dataobj):
@@ -46,11 +43,7 @@ def action(xmppobject, action, sessionid, data, msg, ret, dataobj):
         logger.debug("call %s from %s" % (plugin, msg["from"]))
         logger.debug("=======================================================")
         compteurcallplugin = getattr(xmppobject, "num_call%s" % action)
-        if not hasattr(xmppobject, "received_data"):
-            xmppobject.received_data = {}
-            xmppobject.dating = {}
-        if hasattr(xmppobject, "received_data"):
-            big_data(xmppobject, action, sessionid, data, msg, ret, dataobj)
+        big_data(xmppobject, action, sessionid, data, msg, ret, dataobj)
 
     except Exception as e:
         logger.error("The %s. We encountered the error %s" % (plugin["NAME"], str(e)))
@@ -61,6 +54,8 @@ def big_data(xmppobject, action, sessionid, data, msg, ret, dataobj):
     """
     Réassemble les segments de données reçus pour reconstruire le message complet.
 
+    Traite aussi les acquittements reçus par l'émetteur d'un transfert.
+
     Args:
         xmppobject (object): Objet XMPP utilisé pour la communication.
         action (str): Action associée au message reçu.
@@ -73,50 +68,11 @@ def big_data(xmppobject, action, sessionid, data, msg, ret, dataobj):
     Returns:
         None
     """
-    valuedata = int(time.time())  # Obtient le temps actuel en secondes
-    subsessionid = (
-        []
-    )  # Initialise une liste pour stocker les identifiants de session à supprimer
-
-    # Si la fonction de datation est activée
-    if xmppobject.dating:
-        for sessionidvalue in xmppobject.received_data.keys():
-            if (
-                sessionidvalue in xmppobject.dating
-                and (valuedata - xmppobject.dating[sessionidvalue]) > 1800
-            ):
-                # Supprime la session dans received_data et dating si elle est périmée
-                subsessionid.append(sessionidvalue)
-
-    # Supprime les sessions périmées
-    if subsessionid:
-        for sessionidvalue in subsessionid:
-            del xmppobject.received_data[sessionidvalue]
-            del xmppobject.dating[sessionidvalue]
-
-    # Ajoute le segment de données dans un dictionnaire
-    if sessionid not in xmppobject.received_data:
-        xmppobject.received_data[sessionid] = {}
-        xmppobject.dating[sessionid] = valuedata
-
-    # Obtient le numéro de segment et le nombre total de segments
-    segment_number = data["nb_segment"]
-    nb_segments_total = data["nb_segment_total"]
-    xmppobject.received_data[sessionid][segment_number] = data["segment"]
-
-    # Vérifie si tous les segments ont été reçus
-    if len(xmppobject.received_data[sessionid]) == nb_segments_total:
-        # Concatène les segments pour reconstruire les données complètes
-        full_data_base64 = "".join(
-            [
-                xmppobject.received_data[sessionid][i]
-                for i in range(1, nb_segments_total + 1)
-            ]
-        )
-        full_data_compressed = base64.b64decode(full_data_base64)
-        full_data_utf8 = zlib.decompress(full_data_compressed).decode("utf-8")
-        del xmppobject.received_data[sessionid]
-        logger.debug("count received_data %s" % len(xmppobject.received_data))
+    # Les segments sont écrits dans un fichier spool borné, les acquittements
+    # et les limites par émetteur sont gérés par BigDataTransfers.
+    full_data_utf8 = BigDataTransfers.of(xmppobject).on_message(sessionid, data, msg)
+    if full_data_utf8 is not None:
+        logger.debug("big_data metrics %s" % BigDataTransfers.of(xmppobject).metrics())
         # Convertit les données en JSON
         full_message = json.loads(full_data_utf8)
 
@@ -3,10 +3,12 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 """
-    Plugin used to check if the ARS of the Ejabberd server are running
-    correctly.
+Plugin used to check if the ARS of the Ejabberd server are running
+correctly.
 """
 
+import asyncio
+import collections
 import traceback
 import os
 import logging
@@ -19,7 +21,7 @@ from slixmpp import jid
 from slixmpp.exceptions import IqError, IqTimeout
 
 logger = logging.getLogger()
-plugin = {"VERSION": "1.3", "NAME": "loadarscheck", "TYPE": "substitute"}  # fmt: skip
+plugin = {"VERSION": "1.4", "NAME": "loadarscheck", "TYPE": "substitute"}  # fmt: skip
 
 
 def action(objectxmpp, action, sessionid, data, msg, ret):
@@ -44,31 +46,79 @@ def arscheck(self):
     This function is used to ping the ARS regularly.
     The check_ars_scan_interval variable define how much this is done.
     check_ars_by_ping
+    The scan runs as a task of the event loop, the ARS are pinged
+    concurrently (check_ars_concurrency) and the scan is stopped after
+    check_ars_deadline seconds.
     """
-    sessionid = name_random(5, "monitoring_check_ars")
-
     if not self.ressource_scan_available:
         logger.debug("The ressource is not available.")
         return
-    try:
-        self.ressource_scan_available = False
+    self.ressource_scan_available = False
+    self.loop.create_task(arscheck_scan(self))
+
+
+def is_down(arsstatus):
+    return arsstatus["server"]["presence"] == 0 or arsstatus["ars"]["presence"] == 0
+
+
+async def ping_list_ars(self, list_jid, deadline):
+    """
+    Ping concurrently the ARS of list_jid.
+    Args:
+        list_jid: jids of the relays
+        deadline: time of the loop after which the pings are cancelled
+    Returns:
+        {jid: status} of the ARS checked before the deadline
+    """
+    if not list_jid:
+        return {}
+    semaphore = asyncio.Semaphore(self.check_ars_concurrency)
+
+    async def check(jid_ars):
+        async with semaphore:
+            return jid_ars, await self.ping_ejabberd_and_relay(jid_ars)
 
-        list_ars_search = XmppMasterDatabase().getRelayServer()
-        enabled_ars = [x for x in list_ars_search if x["enabled"]]
-        disabled_ars = [x for x in list_ars_search if not x["enabled"]]
+    tasks = [asyncio.ensure_future(check(jid_ars)) for jid_ars in list_jid]
+    done, pending = await asyncio.wait(
+        tasks, timeout=max(0, deadline - self.loop.time())
+    )
+    for task in pending:
+        task.cancel()
+    if pending:
+        logger.warning(
+            "%s ARS not checked before the deadline of %s s"
+            % (len(pending), self.check_ars_deadline)
+        )
+    result = {}
+    for task in done:
+        if task.exception() is None:
+            jid_ars, arsstatus = task.result()
+            result[jid_ars] = arsstatus
+        else:
+            logger.error("ping ARS : %s" % task.exception())
+    return result
+
+
+async def arscheck_scan(self):
+    sessionid = name_random(5, "monitoring_check_ars")
+    try:
+        deadline = self.loop.time() + self.check_ars_deadline
+        list_ars_search = await self.loop.run_in_executor(
+            None, XmppMasterDatabase().getRelayServer
+        )
+        enabled_ars = [x["jid"] for x in list_ars_search if x["enabled"]]
+        disabled_ars = [x["jid"] for x in list_ars_search if not x["enabled"]]
         logger.debug("disable %s" % len(disabled_ars))
         logger.debug("enable %s" % len(enabled_ars))
 
-        self.ars_server_list_status = []
-        listaction = []
-        for ars in enabled_ars:
-            arsstatus = self.ping_ejabberd_and_relay(ars["jid"])
-            self.ars_server_list_status.append(arsstatus)
-            if (
-                arsstatus["server"]["presence"] == 0
-                or arsstatus["ars"]["presence"] == 0
-            ):
-                listaction.append(ars["jid"])
+        startscan = time.time()
+        arsstatus = await ping_list_ars(self, enabled_ars, deadline)
+        self.ars_server_list_status = [
+            arsstatus[x] for x in enabled_ars if x in arsstatus
+        ]
+        listaction = [
+            x for x in enabled_ars if x in arsstatus and is_down(arsstatus[x])
+        ]
 
         if logger.level == 10 and self.ars_server_list_status:
             self.display_server_status()
@@ -76,21 +126,44 @@ def arscheck(self):
         logger.debug("listaction %s" % listaction)
 
         # We give some time for the relay server, to be correctly/fully started
-        for jidaction in listaction:
-            logger.error("jidaction %s" % jidaction)
-            time.sleep(1)
-            arsstatus = self.ping_ejabberd_and_relay(jidaction)
-            if (
-                arsstatus["server"]["presence"] == 0
-                or arsstatus["ars"]["presence"] == 0
-            ):
-                if self.update_table:
-                    # Update relay and machine table.
-
-                    XmppMasterDatabase().update_Presence_Relay(jidaction)
-
+        listdown = []
+        if listaction:
+            logger.error("jidaction %s" % listaction)
+            await asyncio.sleep(1)
+            arsstatus = await ping_list_ars(self, listaction, deadline)
+            listdown = [
+                x for x in listaction if x in arsstatus and is_down(arsstatus[x])
+            ]
+
+        if listdown and self.update_table:
+            # Update relay and machine table.
+            await self.loop.run_in_executor(
+                None, XmppMasterDatabase().update_Presence_Relays, listdown
+            )
+            for jidaction in listdown:
+                self.xmpplog(
+                    "update on ping ars %s" % jidaction,
+                    type="Monitoring",
+                    sessionname=sessionid,
+                    priority=-1,
+                    action="xmpplog",
+                    why=self.boundjid.bare,
+                    module="Notify | Substitut | Monitoring",
+                    date=None,
+                    fromuser=jidaction,
+                )
+                if self.monitoring_message_on_machine_no_presence:
+                    logger.warning("The Ars %s is down" % jidaction)
+                    self.message_datas_to_monitoring_loadarscheck(
+                        jidaction,
+                        "The Ars %s is down" % jidaction,
+                        informationaction="ack",
+                    )
+                if self.action_reconf_ars_machines:
+                    # update machine for reconf
                     self.xmpplog(
-                        "update on ping ars %s" % jidaction,
+                        "Reconfigure all the machines belonging to the ars %s"
+                        % jidaction,
                         type="Monitoring",
                         sessionname=sessionid,
                         priority=-1,
@@ -100,47 +173,46 @@ def arscheck(self):
                         date=None,
                         fromuser=jidaction,
                     )
-                    if self.monitoring_message_on_machine_no_presence:
-                        logger.warning("The Ars %s is down" % jidaction)
-                        self.message_datas_to_monitoring_loadarscheck(
-                            jidaction,
-                            "The Ars %s is down" % jidaction,
-                            informationaction="ack",
-                        )
-                    if self.action_reconf_ars_machines:
-                        # update machine for reconf
-                        self.xmpplog(
-                            "Reconfigure all the machines belonging to the ars %s"
-                            % jidaction,
-                            type="Monitoring",
-                            sessionname=sessionid,
-                            priority=-1,
-                            action="xmpplog",
-                            why=self.boundjid.bare,
-                            module="Notify | Substitut | Monitoring",
-                            date=None,
-                            fromuser=jidaction,
-                        )
-                        XmppMasterDatabase().is_machine_reconf_needed(jidaction)
-
-        for ars in disabled_ars:
-            arsstatus = self.ping_ejabberd_and_relay(ars["jid"])
-            if (
-                arsstatus["server"]["presence"] == 1
-                and arsstatus["ars"]["presence"] == 1
-            ):
-                self.xmpplog(
-                    "The ARS %s is online" % ars["jid"],
-                    type="Monitoring",
-                    sessionname=sessionid,
-                    priority=-1,
-                    action="xmpplog",
-                    why=self.boundjid.bare,
-                    module="Notify | Substitut | Monitoring",
-                    date=None,
-                    fromuser=ars["jid"],
+            if self.action_reconf_ars_machines:
+                await self.loop.run_in_executor(
+                    None, XmppMasterDatabase().is_machines_reconf_needed, listdown
+                )
+
+        arsstatus = await ping_list_ars(self, disabled_ars, deadline)
+        listonline = [
+            x
+            for x in disabled_ars
+            if x in arsstatus
+            and arsstatus[x]["server"]["presence"] == 1
+            and arsstatus[x]["ars"]["presence"] == 1
+        ]
+        for jidaction in listonline:
+            self.xmpplog(
+                "The ARS %s is online" % jidaction,
+                type="Monitoring",
+                sessionname=sessionid,
+                priority=-1,
+                action="xmpplog",
+                why=self.boundjid.bare,
+                module="Notify | Substitut | Monitoring",
+                date=None,
+                fromuser=jidaction,
+            )
+        if listonline:
+            await self.loop.run_in_executor(
+                None, XmppMasterDatabase().update_Presence_Relays, listonline, 1
+            )
+
+        for jidaction in enabled_ars:
+            if self.ars_is_flapping(jidaction):
+                logger.warning(
+                    "The ARS %s is flapping : latencies %s"
+                    % (jidaction, list(self.ars_latency_history[jidaction]))
                 )
-                XmppMasterDatabase().update_Presence_Relay(ars["jid"], presence=1)
+        logger.debug(
+            "%s ARS checked in %.2f s"
+            % (len(enabled_ars) + len(disabled_ars), time.time() - startscan)
+        )
     except Exception as e:
         logger.error("We failed to check the ARS Status")
         logger.error("The backtrace of this error is \n %s" % traceback.format_exc())
@@ -170,10 +242,11 @@ def message_datas_to_monitoring_loadarscheck(
     )
 
 
-def ping_ejabberd_and_relay(self, jid_client):
+async def ping_ejabberd_and_relay(self, jid_client):
     """
     Used to test both the relayserver and the ejabberd server
     to determine which one is not functionnal.
+    The latency of the ping of the relay is kept in ars_latency_history.
     Args:
         jid_client: jid of the relay
     """
@@ -184,7 +257,9 @@ def ping_ejabberd_and_relay(self, jid_client):
         "server": {"jid": server_jid, "presence": 1},
         "ars": {"jid": name_ars_jid, "presence": 1},
     }
-    result = self.send_ping_relay(jid_client, self.check_timeout_ping)
+    start = time.monotonic()
+    result = await self.send_ping_relay(jid_client, self.check_timeout_ping)
+    latency = time.monotonic() - start
 
     if result == 1:
         pass
@@ -193,7 +268,7 @@ def ping_ejabberd_and_relay(self, jid_client):
         rep["server"]["presence"] = 2
     else:
         rep["ars"]["presence"] = 0
-        result = self.send_ping_relay(server_jid, self.check_timeout_ping)
+        result = await self.send_ping_relay(server_jid, self.check_timeout_ping)
         if result == 1:
             pass
         elif result == -1:
@@ -201,10 +276,17 @@ def ping_ejabberd_and_relay(self, jid_client):
         else:
             rep["server"]["presence"] = 0
 
+    if jid_client not in self.ars_latency_history:
+        self.ars_latency_history[jid_client] = collections.deque(
+            maxlen=self.check_ars_history
+        )
+    self.ars_latency_history[jid_client].append(
+        (time.time(), rep["ars"]["presence"], round(latency, 3))
+    )
     return rep
 
 
-def send_ping_relay(self, jid, timeout=5):
+async def send_ping_relay(self, jid, timeout=5):
     """
     Send ping to the relay using the XEP 0199.
     ref: https://xmpp.org/extensions/xep-0199.html
@@ -213,9 +295,8 @@ def send_ping_relay(self, jid, timeout=5):
         timeout: time before a timeout of the IQ
     """
     logger.debug("send ping to %s " % jid)
-    result = False
     try:
-        result = self["xep_0199"].send_ping(jid, timeout=timeout)
+        await self["xep_0199"].send_ping(jid, timeout=timeout)
         logger.debug("ars present %s" % (jid))
         return 1
     except IqError as e:
@@ -226,6 +307,19 @@ def send_ping_relay(self, jid, timeout=5):
         return -1
 
 
+def ars_is_flapping(self, jid_ars):
+    """
+    Tell if the presence of the ARS changed check_ars_flapping times or more
+    in its last check_ars_history pings.
+    Args:
+        jid_ars: jid of the relay
+    """
+    history = self.ars_latency_history.get(jid_ars, [])
+    presences = [presence for _, presence, _ in history]
+    changes = sum(1 for x, y in zip(presences, presences[1:]) if x != y)
+    return changes >= self.check_ars_flapping
+
+
 def display_server_status(self):
     """
     Display the status of both ejabberd and ARS.
@@ -269,6 +363,8 @@ def read_conf_loadarscheck(objectxmpp):
     pathfileconf = os.path.join(objectxmpp.config.pathdirconffile, namefichierconf)
     objectxmpp.ressource_scan_available = True
     objectxmpp.ars_server_list_status = []
+    # jid of the ARS -> last pings (time, presence, latency)
+    objectxmpp.ars_latency_history = {}
 
     if not os.path.isfile(pathfileconf):
         # not config files
@@ -278,6 +374,10 @@ def read_conf_loadarscheck(objectxmpp):
         objectxmpp.action_reconf_ars_machines = True
         objectxmpp.monitoring_message_on_machine_no_presence = True
         objectxmpp.monitor_agent = "master_mon@pulse"
+        objectxmpp.check_ars_concurrency = 20
+        objectxmpp.check_ars_deadline = 300
+        objectxmpp.check_ars_history = 10
+        objectxmpp.check_ars_flapping = 4
     else:
         ars_config = configparser.ConfigParser()
         ars_config.read(pathfileconf)
@@ -343,6 +443,38 @@ def read_conf_loadarscheck(objectxmpp):
             # default values parameters
             objectxmpp.monitor_agent = "master_mon@pulse"
 
+        if ars_config.has_option("parameters", "check_ars_concurrency"):
+            objectxmpp.check_ars_concurrency = ars_config.getint(
+                "parameters", "check_ars_concurrency"
+            )
+        else:
+            # default values parameters
+            objectxmpp.check_ars_concurrency = 20
+
+        if ars_config.has_option("parameters", "check_ars_deadline"):
+            objectxmpp.check_ars_deadline = ars_config.getint(
+                "parameters", "check_ars_deadline"
+            )
+        else:
+            # default values parameters
+            objectxmpp.check_ars_deadline = 300
+
+        if ars_config.has_option("parameters", "check_ars_history"):
+            objectxmpp.check_ars_history = ars_config.getint(
+                "parameters", "check_ars_history"
+            )
+        else:
+            # default values parameters
+            objectxmpp.check_ars_history = 10
+
+        if ars_config.has_option("parameters", "check_ars_flapping"):
+            objectxmpp.check_ars_flapping = ars_config.getint(
+                "parameters", "check_ars_flapping"
+            )
+        else:
+            # default values parameters
+            objectxmpp.check_ars_flapping = 4
+
     logger.debug(
         "parameter loadarscheck : check_ars_scan_interval = %s"
         % objectxmpp.check_ars_scan_interval
@@ -384,6 +516,9 @@ def read_conf_loadarscheck(objectxmpp):
     # declaration function send_ping_relay in object xmpp
     objectxmpp.send_ping_relay = types.MethodType(send_ping_relay, objectxmpp)
 
+    # declaration function ars_is_flapping in object xmpp
+    objectxmpp.ars_is_flapping = types.MethodType(ars_is_flapping, objectxmpp)
+
     # declaration function arscheck in object xmpp
     objectxmpp.arscheck = types.MethodType(arscheck, objectxmpp)
 
@@ -17,11 +17,13 @@ from lib.plugins.xmpp import XmppMasterDatabase
 from lib.plugins.msc import MscDatabase
 from lib.managepackage import managepackage
 from lib.managesession import session, clean_session
+from lib.jobrunner import JobRunner
 from lib.utils import (
     getRandomName,
     call_plugin,
     name_random,
     name_randomplus,
+    package_files_hash,
 )
 import configparser
 import types
@@ -32,7 +34,7 @@ import time
 import threading
 
 logger = logging.getLogger()
-plugin = {"VERSION": "1.4", "NAME": "loaddeployment", "TYPE": "substitute"}  # fmt: skip
+plugin = {"VERSION": "1.6", "NAME": "loaddeployment", "TYPE": "substitute"}  # fmt: skip
 
 
 def action(objectxmpp, action, sessionid, data, msg, ret):
@@ -389,11 +391,16 @@ def scheduledeployrecoveryjob(self):
         machines_scheduled_deploy = XmppMasterDatabase().search_machines_from_state(
             "DEPLOY TASK SCHEDULED"
         )
+        # the presence of all the machines is read in one query, and the new
+        # states are written with one query by state
+        resultpresence = XmppMasterDatabase().getPresenceExistuuids(
+            [machine["inventoryuuid"] for machine in machines_scheduled_deploy]
+        )
+        newstates = {}
         for machine in machines_scheduled_deploy:
             msglog = []
             UUID = machine["inventoryuuid"]
 
-            resultpresence = XmppMasterDatabase().getPresenceExistuuids(UUID)
             if resultpresence[UUID][1] == 0:
                 # la machine n'est plus dans la table machine
                 # voir le message a afficher.
@@ -405,15 +412,13 @@ def scheduledeployrecoveryjob(self):
                     "during deployment. GLPI ID: %s</span>"
                     % (machine["jidmachine"], UUID)
                 )
-                XmppMasterDatabase().update_state_deploy(
-                    machine["id"], "ABORT MACHINE DISAPPEARED"
+                newstates.setdefault("ABORT MACHINE DISAPPEARED", []).append(
+                    machine["id"]
                 )
             elif resultpresence[UUID][0] == 1:
-                XmppMasterDatabase().update_state_deploy(
-                    machine["id"], "WAITING MACHINE ONLINE"
-                )
+                newstates.setdefault("WAITING MACHINE ONLINE", []).append(machine["id"])
             else:
-                XmppMasterDatabase().update_state_deploy(machine["id"], "WOL 3")
+                newstates.setdefault("WOL 3", []).append(machine["id"])
             for logmsg in msglog:
                 self.xmpplog(
                     logmsg,
@@ -427,6 +432,9 @@ def scheduledeployrecoveryjob(self):
                     fromuser=machine["login"],
                 )
 
+        for state, sql_ids in newstates.items():
+            XmppMasterDatabase().update_state_deploys(sql_ids, state)
+
         # Plan with blocked deployments again
         XmppMasterDatabase().restart_blocked_deployments()
         msglog = []
@@ -435,25 +443,80 @@ def scheduledeployrecoveryjob(self):
         machines_waiting_online = XmppMasterDatabase().search_machines_from_state(
             "WAITING MACHINE ONLINE"
         )
+        # ----------------- contrainte slopt partiel-----------------------
+        # the slot is checked once by command, the machines of the commands
+        # out of their slot are left waiting
+        inslot = MscDatabase().test_deploy_in_partiel_slots(
+            set([machine["title"] for machine in machines_waiting_online])
+        )
+        machines_waiting_online = [
+            machine for machine in machines_waiting_online if inslot[machine["title"]]
+        ]
+        # -----------------------------------------------------------------
         # We check which machines of machines_waiting_online are now online
+        presence = XmppMasterDatabase().getPresenceuuids(
+            [machine["inventoryuuid"] for machine in machines_waiting_online]
+        )
+        machines_online = []
         for machine in machines_waiting_online:
+            try:
+                machine["data"] = json.loads(machine["result"])
+            except Exception:
+                if "sessionid" in machine:
+                    XmppMasterDatabase().replaydeploysessionid(
+                        machine["sessionid"],
+                        force_redeploy=self.force_redeploy,
+                        reschedule=self.reschedule,
+                    )
+                continue
+            if presence[machine["inventoryuuid"]]:
+                machines_online.append(machine)
+        XmppMasterDatabase().update_state_deploys(
+            [machine["id"] for machine in machines_online], "DEPLOYMENT START"
+        )
+        # the syncthing deployments are counted once by command
+        nbsyncthing = XmppMasterDatabase().nbsyncthingdeploys(
+            set(
+                [
+                    (machine["group_uuid"], machine["command"])
+                    for machine in machines_online
+                    if (machine["data"].get("advanced") or {}).get("syncthing") == 1
+                ]
+            )
+        )
+        for machine in machines_online:
             logger.info(
                 "Restarting the deploiement %s actually in  machines_waiting_online state"
                 % machine["sessionid"]
             )
-            # ----------------- contrainte slopt partiel-----------------------
-            res = MscDatabase().test_deploy_in_partiel_slot(machine["title"])
-            if not res:
-                # machine avec contrainte slot partiel on est pas dans le slot
-                continue
-            # -----------------------------------------------------------------
             try:
-                data = json.loads(machine["result"])
-                if XmppMasterDatabase().getPresenceuuid(machine["inventoryuuid"]):
-                    machine_hostname = machine["jidmachine"].split("@")[0][:-4]
+                data = machine["data"]
+                machine_hostname = machine["jidmachine"].split("@")[0][:-4]
+                msg = "Machine %s is online. Starting the deployment" % machine_hostname
+                self.xmpplog(
+                    msg,
+                    type="deploy",
+                    sessionname=machine["sessionid"],
+                    priority=-1,
+                    action="xmpplog",
+                    why=self.boundjid.bare,
+                    module="Deployment | Start | Creation",
+                    date=None,
+                    fromuser=machine["login"],
+                )
+
+                # We restart to deploy on online machines
+                # We need to check if there is a syncthing group. Then we
+                # can decide to add it.
+                if (
+                    "grp" in data["advanced"]
+                    and data["advanced"]["grp"] is not None
+                    and "syncthing" in data["advanced"]
+                    and data["advanced"]["syncthing"] == 1
+                    and nbsyncthing[(machine["group_uuid"], machine["command"])] > 2
+                ):
                     msg = (
-                        "Machine %s is online. Starting the deployment"
-                        % machine_hostname
+                        "Starting peer deployment on machine %s" % machine["jidmachine"]
                     )
                     self.xmpplog(
                         msg,
@@ -464,31 +527,104 @@ def scheduledeployrecoveryjob(self):
                         why=self.boundjid.bare,
                         module="Deployment | Start | Creation",
                         date=None,
-                        fromuser=machine["login"],
+                        fromuser=data["login"],
+                    )
+                    XmppMasterDatabase().updatedeploytosyncthing(machine["sessionid"])
+                    self.callpluginsubstitute(
+                        "deploysyncthing", data, sessionid=machine["sessionid"]
+                    )
+                else:
+                    datasession = self.sessiondeploysubstitute.sessiongetdata(
+                        machine["sessionid"]
+                    )
+                    msglog.append(
+                        "Starting deployment on machine %s from ARS %s"
+                        % (machine["jidmachine"], machine["jid_relay"])
                     )
+                    # lance deployment to ars
+                    try:
+                        if "jidmachine" in data and data["jidmachine"] != "":
+                            checkChangedJID = (
+                                XmppMasterDatabase().update_jid_if_changed(
+                                    data["jidmachine"]
+                                )
+                            )
+                            if checkChangedJID:
+                                if checkChangedJID[0]["jid"] != data["jidmachine"]:
+                                    logging.warning(
+                                        "Machine JID changed since creation of deployment"
+                                    )
+                                    logging.warning(
+                                        "Machine JID %s -> %s"
+                                        % (
+                                            data["jidmachine"],
+                                            checkChangedJID[0]["jid"],
+                                        )
+                                    )
+                                    logging.warning(
+                                        "Relay server JID %s -> %s"
+                                        % (
+                                            data["jidrelay"],
+                                            checkChangedJID[0]["groupdeploy"],
+                                        )
+                                    )
+                                    msglog.append(
+                                        "jid machine changed : replace jid mach from %s to %s"
+                                        % (
+                                            data["jidmachine"],
+                                            checkChangedJID[0]["jid"],
+                                        )
+                                    )
+                                    msglog.append(
+                                        "replace jid ars from %s to %s"
+                                        % (
+                                            data["jidrelay"],
+                                            checkChangedJID[0]["groupdeploy"],
+                                        )
+                                    )
+                                    data["jidmachine"] = checkChangedJID[0]["jid"]
+                                    data["jidrelay"] = checkChangedJID[0]["groupdeploy"]
+                                    XmppMasterDatabase().replace_jid_mach_ars_in_deploy(
+                                        data["jidmachine"],
+                                        data["jidrelay"],
+                                        data["title"],
+                                    )
 
-                    XmppMasterDatabase().update_state_deploy(
-                        int(machine["id"]), "DEPLOYMENT START"
+                    except Exception as e:
+                        logger.error("%s" % (traceback.format_exc()))
+                        logging.error("Error checking for JID changes")
+
+                    command = {
+                        "action": "applicationdeploymentjson",
+                        "base64": False,
+                        "sessionid": machine["sessionid"],
+                        "data": data,
+                    }
+                    self.send_message(
+                        mto=machine["jid_relay"],
+                        mbody=json.dumps(command),
+                        mtype="chat",
                     )
-                    # We restart to deploy on online machines
-                    # We need to check if there is a syncthing group. Then we
-                    # can decide to add it.
+                    for logmsg in msglog:
+                        self.xmpplog(
+                            logmsg,
+                            type="deploy",
+                            sessionname=machine["sessionid"],
+                            priority=-1,
+                            action="xmpplog",
+                            why=self.boundjid.bare,
+                            module="Deployment | Start | Creation",
+                            date=None,
+                            fromuser=machine["login"],
+                        )
+                    msglog = []
                     if (
-                        "grp" in data["advanced"]
-                        and data["advanced"]["grp"] is not None
-                        and "syncthing" in data["advanced"]
+                        "syncthing" in data["advanced"]
                         and data["advanced"]["syncthing"] == 1
-                        and XmppMasterDatabase().nbsyncthingdeploy(
-                            machine["group_uuid"], machine["command"]
-                        )
-                        > 2
                     ):
-                        msg = (
-                            "Starting peer deployment on machine %s"
-                            % machine["jidmachine"]
-                        )
                         self.xmpplog(
-                            msg,
+                            "<span class='log_warn'>There are not enough "
+                            "machines to deploy in peer mode</span>",
                             type="deploy",
                             sessionname=machine["sessionid"],
                             priority=-1,
@@ -498,115 +634,6 @@ def scheduledeployrecoveryjob(self):
                             date=None,
                             fromuser=data["login"],
                         )
-                        XmppMasterDatabase().updatedeploytosyncthing(
-                            machine["sessionid"]
-                        )
-                        self.callpluginsubstitute(
-                            "deploysyncthing", data, sessionid=machine["sessionid"]
-                        )
-                    else:
-                        datasession = self.sessiondeploysubstitute.sessiongetdata(
-                            machine["sessionid"]
-                        )
-                        msglog.append(
-                            "Starting deployment on machine %s from ARS %s"
-                            % (machine["jidmachine"], machine["jid_relay"])
-                        )
-                        # lance deployment to ars
-                        try:
-                            if "jidmachine" in data and data["jidmachine"] != "":
-                                checkChangedJID = (
-                                    XmppMasterDatabase().update_jid_if_changed(
-                                        data["jidmachine"]
-                                    )
-                                )
-                                if checkChangedJID:
-                                    if checkChangedJID[0]["jid"] != data["jidmachine"]:
-                                        logging.warning(
-                                            "Machine JID changed since creation of deployment"
-                                        )
-                                        logging.warning(
-                                            "Machine JID %s -> %s"
-                                            % (
-                                                data["jidmachine"],
-                                                checkChangedJID[0]["jid"],
-                                            )
-                                        )
-                                        logging.warning(
-                                            "Relay server JID %s -> %s"
-                                            % (
-                                                data["jidrelay"],
-                                                checkChangedJID[0]["groupdeploy"],
-                                            )
-                                        )
-                                        msglog.append(
-                                            "jid machine changed : replace jid mach from %s to %s"
-                                            % (
-                                                data["jidmachine"],
-                                                checkChangedJID[0]["jid"],
-                                            )
-                                        )
-                                        msglog.append(
-                                            "replace jid ars from %s to %s"
-                                            % (
-                                                data["jidrelay"],
-                                                checkChangedJID[0]["groupdeploy"],
-                                            )
-                                        )
-                                        data["jidmachine"] = checkChangedJID[0]["jid"]
-                                        data["jidrelay"] = checkChangedJID[0][
-                                            "groupdeploy"
-                                        ]
-                                        XmppMasterDatabase().replace_jid_mach_ars_in_deploy(
-                                            data["jidmachine"],
-                                            data["jidrelay"],
-                                            data["title"],
-                                        )
-
-                        except Exception as e:
-                            logger.error("%s" % (traceback.format_exc()))
-                            logging.error("Error checking for JID changes")
-
-                        command = {
-                            "action": "applicationdeploymentjson",
-                            "base64": False,
-                            "sessionid": machine["sessionid"],
-                            "data": data,
-                        }
-                        self.send_message(
-                            mto=machine["jid_relay"],
-                            mbody=json.dumps(command),
-                            mtype="chat",
-                        )
-                        for logmsg in msglog:
-                            self.xmpplog(
-                                logmsg,
-                                type="deploy",
-                                sessionname=machine["sessionid"],
-                                priority=-1,
-                                action="xmpplog",
-                                why=self.boundjid.bare,
-                                module="Deployment | Start | Creation",
-                                date=None,
-                                fromuser=machine["login"],
-                            )
-                        msglog = []
-                        if (
-                            "syncthing" in data["advanced"]
-                            and data["advanced"]["syncthing"] == 1
-                        ):
-                            self.xmpplog(
-                                "<span class='log_warn'>There are not enough "
-                                "machines to deploy in peer mode</span>",
-                                type="deploy",
-                                sessionname=machine["sessionid"],
-                                priority=-1,
-                                action="xmpplog",
-                                why=self.boundjid.bare,
-                                module="Deployment | Start | Creation",
-                                date=None,
-                                fromuser=data["login"],
-                            )
             except:
                 if "sessionid" in machine:
                     XmppMasterDatabase().replaydeploysessionid(
@@ -618,11 +645,11 @@ def scheduledeployrecoveryjob(self):
         msglog = []
 
         machines_wol3 = XmppMasterDatabase().search_machines_from_state("WOL 3")
+        XmppMasterDatabase().update_state_deploys(
+            [machine["id"] for machine in machines_wol3], "WAITING MACHINE ONLINE"
+        )
         for machine in machines_wol3:
             msglog = []
-            XmppMasterDatabase().update_state_deploy(
-                machine["id"], "WAITING MACHINE ONLINE"
-            )
             machine_hostname = machine["jidmachine"].split("@")[0][:-4]
             msglog.append("Waiting for machine %s to be online" % machine_hostname)
             for logmsg in msglog:
@@ -640,14 +667,19 @@ def scheduledeployrecoveryjob(self):
 
         msglog = []
         machines_wol2 = XmppMasterDatabase().search_machines_from_state("WOL 2")
+        presence = XmppMasterDatabase().getPresenceuuids(
+            [machine["inventoryuuid"] for machine in machines_wol2]
+        )
+        XmppMasterDatabase().update_state_deploys(
+            [x["id"] for x in machines_wol2 if presence[x["inventoryuuid"]]],
+            "WAITING MACHINE ONLINE",
+        )
+        machines_wol2 = [x for x in machines_wol2 if not presence[x["inventoryuuid"]]]
+        XmppMasterDatabase().update_state_deploys(
+            [machine["id"] for machine in machines_wol2], "WOL 3"
+        )
         for machine in machines_wol2:
             msglog = []
-            if XmppMasterDatabase().getPresenceuuid(machine["inventoryuuid"]):
-                XmppMasterDatabase().update_state_deploy(
-                    machine["id"], "WAITING MACHINE ONLINE"
-                )
-                continue
-            XmppMasterDatabase().update_state_deploy(machine["id"], "WOL 3")
             machine_hostname = machine["jidmachine"].split("@")[0][:-4]
             self._addsetwol(wol_set, machine["macadress"])
             msglog.append("Third WOL sent to machine %s" % machine_hostname)
@@ -666,15 +698,20 @@ def scheduledeployrecoveryjob(self):
         msglog = []
 
         machines_wol1 = XmppMasterDatabase().search_machines_from_state("WOL 1")
+        presence = XmppMasterDatabase().getPresenceuuids(
+            [machine["inventoryuuid"] for machine in machines_wol1]
+        )
+        XmppMasterDatabase().update_state_deploys(
+            [x["id"] for x in machines_wol1 if presence[x["inventoryuuid"]]],
+            "WAITING MACHINE ONLINE",
+        )
+        machines_wol1 = [x for x in machines_wol1 if not presence[x["inventoryuuid"]]]
+        XmppMasterDatabase().update_state_deploys(
+            [machine["id"] for machine in machines_wol1], "WOL 2"
+        )
         for machine in machines_wol1:
             msglog = []
-            if XmppMasterDatabase().getPresenceuuid(machine["inventoryuuid"]):
-                XmppMasterDatabase().update_state_deploy(
-                    machine["id"], "WAITING MACHINE ONLINE"
-                )
-                continue
-            XmppMasterDatabase().update_state_deploy(machine["id"], "WOL 2")
-            hostnamemachine = machine["jidmachine"].split("@")[0][:-4]
+            machine_hostname = machine["jidmachine"].split("@")[0][:-4]
             self._addsetwol(wol_set, machine["macadress"])
 
             msglog.append("Second WOL sent to machine %s" % machine_hostname)
@@ -1346,6 +1383,7 @@ def applicationdeploymentjson(
         "methodetransfert": "pushrsync",
         "path": path,
         "packagefile": os.listdir(path),
+        "packagefilehash": package_files_hash(path),
         "jidrelay": jidrelay,
         "jidmachine": jidmachine,
         "jidmaster": self.boundjid.bare,
@@ -1859,6 +1897,7 @@ def read_conf_loaddeployment(objectxmpp):
         objectxmpp.send_hash = False
         objectxmpp.hashing_algo = "sha256"
         objectxmpp.keyAES32 = "abcdefghijklnmopqrstuvwxyz012345"
+        objectxmpp.deployment_job_workers = 4
     else:
         Config = configparser.ConfigParser()
         Config.read(pathfileconf)
@@ -1933,6 +1972,13 @@ def read_conf_loaddeployment(objectxmpp):
         else:
             objectxmpp.keyAES32 = "abcdefghijklnmopqrstuvwxyz012345"
 
+        if Config.has_option("parameters", "deployment_job_workers"):
+            objectxmpp.deployment_job_workers = Config.getint(
+                "parameters", "deployment_job_workers"
+            )
+        else:
+            objectxmpp.deployment_job_workers = 4
+
     # initialisation des object for deployement
 
     objectxmpp.applicationdeployjsonUuidMachineAndUuidPackage = types.MethodType(
@@ -1964,41 +2010,42 @@ def read_conf_loaddeployment(objectxmpp):
 
     objectxmpp.totimestamp = types.MethodType(totimestamp, objectxmpp)
 
+    # the periodic jobs query the databases : they run in the threads of
+    # the job runner, not in the slixmpp loop
+    objectxmpp.deployment_jobs = JobRunner(
+        objectxmpp, "loaddeployment", max_workers=objectxmpp.deployment_job_workers
+    )
+
     # declaration function scheduledeploy in object xmpp
     objectxmpp.scheduledeploy = types.MethodType(scheduledeploy, objectxmpp)
-    # schedule function scheduledeploy
-    objectxmpp.schedule(
+    objectxmpp.deployment_jobs.add(
         "check_and_process_deployment",
         objectxmpp.deployment_scan_interval,
         objectxmpp.scheduledeploy,
-        repeat=True,
     )
 
     # declaration function scheduledeployrecoveryjob in object xmpp
     objectxmpp.scheduledeployrecoveryjob = types.MethodType(
         scheduledeployrecoveryjob, objectxmpp
     )
-    objectxmpp.schedule(
+    objectxmpp.deployment_jobs.add(
         "wol_interval",
         objectxmpp.wol_interval,
         objectxmpp.scheduledeployrecoveryjob,
-        repeat=True,
     )
 
     # declaration function garbagedeploy in object xmpp
     objectxmpp.garbagedeploy = types.MethodType(garbagedeploy, objectxmpp)
-    objectxmpp.schedule(
+    objectxmpp.deployment_jobs.add(
         "deployment_end_timeout",
         objectxmpp.deployment_end_timeout,
         objectxmpp.garbagedeploy,
-        repeat=True,
     )
 
     # declaration function handlemanagesession in object xmpp
     objectxmpp.handlemanagesession = types.MethodType(handlemanagesession, objectxmpp)
-    objectxmpp.schedule(
+    objectxmpp.deployment_jobs.add(
         "session check",
         objectxmpp.session_check_interval,
         objectxmpp.handlemanagesession,
-        repeat=True,
     )
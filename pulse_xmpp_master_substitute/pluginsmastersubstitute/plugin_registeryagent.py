@@ -17,6 +17,7 @@ from lib.plugins.kiosk import KioskDatabase
 from lib.manageRSAsigned import MsgsignedRSA
 from slixmpp import jid
 from lib.utils import getRandomName, call_plugin
+from lib.registration_fingerprint import changed_sections
 import re
 from distutils.version import LooseVersion
 import configparser
@@ -28,13 +29,17 @@ import time
 # import types
 
 logger = logging.getLogger()
-plugin = {"VERSION": "1.55", "NAME": "registeryagent", "TYPE": "substitute"}  # fmt: skip
+plugin = {"VERSION": "1.56", "NAME": "registeryagent", "TYPE": "substitute"}  # fmt: skip
 
 params = {"duration": 300}
 # The parameter named duration is the time after which a configuration request is considered as expired.
 # The connection agent re-sends a configuration request after 300 seconds, thus making the previous one
 # obsolete as it will not be processed
 
+# sections of the registration written by updateMachineRegistration, the
+# other ones need a complete registration
+delta_sections = {"agent", "plugins", "deployment"}
+
 # function comment for next feature
 # this functions will be used later
 # def function_dynamique_declaration_plugin(xmppobject):
@@ -52,6 +57,8 @@ def action(xmppobject, action, sessionid, data, msg, ret, dataobj):
 
         if compteurcallplugin == 0:
             xmppobject.compteur_de_traitement = {}
+            # jid -> (time of the complete registration, fingerprint)
+            xmppobject.registration_fingerprints = {}
             xmppobject.listconfiguration = []
             xmppobject.simultaneous_processing = 50
             xmppobject.show_queue_status = False
@@ -191,6 +198,8 @@ def action(xmppobject, action, sessionid, data, msg, ret, dataobj):
                                     % (interface["macaddress"], interface["ipaddress"])
                                 )
 
+                    if delta_registration(xmppobject, data, msg, showinfobool):
+                        return
                     logger.info("Registering machine %s" % data["from"])
                     XmppMasterDatabase().setlogxmpp(
                         "Registering machine %s" % data["from"],
@@ -338,35 +347,7 @@ def action(xmppobject, action, sessionid, data, msg, ret, dataobj):
                                 "** machine %s reports online in table machine"
                                 % data["from"]
                             )
-                        pluginfunction = [
-                            str("plugin_%s" % x)
-                            for x in xmppobject.pluginlistregistered
-                        ]
-                        if showinfobool:
-                            logger.info(
-                                "Calling plugins for all registration actions on online machine."
-                            )
-                        for function_plugin in pluginfunction:
-                            try:
-                                if hasattr(xmppobject, function_plugin):
-                                    if showinfobool:
-                                        logger.info(
-                                            "Calling plugin %s" % function_plugin
-                                        )
-                                    getattr(xmppobject, function_plugin)(msg, data)
-                                else:
-                                    if showinfobool:
-                                        logger.warning(
-                                            "The %s plugin is not called"
-                                            % function_plugin
-                                        )
-                                        logger.warning(
-                                            "Check why plugin %s"
-                                            " does not have function %s"
-                                            % (function_plugin, function_plugin)
-                                        )
-                            except Exception:
-                                logger.error("\n%s" % (traceback.format_exc()))
+                        call_registered_plugins(xmppobject, msg, data, showinfobool)
                         if showinfobool:
                             logger.debug("=============")
                             logger.debug("=============")
@@ -572,6 +553,11 @@ def action(xmppobject, action, sessionid, data, msg, ret, dataobj):
                             if XmppMasterDatabase().getPresencejid(msg["from"]):
                                 if showinfobool:
                                     logger.info("Correct jid: %s" % msg["from"])
+                                # the next registrations are compared to this one
+                                if "registration_fingerprint" in data:
+                                    xmppobject.registration_fingerprints[
+                                        data["from"]
+                                    ] = (time.time(), data["registration_fingerprint"])
                                 return
                             else:
                                 # The registration of the machine in database must be deleted, so it is updated.
@@ -1153,6 +1139,93 @@ def action(xmppobject, action, sessionid, data, msg, ret, dataobj):
         )
 
 
+def call_registered_plugins(xmppobject, msg, data, showinfobool):
+    pluginfunction = [str("plugin_%s" % x) for x in xmppobject.pluginlistregistered]
+    if showinfobool:
+        logger.info("Calling plugins for all registration actions on online machine.")
+    for function_plugin in pluginfunction:
+        try:
+            if hasattr(xmppobject, function_plugin):
+                if showinfobool:
+                    logger.info("Calling plugin %s" % function_plugin)
+                getattr(xmppobject, function_plugin)(msg, data)
+            else:
+                if showinfobool:
+                    logger.warning("The %s plugin is not called" % function_plugin)
+                    logger.warning(
+                        "Check why plugin %s"
+                        " does not have function %s"
+                        % (function_plugin, function_plugin)
+                    )
+        except Exception:
+            logger.error("\n%s" % (traceback.format_exc()))
+
+
+def delta_registration(xmppobject, data, msg, showinfobool):
+    """
+    Registration of a machine already registered, from the fingerprint of
+    the sections of its message.
+
+    The fingerprint is compared to the one of the last complete registration
+    of the machine. If no section changed, or only the sections in
+    delta_sections, these sections and the presence of the machine are
+    written in one transaction, and the registered plugins are called.
+    Otherwise the complete registration is done.
+
+    Returns True if the registration is done.
+    """
+    fingerprint = data.get("registration_fingerprint")
+    if (
+        not xmppobject.delta_registration
+        or not isinstance(fingerprint, dict)
+        or data.get("regcomplet") is True
+        or "oldjid" in data
+    ):
+        return False
+    previous = xmppobject.registration_fingerprints.get(data["from"])
+    if (
+        previous is None
+        or time.time() - previous[0] > xmppobject.registration_fingerprint_ttl
+    ):
+        return False
+    changed = changed_sections(fingerprint, previous[1])
+    if not changed <= delta_sections:
+        if showinfobool:
+            logger.info(
+                "sections %s changed for %s : complete registration"
+                % (sorted(changed), data["from"])
+            )
+        return False
+    sections = {}
+    if "agent" in changed:
+        sections["agent"] = {
+            "md5agentversion": data.get("md5agentversion", ""),
+            "versionagent": data.get("versionagent", ""),
+        }
+    if "deployment" in changed:
+        sections["deployment"] = {
+            "groupdeploy": data["deployment"],
+            "urlguacamole": data["baseurlguacamole"],
+        }
+    hostname = data.get("machine", "").split(".")
+    if len(hostname) > 1:
+        hostname.pop()
+    if not XmppMasterDatabase().updateMachineRegistration(
+        data["from"], ".".join(hostname), sections
+    ):
+        xmppobject.registration_fingerprints.pop(data["from"], None)
+        return False
+    # the time of the complete registration is kept: it is done again after
+    # registration_fingerprint_ttl
+    xmppobject.registration_fingerprints[data["from"]] = (previous[0], fingerprint)
+    logger.info(
+        "Machine %s registered (changed sections : %s)"
+        % (data["from"], ", ".join(sorted(changed)) or "none")
+    )
+    call_registered_plugins(xmppobject, msg, data, showinfobool)
+    return True
+
+
 def test_mac_address_black_list(macaddress, table_reg_for_match, showinfobool=True):
     if showinfobool:
         logger.info("analyse blacklist Mac address %s" % macaddress)
@@ -1680,6 +1753,8 @@ def read_conf_remote_registeryagent(xmppobject):
             "loadshowregistration",
         ]
         xmppobject.check_uuidinventory = False
+        xmppobject.delta_registration = True
+        xmppobject.registration_fingerprint_ttl = 86400
         xmppobject.blacklisted_mac_addresses = ["00\\:00\\:00\\:00\\:00\\:00"]
         xmppobject.registeryagent_showinfomachine = []
         xmppobject.use_uuid = True
@@ -1698,6 +1773,20 @@ def read_conf_remote_registeryagent(xmppobject):
         else:
             xmppobject.check_uuidinventory = False
 
+        if Config.has_option("parameters", "delta_registration"):
+            xmppobject.delta_registration = Config.getboolean(
+                "parameters", "delta_registration"
+            )
+        else:
+            xmppobject.delta_registration = True
+
+        if Config.has_option("parameters", "registration_fingerprint_ttl"):
+            xmppobject.registration_fingerprint_ttl = Config.getint(
+                "parameters", "registration_fingerprint_ttl"
+            )
+        else:
+            xmppobject.registration_fingerprint_ttl = 86400
+
         if Config.has_option("parameters", "use_uuid"):
             xmppobject.use_uuid = Config.getboolean("parameters", "use_uuid")
         else:
@@ -5,7 +5,6 @@
 
 import sys
 import os
-import gzip
 import zlib
 import base64
 import traceback
@@ -13,12 +12,14 @@ import urllib.request
 import urllib.error
 import time
 import json
+import threading
 from lib.plugins.xmpp import XmppMasterDatabase
 from lib.plugins.glpi import Glpi
 from lib.utils import convert
+from lib import inventorydelta
+from lib.inventoryforward import InventoryForwarder
 import re
 import inspect
-import requests
 import shutil
 from urllib.parse import urlparse
 from datetime import datetime
@@ -29,7 +30,8 @@ import importlib.util
 
 
 logger = logging.getLogger()
-plugin = {"VERSION": "1.13", "NAME": "resultinventory", "TYPE": "substitute"}  # fmt: skip
+plugin = {"VERSION": "1.16", "NAME": "resultinventory", "TYPE": "substitute"}  # fmt: skip
+forwarder_lock = threading.Lock()
 
 
 class InventoryFix:
@@ -131,55 +133,8 @@ class InventoryFix:
         return self._inventory_content
 
 
-def send_content(url, content, verbose=False, user_agent="siveo-injector"):
-    """
-    send inventaire to plugin fusion inventory
-
-    """
-    headers = {
-        "User-Agent": user_agent,
-        "Pragma": "no-cache",
-        "Content-Type": "Application/x-gzip",
-    }
-    if verbose:
-        logger.info("Send content to url : %s" % url)
-
-    compressed_content = convert.convert_to_bytes(content)
-    Content_Type = ["Application/x-compress"]
-    try:
-        compressed_content = gzip.compress(
-            convert.convert_to_bytes(content), compresslevel=9
-        )
-        Content_Type = ["Application/x-gzip"]
-    except:
-        logger.error("erreur compression de content")
-        compressed_content = convert.convert_to_bytes(content)
-    reponsequery = ""
-    reponsecode = 400
-    for mine in Content_Type:
-        headers["Content-Type"] = mine
-        if verbose:
-            logger.info("headers is : %s" % headers)
-        response = requests.post(url, headers=headers, data=compressed_content)
-        reponsecode = response.status_code
-        try:
-            reponsequery = gzip.decompress(response.content)
-        except:
-            reponsequery = response.content
-
-        if response.status_code == 200:
-            if verbose:
-                logger.info("OK")
-                logger.info(response.headers["Content-Type"])
-                logger.info(reponsequery)
-        else:
-            logger.error(response.status_code)
-            logger.error(reponsequery)
-    return reponsecode, reponsequery
-
-
 def action(xmppobject, action, sessionid, data, msg, ret, dataobj):
-    if "inventory" not in data:
+    if "inventory" not in data and "inventory_delta" not in data:
         error_msg = "inventory on machine %s " % msg["from"]
         if "msg" in data:
             error_msg = "%s : %s" % (error_msg, data["msg"])
@@ -192,13 +147,17 @@ def action(xmppobject, action, sessionid, data, msg, ret, dataobj):
         logger.info(
             "Received inventory from %s in inventory substitute agent" % (msg["from"])
         )
-        content = convert.convert_bytes_datetime_to_string(
-            zlib.decompress(base64.b64decode(data["inventory"]))
-        )
+        if "inventory_delta" in data:
+            content = inventory_from_delta(xmppobject, sessionid, data, msg)
+            if content is None:
+                return
+        else:
+            content = convert.convert_bytes_datetime_to_string(
+                zlib.decompress(base64.b64decode(data["inventory"]))
+            )
+            store_inventory(xmppobject, msg["from"], content)
+        forwarded = None
         if xmppobject.config.inventory_enable_forward:
-            list_url_to_forward = [
-                x.strip() for x in xmppobject.config.url_to_forward.split(",")
-            ]
             QUERY = "FAILS"
             DEVICEID = ""
             try:
@@ -257,13 +216,7 @@ def action(xmppobject, action, sessionid, data, msg, ret, dataobj):
                 logger.info(
                     "################################################################"
                 )
-            for url in list_url_to_forward:
-                codeerror, reponse = send_content(
-                    url,
-                    content,
-                    verbose=xmppobject.config.inventory_verbose,
-                    user_agent=xmppobject.config.user_agent,
-                )
+            forwarded = inventory_forwarder(xmppobject).submit(content)
         inventory = content
         machine = XmppMasterDatabase().getMachinefromjid(msg["from"])
         if not machine:
@@ -298,7 +251,33 @@ def action(xmppobject, action, sessionid, data, msg, ret, dataobj):
                 xmppobject.boundjid.bare,
                 xmppobject.boundjid.bare,
             )
-        time.sleep(15)
+        if forwarded is None:
+            inventory_injected(xmppobject, msg, data, machine)
+        else:
+            # GLPI is searched for the machine once the inventory is forwarded
+            forwarded.add_done_callback(
+                lambda future: inventory_injected(
+                    xmppobject, msg, data, machine, future.result()
+                )
+            )
+        # time.sleep(25)
+        # restart agent
+        # xmppobject.restartAgent(msg['from'])
+    except Exception as e:
+        logger.error("%s\n%s" % (str(e), traceback.format_exc()))
+
+
+def inventory_injected(xmppobject, msg, data, machine, forwarded=True):
+    """
+    Update the machine from its inventory in GLPI and add its registry
+    inventory. Called once the inventory has been forwarded to the inventory
+    servers (forwarded is False if a server did not receive it).
+    """
+    try:
+        if not forwarded:
+            logger.warning(
+                "inventory of %s not received by every inventory server" % msg["from"]
+            )
         uuidglpi = XmppUpdateInventoried(msg["from"], machine)
         if uuidglpi == -1:
             logger.error(
@@ -386,13 +365,77 @@ def action(xmppobject, action, sessionid, data, msg, ret, dataobj):
                         "getting key: %s\n%s" % (str(e), traceback.format_exc())
                     )
                     pass
-        # time.sleep(25)
-        # restart agent
-        # xmppobject.restartAgent(msg['from'])
     except Exception as e:
         logger.error("%s\n%s" % (str(e), traceback.format_exc()))
 
 
+def inventory_forwarder(xmppobject):
+    with forwarder_lock:
+        if not hasattr(xmppobject, "inventoryforwarder"):
+            xmppobject.inventoryforwarder = InventoryForwarder.from_config(
+                xmppobject.config
+            )
+    return xmppobject.inventoryforwarder
+
+
+def inventory_store(xmppobject):
+    if not hasattr(xmppobject, "inventorystore"):
+        xmppobject.inventorystore = inventorydelta.InventoryStore(
+            xmppobject.config.inventory_store
+        )
+    return xmppobject.inventorystore
+
+
+def store_inventory(xmppobject, jid, content):
+    """
+    Garde l'inventaire complet de la machine : il sert de base à son
+    prochain inventaire différentiel.
+    """
+    try:
+        inventory_store(xmppobject).save(jid, inventorydelta.split_inventory(content))
+    except inventorydelta.InventoryDeltaError as e:
+        logger.warning("inventory of %s cannot be stored : %s" % (jid, e))
+        inventory_store(xmppobject).discard(jid)
+
+
+def inventory_from_delta(xmppobject, sessionid, data, msg):
+    """
+    Reconstruit l'inventaire complet à partir des sections qui ont changé
+    et du dernier inventaire reçu de la machine.
+
+    Si ce dernier inventaire n'est pas celui sur lequel l'agent a calculé
+    son différentiel, un inventaire complet est demandé à la machine et
+    None est retourné.
+    """
+    store = inventory_store(xmppobject)
+    try:
+        delta = json.loads(
+            convert.convert_bytes_datetime_to_string(
+                zlib.decompress(base64.b64decode(data["inventory_delta"]))
+            )
+        )
+        inventory = inventorydelta.apply_delta(store.load(msg["from"]), delta)
+    except (inventorydelta.InventoryDeltaError, ValueError, KeyError) as e:
+        logger.warning(
+            "inventory delta of %s cannot be applied (%s), "
+            "the complete inventory is requested" % (msg["from"], e)
+        )
+        store.discard(msg["from"])
+        body = {
+            "action": "inventory",
+            "sessionid": sessionid,
+            "data": {"forced": "forced", "full": True},
+        }
+        xmppobject.send_message(mto=msg["from"], mbody=json.dumps(body), mtype="chat")
+        return None
+    store.save(msg["from"], inventory)
+    logger.debug(
+        "inventory of %s rebuilt with the sections %s"
+        % (msg["from"], ", ".join(delta["sections"]))
+    )
+    return inventorydelta.join_inventory(inventory)
+
+
 def getComputerByMac(mac):
     ret = Glpi().getMachineByMacAddress("imaging_module", mac)
     if isinstance(ret, list):
@@ -17,6 +17,7 @@ from lib.plugins.kiosk import KioskDatabase
 from lib.plugins.msc import MscDatabase
 from lib.plugins.glpi import Glpi
 from lib.managepackage import managepackage
+from lib.kioskresolver import kiosk_resolver
 from lib.utils import (
     name_random,
     file_get_contents,
@@ -24,6 +25,7 @@ from lib.utils import (
     getRandomName,
     call_plugin,
     name_randomplus,
+    package_files_hash,
 )
 import base64
 
@@ -40,7 +42,7 @@ if sys.version_info >= (3, 0, 0):
 
 logger = logging.getLogger()
 
-plugin = {"VERSION": "1.3", "NAME": "resultkiosk", "TYPE": "substitute"}  # fmt: skip
+plugin = {"VERSION": "1.5", "NAME": "resultkiosk", "TYPE": "substitute"}  # fmt: skip
 PREFIX_COMMAND = "commandkiosk"
 
 
@@ -362,11 +364,14 @@ def get_packages_for_machine(machine, showinfobool=True):
     if list_profile_packages is None:
         return []
 
-    granted_packages = []
-    for element in list_profile_packages:
-        granted_packages += KioskDatabase().get_acknowledges_for_package_profile(
-            element[9], element[6], machine["lastuser"]
-        )
+    # acknowledgements of the user, by (package uuid, package_has_profil id)
+    granted_packages = {}
+    for ack in KioskDatabase().get_acknowledges_for_package_profiles(
+        {element[9] for element in list_profile_packages}, machine["lastuser"]
+    ):
+        granted_packages.setdefault(
+            (ack["package_uuid"], ack["id_package_has_profil"]), []
+        ).append(ack)
     list_software_glpi = []
     softwareonmachine = Glpi().getLastMachineInventoryPart(
         machine["uuid_inventorymachine"],
@@ -378,6 +383,9 @@ def get_packages_for_machine(machine, showinfobool=True):
     )
     for x in softwareonmachine:
         list_software_glpi.append([x[0][1], x[1][1], x[2][1]])
+    list_software_glpi = kiosk_resolver.softwares(
+        list_software_glpi, [element[4] for element in list_profile_packages]
+    )
 
     structuredatakiosk = []
     indexed = {}
@@ -423,6 +431,11 @@ def get_packages_for_machine(machine, showinfobool=True):
 def __search_software_in_glpi(
     list_software_glpi, list_granted_packages, packageprofile
 ):
+    """
+    list_software_glpi : SoftwareIndex of the softwares of the machine
+    list_granted_packages : acknowledgements by (package uuid,
+                            package_has_profil id)
+    """
     structuredatakioskelement = {
         "name": packageprofile[0],
         "action": [],
@@ -433,66 +446,46 @@ def __search_software_in_glpi(
         "launcher_cmd": "",
     }
 
-    descriptor = getdescriptor(packageprofile[6])
-    if "launcher" in descriptor["info"]:
-        structuredatakioskelement["launcher_cmd"] = descriptor["info"]["launcher"]
-    else:
-        pass
-
-    patternname = re.compile(
-        "(?i)"
-        + packageprofile[4]
-        .replace("+", "\+")
-        .replace("*", "\*")
-        .replace("(", "\(")
-        .replace(")", "\)")
-        .replace(".", "\.")
-    )
-    for soft_glpi in list_software_glpi:
-        if (
-            patternname.match(str(soft_glpi[0]))
-            or patternname.match(str(soft_glpi[1]))
-            or (soft_glpi[1] == packageprofile[4] and soft_glpi[2] == packageprofile[5])
-        ):
-            # Process with this package which is installed on the machine
-            # The package could be deleted
-            structuredatakioskelement["icon"] = "kiosk.png"
-            for step in descriptor.get("win", {}).get("sequence", []):
-                if step.get("action") == "action_section_uninstall":
-                    structuredatakioskelement["action"].append("Delete")
-                    break
-            structuredatakioskelement["action"].append("Launch")
-            # verification if update
-            # compare the version
-            # TODO
-            # For now we use the package version. Later the software version will be needed into the pulse package
-            if LooseVersion(soft_glpi[2]) < LooseVersion(packageprofile[3]):
-                structuredatakioskelement["action"].append("Update")
-                logger.debug(
-                    "the software version is superior "
-                    "to that installed on the machine %s : %s < %s"
-                    % (packageprofile[0], soft_glpi[2], LooseVersion(packageprofile[3]))
-                )
-            break
+    descriptor = kiosk_resolver.package(packageprofile[6]) or {
+        "launcher": "",
+        "uninstall": False,
+    }
+    structuredatakioskelement["launcher_cmd"] = descriptor["launcher"]
+
+    soft_glpi = list_software_glpi.find(packageprofile[4], packageprofile[5])
+    if soft_glpi is not None:
+        # Process with this package which is installed on the machine
+        # The package could be deleted
+        structuredatakioskelement["icon"] = "kiosk.png"
+        if descriptor["uninstall"]:
+            structuredatakioskelement["action"].append("Delete")
+        structuredatakioskelement["action"].append("Launch")
+        # verification if update
+        # compare the version
+        # TODO
+        # For now we use the package version. Later the software version will be needed into the pulse package
+        if LooseVersion(soft_glpi[2]) < LooseVersion(packageprofile[3]):
+            structuredatakioskelement["action"].append("Update")
+            logger.debug(
+                "the software version is superior "
+                "to that installed on the machine %s : %s < %s"
+                % (packageprofile[0], soft_glpi[2], LooseVersion(packageprofile[3]))
+            )
     if len(structuredatakioskelement["action"]) == 0:
         # The package defined for this profile is absent from the machine:
         if packageprofile[8] == "allowed":
             structuredatakioskelement["action"].append("Install")
         else:
             trigger = False
-            for ack in list_granted_packages:
-                if ack["package_uuid"] == structuredatakioskelement["uuid"]:
-                    if ack["id_package_has_profil"] != packageprofile[9]:
-                        continue
-                    else:
-                        if ack["status"] == "allowed":
-                            structuredatakioskelement["action"].append("Install")
-                        elif ack["status"] == "waiting":
-                            trigger = True
-                        elif ack["status"] == "rejected":
-                            trigger = True
-                else:
-                    continue
+            for ack in list_granted_packages.get(
+                (structuredatakioskelement["uuid"], packageprofile[9]), []
+            ):
+                if ack["status"] == "allowed":
+                    structuredatakioskelement["action"].append("Install")
+                elif ack["status"] == "waiting":
+                    trigger = True
+                elif ack["status"] == "rejected":
+                    trigger = True
 
             if len(structuredatakioskelement["action"]) == 0 and trigger is False:
                 structuredatakioskelement["action"].append("Ask")
@@ -646,6 +639,7 @@ def deploypackage(data, message, xmppobject, sessionid):
             "methodetransfert": "pushrsync",
             "path": path,
             "packagefile": os.listdir(path),
+            "packagefilehash": package_files_hash(path),
             "jidrelay": jidrelay,
             "jidmachine": jidmachine,
             "jidmaster": xmppobject.boundjid.bare,
@@ -996,6 +990,7 @@ def applicationdeploymentjsonkiosk(
         "methodetransfert": "pushrsync",
         "path": path,
         "packagefile": os.listdir(path),
+        "packagefilehash": package_files_hash(path),
         "jidrelay": jidrelay,
         "jidmachine": jidmachine,
         "jidmaster": self.boundjid.bare,
@@ -7,54 +7,34 @@ import os
 import json
 import logging
 from lib.plugins.xmpp import XmppMasterDatabase
-from lib.utils import file_put_contents, call_plugin
+from lib.manage_xmpplog import XmppLogWriter
+from lib.utils import file_put_contents
 import re
 import configparser
+import threading
 
 # this import will be used later
 # import types
 
 logger = logging.getLogger()
-plugin = {"VERSION": "1.03", "NAME": "xmpplog", "TYPE": "substitute"}  # fmt: skip
+plugin = {"VERSION": "1.04", "NAME": "xmpplog", "TYPE": "substitute"}  # fmt: skip
+
+_init_lock = threading.Lock()
 
 
 def action(xmppobject, action, sessionid, data, msg, ret, dataobj):
     logger.debug("=====================================================")
     logger.debug("call %s from %s" % (plugin, msg["from"]))
     logger.debug("=====================================================")
-    compteurcallplugin = getattr(xmppobject, "num_call%s" % action)
-    if compteurcallplugin == 0:
-        xmppobject.compteur_de_traitement = 0
-        xmppobject.listconfiguration = []
-        xmppobject.simultaneous_processing = 50
-        xmppobject.show_queue_status = False
-        xmppobject.status_rules = []
-        loggerliststatus = XmppMasterDatabase().get_log_status()
-        try:
-            for t in XmppMasterDatabase().get_log_status():
-                t["compile_re"] = re.compile(t["regexplog"])
-                xmppobject.status_rules.append(t)
-            logger.debug("We initialized to the rule: %s" % xmppobject.status_rules)
-        except Exception:
-            logger.error("\n%s" % (traceback.format_exc()))
-        read_conf_log_agent(xmppobject)
-    if xmppobject.compteur_de_traitement >= xmppobject.simultaneous_processing:
-        xmppobject.listconfiguration.append(
-            {"action": action, "sessionid": sessionid, "data": data, "msg": msg}
-        )
-        if bool(xmppobject.show_queue_status):
-            logger.info(
-                "Pending pool counter = %s" % (xmppobject.compteur_de_traitement)
-            )
-        return
+    if getattr(xmppobject, "xmpplog_writer", None) is None:
+        init_log_writer(xmppobject)
     try:
-        xmppobject.compteur_de_traitement = xmppobject.compteur_de_traitement + 1
         dataobj = data
         if "type" in dataobj and dataobj["type"] == "deploy" and "text" in dataobj:
             re_status = searchstatus(xmppobject, dataobj["text"])
             if re_status["status"] != "":
-                XmppMasterDatabase().updatedeploytosessionid(
-                    re_status["status"], dataobj["sessionid"]
+                xmppobject.xmpplog_writer.set_deploy_status(
+                    dataobj["sessionid"], re_status["status"]
                 )
                 logging.debug(
                     "We applied the status %s for the sessionid %s"
@@ -77,36 +57,32 @@ def action(xmppobject, action, sessionid, data, msg, ret, dataobj):
     except Exception as e:
         logging.error("structure Message from %s %s " % (msg["from"], str(e)))
         logger.error("\n%s" % (traceback.format_exc()))
-    finally:
-        xmppobject.compteur_de_traitement = xmppobject.compteur_de_traitement - 1
-        if xmppobject.compteur_de_traitement < 0:
-            xmppobject.compteur_de_traitement = 0
-        while (
-            xmppobject.compteur_de_traitement > 0
-            and xmppobject.compteur_de_traitement < xmppobject.simultaneous_processing
-            and len(xmppobject.listconfiguration)
-        ):
-            ## call plugin
-            report = xmppobject.listconfiguration.pop(0)
-            dataerreur = {
-                "action": "result" + plugin["NAME"],
-                "data": {"msg": "error plugin : " + plugin["NAME"]},
-                "sessionid": report["sessionid"],
-                "ret": 255,
-                "base64": False,
-            }
-            if bool(xmppobject.show_queue_status):
-                logger.info("Re-call plugin %s" % (plugin["NAME"]))
-            call_plugin(
-                __file__,
-                xmppobject,
-                action,
-                report["sessionid"],
-                report["data"],
-                report["msg"],
-                0,
-                dataerreur,
-            )
+
+
+def init_log_writer(xmppobject):
+    """
+    Load the deploy status rules and start the buffered log writer.
+    The first messages can be processed concurrently, so this is done once
+    under a lock.
+    """
+    with _init_lock:
+        if getattr(xmppobject, "xmpplog_writer", None) is not None:
+            return
+        xmppobject.status_rules = []
+        try:
+            for t in XmppMasterDatabase().get_log_status():
+                t["compile_re"] = re.compile(t["regexplog"])
+                xmppobject.status_rules.append(t)
+            logger.debug("We initialized to the rule: %s" % xmppobject.status_rules)
+        except Exception:
+            logger.error("\n%s" % (traceback.format_exc()))
+        read_conf_log_agent(xmppobject)
+        xmppobject.xmpplog_writer = XmppLogWriter(
+            XmppMasterDatabase(),
+            batch_size=xmppobject.log_batch_size,
+            flush_interval=xmppobject.log_flush_interval,
+            max_queue=xmppobject.log_max_queue,
+        )
 
 
 def createlog(xmppobject, dataobj):
@@ -130,7 +106,7 @@ def createlog(xmppobject, dataobj):
         touser = dataobj["touser"] if "touser" in dataobj else xmppobject.boundjid.bare
         if sessionname.startswith("update"):
             type = "update"
-        XmppMasterDatabase().setlogxmpp(
+        xmppobject.xmpplog_writer.add_log(
             text,
             type=type,
             sessionname=sessionname,
@@ -168,7 +144,7 @@ def registerlogxmpp(
     if sessionname.startswith("update"):
         typelog = "update"
     typelog = "noset"
-    XmppMasterDatabase().setlogxmpp(
+    xmppobject.xmpplog_writer.add_log(
         text,
         type=typelog,
         sessionname=sessionname,
@@ -225,8 +201,9 @@ def xmpplogdeploy(xmppobject, data):
 
 
 def read_conf_log_agent(xmppobject):
-    xmppobject.simultaneous_processing = 50
-    xmppobject.show_queue_status = False
+    xmppobject.log_batch_size = 500
+    xmppobject.log_flush_interval = 1.0
+    xmppobject.log_max_queue = 20000
     namefichierconf = plugin["NAME"] + ".ini"
     pathfileconf = os.path.join(xmppobject.config.pathdirconffile, namefichierconf)
     logger.warning("Config file %s for plugin %s" % (pathfileconf, plugin["NAME"]))
@@ -235,10 +212,10 @@ def read_conf_log_agent(xmppobject):
             "Plugin %s\nConfiguration file :"
             "\n\t%s missing"
             "\neg conf:\n[parameters]\n"
-            "simultaneous_processing = 50" % (plugin["NAME"], pathfileconf)
+            "batch_size = 500" % (plugin["NAME"], pathfileconf)
         )
         logger.warning("create default conf file %s" % pathfileconf)
-        file_put_contents(pathfileconf, "[parameters]\nsimultaneous_processing = 50\n")
+        file_put_contents(pathfileconf, "[parameters]\nbatch_size = 500\n")
     else:
         Config = configparser.ConfigParser()
         Config.read(pathfileconf)
@@ -247,19 +224,16 @@ def read_conf_log_agent(xmppobject):
             Config.read(pathfileconf + ".local")
             logger.debug("read file %s.local" % pathfileconf)
 
-        if Config.has_option("parameters", "simultaneous_processing"):
-            xmppobject.simultaneous_processing = Config.getint(
-                "parameters", "simultaneous_processing"
-            )
-        else:
-            xmppobject.simultaneous_processing = 50
+        if Config.has_option("parameters", "batch_size"):
+            xmppobject.log_batch_size = Config.getint("parameters", "batch_size")
 
-        if Config.has_option("parameters", "show_queue_status"):
-            xmppobject.show_queue_status = Config.getboolean(
-                "parameters", "show_queue_status"
+        if Config.has_option("parameters", "flush_interval"):
+            xmppobject.log_flush_interval = Config.getfloat(
+                "parameters", "flush_interval"
             )
-        else:
-            xmppobject.show_queue_status = False
+
+        if Config.has_option("parameters", "max_queue"):
+            xmppobject.log_max_queue = Config.getint("parameters", "max_queue")
 
 
 def searchstatus(xmppobject, chaine):
@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; -*-
+# SPDX-FileCopyrightText: 2016-2023 Siveo <support@siveo.net>
+# SPDX-License-Identifier: GPL-3.0-or-later
+import base64
+import importlib.util
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load(name, path):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+agentdelta = load("agentdelta", "pulse_xmpp_agent/lib/inventorydelta.py")
+substitutedelta = load(
+    "substitutedelta", "pulse_xmpp_master_substitute/lib/inventorydelta.py"
+)
+
+
+def encode(string):
+    # convert.compress_and_encode de l'agent
+    return base64.b64encode(zlib.compress(string.encode("utf-8"), 9)).decode("utf-8")
+
+
+def inventory(softwares, processes, ip, logdate="2024-01-01 10:00:00"):
+    content = [
+        "<HARDWARE><NAME>pc-01</NAME><UUID>4C4C4544</UUID></HARDWARE>",
+        "<BIOS><SMODEL>OptiPlex</SMODEL><BDATE>2023-01-01</BDATE></BIOS>",
+    ]
+    content.extend(
+        "<SOFTWARES><NAME>software %s</NAME><VERSION>1.%s</VERSION>"
+        "<PUBLISHER>Publisher &amp; Co</PUBLISHER></SOFTWARES>" % (x, x)
+        for x in range(softwares)
+    )
+    content.append(
+        "<NETWORKS><IPADDRESS>%s</IPADDRESS><MACADDR>00:11:22:33:44:55</MACADDR>"
+        "</NETWORKS>" % ip
+    )
+    content.extend(
+        "<PROCESSES><CMD>/usr/bin/process %s</CMD><PID>%s</PID></PROCESSES>" % (x, x)
+        for x in range(processes)
+    )
+    content.append("<STORAGES><NAME>sda</NAME><DISKSIZE>476940</DISKSIZE></STORAGES>")
+    content.append("<ACCESSLOG><LOGDATE>%s</LOGDATE></ACCESSLOG>" % logdate)
+    return (
+        '<?xml version="1.0" encoding="UTF-8" ?><REQUEST><CONTENT>%s</CONTENT>'
+        "<DEVICEID>pc-01-2024-01-01-10-00-00</DEVICEID><QUERY>INVENTORY</QUERY>"
+        "</REQUEST>" % "".join(content)
+    )
+
+
+class TestInventoryDelta(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = substitutedelta.InventoryStore(self.directory)
+        self.jid = "pc-01.abc@pulse/abcdef"
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_split_join(self):
+        content = inventory(50, 20, "10.0.0.1")
+        split = agentdelta.split_inventory(content)
+        self.assertEqual(agentdelta.join_inventory(split), content)
+        self.assertEqual(split["layout"][2], ["SOFTWARES", 50])
+        self.assertEqual(len(split["sections"]["PROCESSES"]), 20)
+
+    def test_replay(self):
+        first = inventory(800, 150, "10.0.0.1")
+        second = inventory(800, 150, "10.0.0.2", "2024-01-02 10:00:00").replace(
+            "/usr/bin/process 3<", "/usr/bin/process 3 --daemon<"
+        )
+
+        # premier inventaire : envoyé complet, gardé par le substitut
+        split = agentdelta.split_inventory(first)
+        hashes = agentdelta.section_hashes(split)
+        self.store.save(self.jid, substitutedelta.split_inventory(first))
+
+        # second inventaire : les logiciels n'ont pas changé
+        delta = agentdelta.make_delta(agentdelta.split_inventory(second), hashes)
+        self.assertEqual(
+            sorted(delta["sections"]), ["ACCESSLOG", "NETWORKS", "PROCESSES"]
+        )
+        payload_full = len(encode(second))
+        payload_delta = len(encode(json.dumps(delta)))
+        self.assertLess(payload_delta * 2, payload_full)
+
+        rebuilt = substitutedelta.apply_delta(self.store.load(self.jid), delta)
+        self.assertEqual(substitutedelta.join_inventory(rebuilt), second)
+
+        # une machine qui ne change pas n'envoie aucune section
+        delta = agentdelta.make_delta(
+            agentdelta.split_inventory(second), agentdelta.section_hashes(rebuilt)
+        )
+        self.assertEqual(delta["sections"], {})
+        self.assertEqual(
+            substitutedelta.join_inventory(substitutedelta.apply_delta(rebuilt, delta)),
+            second,
+        )
+
+    def test_base_mismatch(self):
+        first = inventory(10, 5, "10.0.0.1")
+        second = inventory(10, 5, "10.0.0.2")
+        delta = agentdelta.make_delta(
+            agentdelta.split_inventory(second),
+            agentdelta.section_hashes(agentdelta.split_inventory(first)),
+        )
+        with self.assertRaises(substitutedelta.InventoryDeltaError):
+            substitutedelta.apply_delta(self.store.load(self.jid), delta)
+        self.store.save(self.jid, substitutedelta.split_inventory(second))
+        with self.assertRaises(substitutedelta.InventoryDeltaError):
+            substitutedelta.apply_delta(self.store.load(self.jid), delta)
+
+
+if __name__ == "__main__":
+    unittest.main()